@@ -0,0 +1,153 @@
+# Benchmark of negotiated compression, for chat frames and for /p2pvideo payloads
+#
+# chat   starts a server with --compression none and then with the default, connects --clients
+#        clients in groups of --group-size that offer zlib at login and send /groupmsg text, and
+#        reports the bytes the clients received per message delivered, delivery latency and the
+#        CPU time the server's compressors took (from /stats)
+# files  sends files through a relay limited to --link-mbps, standing in for a slow link, with and
+#        without compression: log-like text, random bytes like a compressed video, and a mix
+#
+# Usage: python3 benchmarks/bench_compression.py [--clients 200] [--group-size 20] [--duration 10]
+#                                                [--threshold BYTES] [--link-mbps 80] [--file-mb 16]
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import relay
+import transfer
+from bench_load import Recorder, SimClient, percentile, receive_loop, start_server, stop_server
+
+WORDS = ("the meeting moved to three this afternoon can you send me the slides before lunch I will be "
+         "late today the build is green again please review my change when you have a minute thanks").split()
+
+# Counts what a client reads from its socket
+class CountingReader:
+    def __init__(self, reader):
+        self.reader = reader
+        self.bytes = 0
+
+    async def read(self, size):
+        data = await self.reader.read(size)
+        self.bytes += len(data)
+        return data
+
+class CompressingClient(SimClient):
+    async def connect(self, port):
+        await SimClient.connect(self, port)
+        # read_loop() has not run yet, it reads through the counter from its first read
+        self.reader = CountingReader(self.reader)
+
+    # Messages are "lg <perf_counter_ns> TEXT"
+    def delivered(self, text):
+        content = text.split(": ", 1)[1]
+        if content.startswith("lg "):
+            self.recorder.record((time.perf_counter_ns() - int(content.split(" ", 2)[1])) / 1e9)
+
+    async def login(self):
+        reply = await self.request("credentials", self.username, self.password, self.udp_port, "zlib")
+        if reply.args[0] != "success":
+            raise RuntimeError(f"login of {self.username} failed: {reply.args[0]}")
+        self.send("Log", self.username, self.udp_port)
+
+async def chat(args, port):
+    recorder = Recorder()
+    users = [CompressingClient(f"user{index}", f"password{index}", 20000 + index, recorder)
+             for index in range(args.clients)]
+    for user in users:
+        await user.connect(port)
+        await user.login()
+    groups = [users[start:start + args.group_size] for start in range(0, len(users), args.group_size)]
+    for index, members in enumerate(groups):
+        await members[0].request("/creategroup", f"g{index}", *(member.username for member in members))
+        for member in members[1:]:
+            await member.request("/joingroup", f"g{index}", member.username)
+    received_before = sum(user.reader.bytes for user in users)
+
+    stopping = time.monotonic() + args.duration
+
+    async def talk(user, group):
+        while time.monotonic() < stopping:
+            text = " ".join(random.choice(WORDS) for _ in range(random.randrange(4, 30)))
+            user.send("/groupmsg", group, user.username, f"lg {time.perf_counter_ns()} {text}")
+            await asyncio.sleep(args.think_ms / 1000 * random.uniform(0.5, 1.5))
+
+    await asyncio.gather(*(talk(member, f"g{index}") for index, members in enumerate(groups) for member in members))
+    await asyncio.sleep(1) # Deliveries still in flight
+    received = sum(user.reader.bytes for user in users) - received_before
+    stats = json.loads((await users[0].request("/stats")).args[0])["gauges"]["compression"]
+    for user in users:
+        await user.close()
+    return recorder, received, stats
+
+def files(args, directory):
+    size = args.file_mb * 1024 * 1024
+    text = b"".join(b"%d 18 Oct 2026 12:%02d:%02d user%d: %s\n" % (
+        number, number % 60, number % 60, number % 97, " ".join(random.choice(WORDS) for _ in range(8)).encode())
+        for number in range(size // 60))[:size]
+    video = os.urandom(size)
+    # A container: mostly compressed frames, with an index and some metadata that compress well
+    mixed = video[:size * 3 // 4] + text[:size // 4]
+
+    relays = relay.RelayServer("127.0.0.1", args.link_mbps * 1000 * 1000 // 8, 0)
+    for name, data in (("text", text), ("video", video), ("mixed", mixed)):
+        source = os.path.join(directory, f"{name}.bin")
+        with open(source, "wb") as file:
+            file.write(data)
+        for compress in (False, True):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            sock.settimeout(0.5)
+            receiver = transfer.TransferReceiver(sock, directory)
+            thread = threading.Thread(target=receive_loop, args=(receiver,), daemon=True)
+            thread.start()
+            port = relays.open("127.0.0.1", sock.getsockname())
+            cpu_started = time.process_time()
+            stats = transfer.send_file(("127.0.0.1", port), source, "alice", f"{name}{int(compress)}.bin",
+                                       None, transfer.MAX_TIMEOUTS, compress)
+            cpu = time.process_time() - cpu_started
+            sock.sendto(transfer.stop_packet(), sock.getsockname())
+            thread.join()
+            sock.close()
+            print(f"files {name:5} compress {'on ' if compress else 'off'}  {stats.duration():6.2f} s  "
+                  f"{stats.throughput() / 1e6:6.1f} MB/s  on the wire {stats.wire_bytes / max(stats.payload_bytes, 1):5.1%}  "
+                  f"sender compression CPU {stats.compress_seconds:5.2f} s  process CPU {cpu:5.2f} s")
+    relays.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--group-size", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--think-ms", type=float, default=200.0)
+    parser.add_argument("--threshold", type=int, default=None, help="the server's --compression-threshold")
+    parser.add_argument("--link-mbps", type=int, default=80, help="rate of the relay the files go through")
+    parser.add_argument("--file-mb", type=int, default=16)
+    args = parser.parse_args()
+
+    threshold = [] if args.threshold is None else ["--compression-threshold", str(args.threshold)]
+    for name, server_args in (("off", ["--compression", "none"]), ("on", threshold)):
+        with tempfile.TemporaryDirectory() as directory:
+            process, port = start_server(directory, args.clients, server_args)
+            try:
+                recorder, received, stats = asyncio.run(chat(args, port))
+            finally:
+                stop_server(process)
+        latencies = sorted(recorder.latencies)
+        print(f"chat  compression {name:3}  {len(latencies)} deliveries  {received / max(len(latencies), 1):6.1f} bytes each  "
+              f"p50 {percentile(latencies, 0.5) * 1000:6.2f} ms  p99 {percentile(latencies, 0.99) * 1000:6.2f} ms  "
+              f"server {stats['deflated']} deflated, {stats['plain_writes']} plain, "
+              f"{stats['cpu_us_per_kb'] or 0:.1f} us CPU per KB")
+
+    with tempfile.TemporaryDirectory() as directory:
+        files(args, directory)
+
+if __name__ == "__main__":
+    main()
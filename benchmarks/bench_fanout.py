@@ -0,0 +1,158 @@
+# Sender side cost of one group message to many recipients
+# The legacy path is the original server code: sendall() on every recipient's socket from the
+# sender's thread. The queued paths use outbound.py: the frame is queued for every recipient and
+# each recipient's writer sends it, a thread per connection as in --mode threaded, or a coroutine
+# per connection as in --mode async. In the queued runs one recipient never reads, its queue
+# spills to disk while the sender and the other recipients carry on. (The legacy path cannot be
+# run with a stalled recipient, the sender would block on it for good.)
+#
+# In the threaded run the writer threads share the GIL with the sender, so the time per send also
+# counts the writing done meanwhile. In the async run the writers only run once the send returns.
+#
+# Usage: python3 benchmarks/bench_fanout.py [--members 1000] [--messages 200] [--size 200]
+import argparse
+import asyncio
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+from outbound import OutboundQueue, DeliveryMetrics, send_frames
+
+# Reads and discards everything arriving on the given sockets until stopped
+def drain(sockets, stopped):
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+    while not stopped.is_set():
+        for key, _ in selector.select(0.1):
+            try:
+                key.fileobj.recv(1 << 20)
+            except BlockingIOError:
+                pass
+    selector.close()
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def run(members, messages, frame, mode):
+    pairs = [socket.socketpair() for _ in range(members)]
+    stalled = 0 if mode == "legacy" else 1
+    stopped = threading.Event()
+    reader = threading.Thread(target=drain, args=([far for _, far in pairs[stalled:]], stopped))
+    reader.start()
+
+    metrics = DeliveryMetrics()
+    if mode == "threaded":
+        recipients = []
+        for index, (near, _) in enumerate(pairs):
+            queue = OutboundQueue(f"member{index}", limit=16 * 1024, policy="spill", metrics=metrics)
+            threading.Thread(target=write_loop, args=(queue, near), daemon=True).start()
+            recipients.append(queue)
+        samples = send_all(recipients, messages, frame)
+        deepest = metrics.depths()[0]
+        for queue in recipients:
+            queue.close(discard=True)
+    elif mode == "async":
+        samples, deepest = asyncio.run(run_async(pairs, messages, frame, metrics))
+    else:
+        samples = send_all([near for near, _ in pairs], messages, frame)
+        deepest = None
+    stopped.set()
+    reader.join()
+    for near, far in pairs:
+        near.close()
+        far.close()
+    return samples, deepest
+
+def send_all(recipients, messages, frame):
+    samples = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        for recipient in recipients:
+            recipient.sendall(frame)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+async def run_async(pairs, messages, frame, metrics):
+    recipients = []
+    writers = []
+    for index, (near, _) in enumerate(pairs):
+        _, writer = await asyncio.open_connection(sock=near)
+        ready = asyncio.Event()
+        queue = OutboundQueue(f"member{index}", limit=16 * 1024, policy="spill", on_ready=ready.set, metrics=metrics)
+        writers.append(asyncio.create_task(write_loop_async(queue, ready, writer)))
+        recipients.append(queue)
+    samples = []
+    for _ in range(messages):
+        started = time.perf_counter()
+        for recipient in recipients:
+            recipient.sendall(frame)
+        samples.append(time.perf_counter() - started)
+        # Lets the writers run between messages, as the server does between commands
+        await asyncio.sleep(0)
+    deepest = metrics.depths()[0]
+    for queue in recipients:
+        queue.close(discard=True)
+    # The stalled member's writer may be waiting on drain() for good
+    for task in writers:
+        task.cancel()
+    await asyncio.gather(*writers, return_exceptions=True)
+    return samples, deepest
+
+# The writer loops of ClientThread and AsyncClientConnection in server.py
+async def write_loop_async(queue, ready, writer):
+    while True:
+        frames = queue.take()
+        if frames is None:
+            return
+        if not frames:
+            ready.clear()
+            await ready.wait()
+            continue
+        writer.writelines(frames)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            return
+
+def write_loop(queue, sock):
+    while True:
+        frames = queue.take(block=True)
+        if frames is None:
+            return
+        try:
+            send_frames(sock, frames)
+        except OSError:
+            return
+
+def report(name, members, samples, deepest=None):
+    line = (f"{name:8} {members} members: p50 {percentile(samples, 0.5) * 1e6:9.1f} us  "
+            f"p99 {percentile(samples, 0.99) * 1e6:9.1f} us  per send, "
+            f"{sum(samples) / len(samples) / members * 1e6:.2f} us per recipient")
+    if deepest is not None:
+        line += f", {deepest[1]} bytes queued for {deepest[0]}"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=200, help="message length in characters")
+    args = parser.parse_args()
+
+    frame = protocol.encode("groupmsg_recieve", "x" * args.size)
+    samples, _ = run(args.members, args.messages, frame, "legacy")
+    report("legacy", args.members, samples)
+    for mode in ("threaded", "async"):
+        samples, deepest = run(args.members, args.messages, frame, mode)
+        report(mode, args.members, samples, deepest)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Cost of the checks and the recipient lookup behind one /groupmsg in a large group
+# The legacy path is the original server code: "username not in members_joined[group]" on lists,
+# then a presence lookup for every joined member. The registry path is groups.py: set lookups and
+# the group's set of members online, kept up to date by logins and logouts.
+#
+# Usage: python3 benchmarks/bench_groups.py [--members 10000] [--online 500] [--messages 500]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from groups import GroupRegistry
+from presence import PresenceRegistry
+
+TIMESTAMP = "18 Oct 2026 12:00:00"
+
+def run_legacy(members, online, messages, presence):
+    groups = {"big": members}
+    members_joined = {"big": list(members)}
+    started = time.perf_counter()
+    for _ in range(messages):
+        sender = random.choice(online)
+        assert sender in groups["big"] and sender in members_joined["big"]
+        recipients = [member for member in members_joined["big"] if member != sender and presence.get(member) is not None]
+    return time.perf_counter() - started, len(recipients)
+
+def run_registry(members, online, messages, presence):
+    groups = GroupRegistry()
+    groups.attach(presence)
+    groups.create("big", members, joined=members[1:])
+    group = groups.get("big")
+    started = time.perf_counter()
+    for _ in range(messages):
+        sender = random.choice(online)
+        assert sender in group.members and sender in group.joined
+        recipients = [member for member in group.recipients() if member != sender and presence.get(member) is not None]
+    return time.perf_counter() - started, len(recipients)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--online", type=int, default=500, help="members logged in")
+    parser.add_argument("--messages", type=int, default=500)
+    args = parser.parse_args()
+
+    members = [f"user{index}" for index in range(args.members)]
+    online = random.sample(members, args.online)
+    presence = PresenceRegistry()
+    for username in online:
+        presence.login(username, None, TIMESTAMP, "127.0.0.1", 10000)
+
+    for name, run in (("legacy", run_legacy), ("registry", run_registry)):
+        elapsed, recipients = run(members, online, args.messages, presence)
+        print(f"{name:8} {args.members} members, {args.online} online: "
+              f"{elapsed / args.messages * 1e6:,.1f} us per message, {recipients} recipients")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Loopback benchmark of sending one file to every member of a group
+# "each" is what a presenter had to do before /groupvideo: one /p2pvideo per member, one after the
+# other. "group" is transfer.send_file_to_group(), which maps and hashes the file once and sends it
+# to every member at once. Sender CPU is the CPU time of the sending thread only, the receivers run
+# on a thread of their own. Everything a receiver sends back is held for --rtt-ms, as if the members
+# were that far away: one transfer after the other pays every round trip once per member.
+#
+# Usage: python3 benchmarks/bench_groupvideo.py [--members 8] [--size-mb 32] [--rtt-ms 20] [--payload-size BYTES]
+import argparse
+import heapq
+import itertools
+import os
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import transfer
+
+# Receiver socket whose sendto() is held until the delay has passed, Audience sends it then
+class DelayedSocket:
+    def __init__(self, sock, audience):
+        self.sock = sock
+        self.audience = audience
+
+    def sendto(self, data, address):
+        heapq.heappush(self.audience.delayed, (time.monotonic() + self.audience.delay, next(self.audience.order),
+                                               self.sock, bytes(data), address))
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+# One receiver per member, all served by one thread
+class Audience:
+    def __init__(self, members, directory, delay):
+        self.delay = delay
+        self.delayed = [] # (due, order, socket, datagram, address)
+        self.order = itertools.count()
+        self.receivers = {}
+        for index in range(members):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(False)
+            member_directory = os.path.join(directory, f"member{index}")
+            os.makedirs(member_directory)
+            self.receivers[sock] = transfer.TransferReceiver(DelayedSocket(sock, self), member_directory)
+        self.completed = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def addresses(self):
+        return [sock.getsockname() for sock in self.receivers]
+
+    def run(self):
+        while not self.stopped:
+            timeout = min(max(self.delayed[0][0] - time.monotonic(), 0), 0.05) if self.delayed else 0.05
+            for sock in select.select(list(self.receivers), [], [], timeout)[0]:
+                self.completed += len(self.receivers[sock].receive())
+            while self.delayed and self.delayed[0][0] <= time.monotonic():
+                _, _, sock, data, address = heapq.heappop(self.delayed)
+                sock.sendto(data, address)
+
+    def wait_for(self, count):
+        while self.completed < count:
+            time.sleep(0.001)
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+        for sock in self.receivers:
+            sock.close()
+
+def run(name, members, source, directory, payload_size, delay):
+    audience = Audience(members, os.path.join(directory, name), delay)
+    addresses = audience.addresses()
+    started = time.monotonic()
+    cpu_started = time.thread_time()
+    if name == "each":
+        for address in addresses:
+            transfer.send_file(address, source, "alice", "video.bin", payload_size)
+    else:
+        stats, errors = transfer.send_file_to_group(addresses, source, "alice", "video.bin", payload_size)
+        assert not errors, errors
+    cpu = time.thread_time() - cpu_started
+    audience.wait_for(members)
+    elapsed = time.monotonic() - started
+    audience.close()
+    return elapsed, cpu
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--members", type=int, default=8)
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--rtt-ms", type=float, default=20)
+    parser.add_argument("--payload-size", type=int, default=None, help="default: largest the path MTU allows")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.bin")
+        with open(source, "wb") as file:
+            file.write(os.urandom(size))
+        for name in ("each", "group"):
+            # Each run hashes the file afresh, as a presenter sending a new file would
+            transfer.manifest_cache.clear()
+            elapsed, cpu = run(name, args.members, source, directory, args.payload_size, args.rtt_ms / 1000)
+            delivered = size * args.members
+            print(f"{name:6} {args.members} members x {size / 1e6:.1f} MB in {elapsed:6.2f} s  "
+                  f"{delivered / 1e6 / elapsed:8.1f} MB/s delivered  sender {cpu:5.2f} CPU s "
+                  f"({cpu / (delivered / 1e9):.2f} per GB delivered)")
+
+if __name__ == "__main__":
+    main()
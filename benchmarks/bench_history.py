@@ -0,0 +1,80 @@
+# Benchmark of reading a page of chat history as the history grows
+# Fills a history store (history.py) with --sizes messages spread over --conversations private
+# conversations, then times /history pages for random conversations: the newest page, and a page
+# further back through its "before" id. "scan" is the same newest page found the way the message
+# logs would have to be read for it: every line of a flat log, keeping the conversation's last ones.
+#
+# Usage: python3 benchmarks/bench_history.py [--sizes 10000,100000,1000000] [--conversations 1000] [--pages 2000]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import history
+
+def fill(directory, size, conversations):
+    store = history.HistoryStore(directory)
+    log_path = os.path.join(directory, "messagelog.txt")
+    with open(log_path, "w") as log:
+        for number in range(size):
+            conversation = random.randrange(conversations)
+            sender = f"user{conversation}"
+            text = f"message {number} " + "x" * random.randrange(10, 100)
+            store.append(history.private_conversation(sender, f"peer{conversation}"), sender, "18 Oct 2026 12:00:00", text)
+            log.write(f"{number + 1}; 18 Oct 2026 12:00:00; {sender}; peer{conversation}; {text}\n")
+    store.close()
+    return store, log_path
+
+def scan(log_path, sender, limit):
+    found = []
+    with open(log_path) as log:
+        for line in log:
+            if line.split("; ", 3)[2] == sender:
+                found.append(line)
+                if len(found) > limit:
+                    found.pop(0)
+    return found
+
+def timed(pages, read):
+    latencies = []
+    for _ in range(pages):
+        started = time.perf_counter()
+        read()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--scan-pages", type=int, default=5, help="pages read by scanning, it is slow")
+    args = parser.parse_args()
+
+    for size in (int(size) for size in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as directory:
+            store, log_path = fill(directory, size, args.conversations)
+            reader = history.HistoryReader(directory)
+
+            def conversation():
+                number = random.randrange(args.conversations)
+                return history.private_conversation(f"user{number}", f"peer{number}")
+
+            def back():
+                # A page from somewhere in the conversation's past
+                return reader.page(conversation(), random.randrange(1, store.next_id))
+
+            newest = timed(args.pages, lambda: reader.page(conversation()))
+            older = timed(args.pages, back)
+            scanned = timed(args.scan_pages, lambda: scan(log_path, f"user{random.randrange(args.conversations)}",
+                                                         history.DEFAULT_PAGE_SIZE))
+            print(f"{size:8} messages  {store.compressed:3} segments compressed  "
+                  f"newest p50 {newest[0]:6.3f} ms p99 {newest[1]:6.3f} ms  "
+                  f"before p50 {older[0]:6.3f} ms p99 {older[1]:6.3f} ms  scan p50 {scanned[0]:8.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+# Load generator for server.py: starts a local server, connects many simulated clients that speak
+# the real protocol, drives one workload and reports throughput and end-to-end latency as JSON
+#
+# Workloads:
+#   login       every client connects and logs in at once (a login storm), latency is connect to "success"
+#   chat        every client sends /msgto to random online clients, latency is send to delivery
+#   group       clients form groups of --group-size and send /groupmsg, latency is send to each delivery
+#   activeuser  every client asks for /activeuser in a loop, latency is request to reply
+#   p2pvideo    pairs of clients look each other up with /p2pvideo and transfer --file-mb over UDP
+#
+# All clients run on one asyncio event loop in this process, so send and receive times share a clock.
+# Chat clients wait --think-ms between messages. The JSON result can be saved with --output and
+# later passed as --baseline to flag throughput or p99 regressions beyond --tolerance.
+#
+# Usage: python3 benchmarks/bench_load.py chat [--clients 1000] [--duration 10]
+#            [--server-args "--mode async --workers 2"] [--output result.json] [--baseline old.json]
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+import transfer
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKLOADS = ("login", "chat", "group", "activeuser", "p2pvideo")
+
+class Recorder:
+    def __init__(self):
+        self.latencies = [] # seconds
+        self.operations = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.operations += 1
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+# One simulated client, replies are matched to requests by request id as in client.py
+class SimClient:
+    def __init__(self, username, password, udp_port, recorder):
+        self.username = username
+        self.password = password
+        self.udp_port = udp_port
+        self.recorder = recorder
+        self.decoder = protocol.FrameDecoder()
+        self.pending = {} # request id -> future waiting for the reply
+        self.request_ids = itertools.count(1)
+        self.reader_task = None
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port, limit=protocol.MAX_FRAME_SIZE)
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        while True:
+            try:
+                data = await self.reader.read(protocol.RECV_SIZE)
+            except ConnectionError:
+                data = b""
+            if not data:
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("server closed the connection"))
+                return
+            for command in self.decoder.feed(data):
+                if command.name in ("msg_recieve", "groupmsg_recieve"):
+                    self.delivered(command.args[0])
+                    continue
+                future = self.pending.pop(command.request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(command)
+
+    # Messages carry the time they were sent, "lg <perf_counter_ns>"
+    def delivered(self, text):
+        content = text.split(": ", 1)[1]
+        if content.startswith("lg "):
+            self.recorder.record((time.perf_counter_ns() - int(content[3:])) / 1e9)
+
+    async def request(self, name, *args):
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(protocol.encode(name, *args, request_id=request_id))
+        return await future
+
+    def send(self, name, *args):
+        self.writer.write(protocol.encode(name, *args))
+
+    async def login(self):
+        reply = await self.request("credentials", self.username, self.password, self.udp_port)
+        if reply.args[0] != "success":
+            raise RuntimeError(f"login of {self.username} failed: {reply.args[0]}")
+        self.send("Log", self.username, self.udp_port)
+
+    async def close(self):
+        self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+def start_server(directory, clients, server_args):
+    with open(os.path.join(directory, "credentials.txt"), "w") as file:
+        for index in range(clients):
+            file.write(f"user{index} password{index}\n")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    command = [sys.executable, os.path.join(REPOSITORY, "server.py"), str(port), "5"] + server_args
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+def stop_server(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(20)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+async def connect_all(port, clients, recorder, concurrency):
+    users = [SimClient(f"user{index}", f"password{index}", 20000 + index, recorder) for index in range(clients)]
+    limit = asyncio.Semaphore(concurrency)
+
+    async def connect(user):
+        async with limit:
+            started = time.perf_counter()
+            await user.connect(port)
+            await user.login()
+            return time.perf_counter() - started
+
+    return users, await asyncio.gather(*(connect(user) for user in users))
+
+async def run_for(duration, users, loop_body):
+    stopping = time.monotonic() + duration
+
+    async def client_loop(user):
+        while time.monotonic() < stopping:
+            await loop_body(user)
+
+    await asyncio.gather(*(client_loop(user) for user in users))
+
+async def workload_login(args, port, recorder):
+    users, latencies = await connect_all(port, args.clients, recorder, args.concurrency)
+    for latency in latencies:
+        recorder.record(latency)
+    return users
+
+async def workload_chat(args, port, recorder):
+    users, _ = await connect_all(port, args.clients, recorder, args.concurrency)
+    think = args.think_ms / 1000
+
+    async def body(user):
+        peer = users[random.randrange(len(users))]
+        if peer is user:
+            return
+        reply = await user.request("/msgto", user.username, peer.username, f"lg {time.perf_counter_ns()}")
+        if reply.name != "msg_sent" or reply.args[0].startswith("Error"):
+            recorder.errors += 1
+        await asyncio.sleep(think * random.uniform(0.5, 1.5))
+
+    await run_for(args.duration, users, body)
+    return users
+
+async def workload_group(args, port, recorder):
+    users, _ = await connect_all(port, args.clients, recorder, args.concurrency)
+    think = args.think_ms / 1000
+    groups = [users[start:start + args.group_size] for start in range(0, len(users), args.group_size)]
+
+    async def form(index, members):
+        reply = await members[0].request("/creategroup", f"g{index}", *(member.username for member in members))
+        if reply.args[0].startswith("Error"):
+            raise RuntimeError(reply.args[0])
+        for member in members[1:]:
+            await member.request("/joingroup", f"g{index}", member.username)
+
+    await asyncio.gather(*(form(index, members) for index, members in enumerate(groups)))
+    group_of = {member.username: f"g{index}" for index, members in enumerate(groups) for member in members}
+
+    # The /groupmsg reply is not waited for, so only the sender's think time paces it
+    async def body(user):
+        user.send("/groupmsg", group_of[user.username], user.username, f"lg {time.perf_counter_ns()}")
+        await asyncio.sleep(think * random.uniform(0.5, 1.5))
+
+    await run_for(args.duration, users, body)
+    # Lets deliveries still in flight arrive
+    await asyncio.sleep(1)
+    return users
+
+async def workload_activeuser(args, port, recorder):
+    users, _ = await connect_all(port, args.clients, recorder, args.concurrency)
+    think = args.think_ms / 1000
+
+    async def body(user):
+        started = time.perf_counter()
+        await user.request("/activeuser")
+        recorder.record(time.perf_counter() - started)
+        await asyncio.sleep(think * random.uniform(0.5, 1.5))
+
+    await run_for(args.duration, users, body)
+    return users
+
+# Each receiving client runs a TransferReceiver on its own UDP port in a thread, as client.py does
+async def workload_p2pvideo(args, port, recorder):
+    pairs = max(1, args.clients // 2)
+    users, _ = await connect_all(port, pairs * 2, recorder, args.concurrency)
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "video.bin")
+    with open(source, "wb") as file:
+        file.write(os.urandom(args.file_mb * 1024 * 1024))
+
+    receivers = []
+    for user in users[1::2]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", user.udp_port))
+        sock.settimeout(0.5)
+        receiver = transfer.TransferReceiver(sock, directory)
+        thread = threading.Thread(target=receive_loop, args=(receiver,), daemon=True)
+        thread.start()
+        receivers.append((sock, receiver, thread))
+
+    loop = asyncio.get_running_loop()
+
+    async def send(presenter, audience):
+        for _ in range(args.transfers):
+            started = time.perf_counter()
+            reply = await presenter.request("/p2pvideo", audience.username, "video.bin", presenter.username)
+            if len(reply.args) != 2:
+                recorder.errors += 1
+                continue
+            try:
+                await loop.run_in_executor(None, transfer.send_file, ("127.0.0.1", reply.args[1]), source,
+                                           presenter.username, "video.bin")
+            except transfer.TransferError:
+                recorder.errors += 1
+                continue
+            recorder.record(time.perf_counter() - started)
+            recorder.bytes += args.file_mb * 1024 * 1024
+
+    await asyncio.gather(*(send(users[index], users[index + 1]) for index in range(0, len(users), 2)))
+    for sock, receiver, thread in receivers:
+        sock.sendto(transfer.stop_packet(), sock.getsockname())
+        thread.join()
+        sock.close()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return users
+
+def receive_loop(receiver):
+    while not receiver.stopped:
+        try:
+            receiver.receive()
+        except socket.timeout:
+            receiver.expire_idle()
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except OSError:
+        return None
+
+def summarize(args, recorder, elapsed):
+    latencies = sorted(recorder.latencies)
+    result = {
+        "workload": args.workload,
+        "clients": args.clients,
+        "server_args": args.server_args,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "elapsed_s": round(elapsed, 3),
+        "operations": recorder.operations,
+        "errors": recorder.errors,
+        "throughput_per_s": round(recorder.operations / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.5) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "p999": round(percentile(latencies, 0.999) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+    if recorder.bytes:
+        result["megabytes_per_s"] = round(recorder.bytes / 1e6 / elapsed, 1)
+    return result
+
+# Differences against an earlier result, a regression is lower throughput or higher p99 beyond the tolerance
+def compare(result, baseline, tolerance):
+    regressions = []
+    old, new = baseline["throughput_per_s"], result["throughput_per_s"]
+    if old and new < old * (1 - tolerance):
+        regressions.append(f"throughput {old} -> {new} per s")
+    old, new = baseline["latency_ms"]["p99"], result["latency_ms"]["p99"]
+    if old and new > old * (1 + tolerance):
+        regressions.append(f"p99 latency {old} -> {new} ms")
+    return regressions
+
+async def run(args, port):
+    recorder = Recorder()
+    workload = globals()[f"workload_{args.workload}"]
+    started = time.perf_counter()
+    users = await workload(args, port, recorder)
+    elapsed = time.perf_counter() - started
+    # The login storm measures the connects themselves, the others only their steady state
+    if args.workload not in ("login", "p2pvideo"):
+        elapsed = args.duration
+    for user in users:
+        await user.close()
+    return recorder, elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workload", choices=WORKLOADS)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of steady load after every client logged in")
+    parser.add_argument("--think-ms", type=float, default=100.0, help="average pause between one client's requests")
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--file-mb", type=int, default=8)
+    parser.add_argument("--transfers", type=int, default=1, help="transfers per pair of clients")
+    parser.add_argument("--concurrency", type=int, default=1000, help="connects and logins in flight at once")
+    parser.add_argument("--server-args", default="", help="options for server.py, such as \"--mode async\"")
+    parser.add_argument("--port", type=int, default=None,
+                        help="use a server already running on this port, its credentials.txt must have userN passwordN")
+    parser.add_argument("--output", default=None, help="also write the JSON result to this file")
+    parser.add_argument("--baseline", default=None, help="earlier JSON result to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+    args.server_args = shlex.split(args.server_args)
+
+    # Thousands of clients need thousands of descriptors, here and in the server it starts
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with tempfile.TemporaryDirectory() as directory:
+        process = None
+        port = args.port
+        if port is None:
+            process, port = start_server(directory, args.clients, args.server_args)
+        try:
+            recorder, elapsed = asyncio.run(run(args, port))
+        finally:
+            if process is not None:
+                stop_server(process)
+
+    result = summarize(args, recorder, elapsed)
+    print(json.dumps(result, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
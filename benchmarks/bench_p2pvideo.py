@@ -0,0 +1,215 @@
+# Loopback benchmark of the /p2pvideo send and receive paths
+# Compares the original path (1024 byte read() and sendto() per datagram, a sleep between
+# datagrams, an EOF marker) with transfer.py (mapped file, MTU sized payloads, acks, recv_into)
+# The resumed run stops a transfer once --resume-at of the file has been acked, then times sending
+# the file again, which only sends the chunks the receiver does not have yet.
+# The stream run plays the file into a pipe through the jitter buffer (playback.py), drops --loss of
+# the payloads at the receiver, and reports when the first byte reached the pipe.
+#
+# Usage: python3 benchmarks/bench_p2pvideo.py [--size-mb 64] [--payload-size BYTES] [--resume-at 0.5]
+#                                             [--jitter-buffer KB] [--loss 0.01]
+import argparse
+import os
+import random
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import playback
+import transfer
+
+# The sender and receiver loops of the original client.py
+def legacy_send(address, path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with open(path, 'rb') as file:
+        sock.sendto(b"/p2pvideo bob video.bin alice", address)
+        data = file.read(1024)
+        while data:
+            sock.sendto(data, address)
+            data = file.read(1024)
+            time.sleep(0.00001)
+        sock.sendto(b"EOF", address)
+    sock.close()
+
+def legacy_receive(sock, path, result):
+    sock.recvfrom(1024)
+    received = 0
+    with open(path, 'ab') as file:
+        while True:
+            try:
+                data, address = sock.recvfrom(1024)
+            except socket.timeout:
+                break # The EOF marker was lost
+            if data == b"EOF":
+                break
+            file.write(data)
+            received += len(data)
+    result["received"] = received
+
+def run_legacy(source, directory):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(5)
+    result = {}
+    receiver = threading.Thread(target=legacy_receive, args=(sock, os.path.join(directory, "legacy.bin"), result))
+    receiver.start()
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    legacy_send(sock.getsockname(), source)
+    receiver.join()
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu_started
+    sock.close()
+    return result["received"], elapsed, cpu, None
+
+# Gives up once a fraction of the file has been acked, like a sender that crashed
+class InterruptedSender(transfer.TransferSender):
+    def __init__(self, sock, address, path, sender, filename, payload_size, fraction):
+        transfer.TransferSender.__init__(self, sock, address, path, sender, filename, payload_size)
+        self.stop_at = int(self.total * fraction)
+
+    def send_window(self):
+        if self.cum >= self.stop_at:
+            raise transfer.TransferError("interrupted")
+        transfer.TransferSender.send_window(self)
+
+def run_engine(source, directory, payload_size, resume_at=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1)
+    receiver = transfer.TransferReceiver(sock, directory)
+    completed = []
+
+    def receive_loop():
+        while not receiver.stopped:
+            try:
+                completed.extend(receiver.receive())
+            except socket.timeout:
+                continue
+
+    thread = threading.Thread(target=receive_loop)
+    thread.start()
+    if resume_at is not None:
+        interrupted = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            InterruptedSender(interrupted, sock.getsockname(), source, "alice", "video.bin", payload_size, resume_at).run()
+        except transfer.TransferError:
+            pass
+        interrupted.close()
+        # Runs on this thread while the receive loop may be reading, good enough once the sender is gone
+        time.sleep(0.2)
+        receiver.expire_idle(0)
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    stats = transfer.send_file(sock.getsockname(), source, "alice", "video.bin", payload_size)
+    while not completed:
+        time.sleep(0.001)
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu_started
+    stop = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stop.sendto(transfer.stop_packet(), sock.getsockname())
+    stop.close()
+    thread.join()
+    sock.close()
+    return completed[0].size, elapsed, cpu, stats
+
+# Loses a fraction of the payloads as they arrive
+class LossyReceiver(transfer.TransferReceiver):
+    def __init__(self, sock, directory, incoming, loss):
+        transfer.TransferReceiver.__init__(self, sock, directory, incoming)
+        self.loss = loss
+
+    def handle_datagram(self, data, address):
+        if data[0] == transfer.DATA and random.random() < self.loss:
+            return None
+        return transfer.TransferReceiver.handle_datagram(self, data, address)
+
+def run_stream(source, directory, payload_size, buffer_size, loss):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.05)
+    read_fd, write_fd = os.pipe()
+    incoming = lambda *args: playback.IncomingStream(*args, sink=playback.FileSink(write_fd), buffer_size=buffer_size)
+    receiver = LossyReceiver(sock, directory, incoming, loss)
+    completed = []
+    played = {"bytes": 0, "first": None}
+
+    # Waits for datagrams and for the pipe at once, like the client's event loop
+    def receive_loop():
+        while not receiver.stopped:
+            sinks = [stream.sink for stream in receiver.blocked.values()]
+            readable, writable, _ = select.select([sock], sinks, [], 0.05)
+            if readable:
+                completed.extend(receiver.receive())
+            if writable:
+                completed.extend(receiver.drain_streams())
+
+    # The player, reads the pipe as fast as it can
+    def play_loop():
+        while True:
+            data = os.read(read_fd, 1 << 20)
+            if not data:
+                break
+            if played["first"] is None:
+                played["first"] = time.monotonic()
+            played["bytes"] += len(data)
+
+    threads = [threading.Thread(target=receive_loop), threading.Thread(target=play_loop)]
+    for thread in threads:
+        thread.start()
+    started = time.monotonic()
+    cpu_started = time.process_time()
+    stats = transfer.send_file(sock.getsockname(), source, "alice", "video.bin", payload_size)
+    while not completed:
+        time.sleep(0.001)
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu_started
+    stop = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stop.sendto(transfer.stop_packet(), sock.getsockname())
+    stop.close()
+    for thread in threads:
+        thread.join()
+    sock.close()
+    os.close(read_fd)
+    return played["bytes"], elapsed, cpu, stats, played["first"] - started, completed[0].stats
+
+def report(name, size, received, elapsed, cpu, stats):
+    line = (f"{name:8} {received / 1e6:8.1f} of {size / 1e6:.1f} MB received  {received / 1e6 / elapsed:8.1f} MB/s  "
+            f"{cpu / (received / 1e9) if received else float('inf'):7.2f} CPU s/GB")
+    if stats is not None:
+        line += f"  {stats.datagrams} datagrams, {stats.retransmits} retransmits"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--payload-size", type=int, default=None, help="default: largest the path MTU allows")
+    parser.add_argument("--resume-at", type=float, default=0.5, help="fraction of the file sent before the interruption")
+    parser.add_argument("--jitter-buffer", type=int, default=playback.DEFAULT_BUFFER_SIZE // 1024, metavar="KB")
+    parser.add_argument("--loss", type=float, default=0.01, help="fraction of payloads the stream run loses")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.bin")
+        with open(source, "wb") as file:
+            file.write(os.urandom(size))
+        # Both CPU figures include the sending and the receiving thread, they share this process
+        report("legacy", size, *run_legacy(source, directory))
+        report("engine", size, *run_engine(source, directory, args.payload_size))
+        report("resumed", size, *run_engine(source, directory, args.payload_size, args.resume_at))
+        # The file runs end when the whole file is on disk, which is also when a player could start
+        played, elapsed, cpu, stats, first_byte, stream_stats = run_stream(
+            source, directory, args.payload_size, args.jitter_buffer * 1024, args.loss)
+        report("stream", size, played, elapsed, cpu, stats)
+        print(f"{'':8} first byte after {first_byte * 1000:.1f} ms, {stream_stats.stalls} stalls "
+              f"({stream_stats.stall_time * 1000:.0f} ms), buffer peak {stream_stats.peak_buffer / 1e6:.2f} MB "
+              f"and mean {stream_stats.buffer_total / max(stream_stats.buffer_samples, 1) / 1e6:.2f} MB "
+              f"of {stream_stats.buffer_size / 1e6:.2f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Benchmark of one connection sending many /msgto messages, waiting for each reply or pipelining them
+#
+# A sender and a receiver log in, then the sender sends --messages messages to the receiver:
+# one at a time  each request waits for its reply before the next is sent, as typed at the prompt
+# pipelined      up to --window requests are in flight, as with client.py --bulk
+# and reports messages per second through the connection (until the last message was delivered)
+# and how many frames the server's writers sent per write, from /stats.
+#
+# Usage: python3 benchmarks/bench_pipeline.py [--messages 20000] [--window 512] [--server-args "--mode async"]
+import argparse
+import asyncio
+import collections
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import client
+import protocol
+from bench_load import start_server, stop_server
+
+# The client's own connection, so its write coalescing is measured too
+class Client:
+    def __init__(self, username, password, udp_port):
+        self.username = username
+        self.password = password
+        self.udp_port = udp_port
+        self.received = 0
+        self.expected = 0
+        self.all_received = None
+
+    async def connect(self, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=protocol.MAX_FRAME_SIZE)
+        self.connection = client.ServerConnection(reader, writer)
+        self.connection.handlers = {"msg_recieve": self.delivered}
+        self.reader_task = asyncio.create_task(self.connection.read_loop())
+
+    async def login(self):
+        reply = await self.connection.request("credentials", self.username, self.password, self.udp_port)
+        if reply.args[0] != "success":
+            raise RuntimeError(f"login of {self.username} failed: {reply.args[0]}")
+        self.connection.send("Log", self.username, self.udp_port)
+
+    def delivered(self, command):
+        self.received += 1
+        if self.received == self.expected:
+            self.all_received.set_result(None)
+
+    def expect(self, count):
+        self.received = 0
+        self.expected = count
+        self.all_received = asyncio.get_running_loop().create_future()
+
+    async def close(self):
+        self.connection.close()
+        self.reader_task.cancel()
+
+async def one_at_a_time(sender, receiver, messages):
+    for number in range(messages):
+        await sender.connection.request("/msgto", sender.username, receiver.username, f"message {number}")
+
+async def pipelined(sender, receiver, messages, window):
+    in_flight = collections.deque()
+    for number in range(messages):
+        if len(in_flight) >= window:
+            await in_flight.popleft()
+        in_flight.append(sender.connection.submit("/msgto", sender.username, receiver.username, f"message {number}"))
+    for future in in_flight:
+        await future
+
+async def run(args, port):
+    sender = Client("user0", "password0", 20000)
+    receiver = Client("user1", "password1", 20001)
+    for user in (sender, receiver):
+        await user.connect(port)
+        await user.login()
+
+    results = []
+    for name in ("one at a time", "pipelined"):
+        messages = args.messages if name == "pipelined" else args.messages // args.slow_fraction
+        before = json.loads((await sender.connection.request("/stats")).args[0])["gauges"]["outbound"]
+        receiver.expect(messages)
+        started = time.perf_counter()
+        if name == "pipelined":
+            await pipelined(sender, receiver, messages, args.window)
+        else:
+            await one_at_a_time(sender, receiver, messages)
+        await receiver.all_received
+        elapsed = time.perf_counter() - started
+        after = json.loads((await sender.connection.request("/stats")).args[0])["gauges"]["outbound"]
+        frames = after["frames"] - before["frames"]
+        writes = after.get("writes", 0) - before.get("writes", 0)
+        results.append((name, messages, elapsed, frames / writes if writes else None))
+    for user in (sender, receiver):
+        await user.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--window", type=int, default=512, help="requests in flight when pipelining")
+    parser.add_argument("--slow-fraction", type=int, default=4, help="one at a time sends --messages divided by this")
+    parser.add_argument("--server-args", default="", help='options for server.py, for example "--mode async"')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        process, port = start_server(directory, 2, shlex.split(args.server_args) + ["--log-level", "off"])
+        try:
+            results = asyncio.run(run(args, port))
+        finally:
+            stop_server(process)
+    for name, messages, elapsed, per_write in results:
+        coalesced = f"{per_write:6.1f} frames per server write" if per_write is not None else ""
+        print(f"{name:13}  {messages:6} messages  {elapsed:6.2f} s  {messages / elapsed:9.0f} messages/s  {coalesced}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Login/logout churn benchmark for the presence registry
+# Logs in --users users, then repeatedly logs one out and back in. The legacy path is the
+# original server code: a dict of lists, an append to userlog.txt that first counts its lines,
+# and a full rewrite of userlog.txt on every logout. The registry path is presence.py with its
+# snapshot thread, also driven from several threads at once.
+# It then times building an /activeuser reply: the original code formats a line for every user,
+# the registry hands out one page of its cached lines.
+#
+# Usage: python3 benchmarks/bench_presence.py [--users 10000] [--cycles 300] [--threads 4]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from presence import PresenceRegistry, UserlogSnapshot
+
+TIMESTAMP = "18 Oct 2026 12:00:00"
+
+def legacy_login(connected_clients, path, username, port):
+    connected_clients[username] = [None, TIMESTAMP, "127.0.0.1", port]
+    if os.path.isfile(path):
+        with open(path, 'r') as file:
+            active_user = len(file.readlines())
+        active_user += 1
+    else:
+        active_user = 1
+    with open(path, 'a') as file:
+        file.write(f"{active_user}; {TIMESTAMP}; {username}; 127.0.0.1; {port}\n")
+
+def legacy_logout(connected_clients, path, username):
+    with open(path, "r") as infile:
+        lines = infile.readlines()
+    with open(path, "w") as outfile:
+        serial_number_offset = 0
+        for line in lines:
+            parts = line.strip().split('; ')
+            if len(parts) >= 3 and parts[2] == username:
+                serial_number_offset = -1
+            else:
+                parts[0] = str(int(parts[0]) + serial_number_offset)
+                outfile.write('; '.join(parts) + '\n')
+    if username in connected_clients:
+        del connected_clients[username]
+
+def run_legacy(directory, users, cycles):
+    path = os.path.join(directory, "legacy_userlog.txt")
+    connected_clients = {}
+    for index in range(users):
+        legacy_login(connected_clients, path, f"user{index}", 10000 + index)
+    started = time.perf_counter()
+    for _ in range(cycles):
+        index = random.randrange(users)
+        legacy_logout(connected_clients, path, f"user{index}")
+        legacy_login(connected_clients, path, f"user{index}", 10000 + index)
+    return time.perf_counter() - started
+
+def run_registry(directory, users, cycles, threads):
+    registry = PresenceRegistry()
+    snapshot = UserlogSnapshot(registry, os.path.join(directory, "userlog.txt"), interval=0.1)
+    for index in range(users):
+        registry.login(f"user{index}", None, TIMESTAMP, "127.0.0.1", 10000 + index)
+
+    def churn(count):
+        for _ in range(count):
+            index = random.randrange(users)
+            registry.logout(f"user{index}")
+            registry.login(f"user{index}", None, TIMESTAMP, "127.0.0.1", 10000 + index)
+
+    workers = [threading.Thread(target=churn, args=(cycles // threads,)) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    snapshot.close()
+    snapshot.write()
+    with open(os.path.join(directory, "userlog.txt")) as file:
+        assert len(file.readlines()) == len(registry) == users
+    return elapsed, snapshot.writes
+
+def run_activeuser(users, requests, page_size):
+    registry = PresenceRegistry()
+    for index in range(users):
+        registry.login(f"user{index}", None, TIMESTAMP, "127.0.0.1", 10000 + index)
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        lines = []
+        for user in registry.snapshot():
+            if user.username != "user0":
+                lines.append(f"{user.username}; {user.ip_address}; {user.udp_port}; active since {user.timestamp}.")
+        "\n".join(lines)
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for request in range(requests):
+        lines, others = registry.page(request % (users // page_size) * page_size, page_size, exclude="user0")
+        "\n".join(lines)
+    return legacy, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--cycles", type=int, default=300, help="logout and login pairs for the legacy path")
+    parser.add_argument("--registry-cycles", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200, help="/activeuser replies to build")
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        elapsed = run_legacy(directory, args.users, args.cycles)
+        print(f"legacy    {args.cycles} cycles at {args.users} users: {elapsed:.2f} s, "
+              f"{args.cycles / elapsed:,.0f} cycles/s, {elapsed / args.cycles * 1e6:,.1f} us per cycle")
+        elapsed, writes = run_registry(directory, args.users, args.registry_cycles, args.threads)
+        print(f"registry  {args.registry_cycles} cycles at {args.users} users on {args.threads} threads: {elapsed:.2f} s, "
+              f"{args.registry_cycles / elapsed:,.0f} cycles/s, {elapsed / args.registry_cycles * 1e6:,.1f} us per cycle, "
+              f"{writes} userlog snapshots")
+    legacy, paged = run_activeuser(args.users, args.requests, args.page_size)
+    print(f"activeuser at {args.users} users: full reply {legacy / args.requests * 1e6:,.1f} us, "
+          f"page of {args.page_size} {paged / args.requests * 1e6:,.1f} us")
+
+if __name__ == "__main__":
+    main()
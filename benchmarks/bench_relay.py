@@ -0,0 +1,118 @@
+# Loopback benchmark of the server relay (relay.py) and what it does to chat latency
+# Starts a server with --relay for each run, keeps --clients chat clients sending /msgto to each
+# other, and in every run but the first has --transfers presenters send a file to their audience
+# through a relay over and over. Reports chat latency (send to delivery) and what the relays moved.
+#   chat       no transfers, the baseline
+#   unlimited  --relay-rate 0 --relay-budget 0
+#   limited    the default --relay-rate and --relay-budget, or the ones given here
+#
+# Usage: python3 benchmarks/bench_relay.py [--clients 200] [--transfers 4] [--duration 10]
+#                                          [--relay-rate BYTES] [--relay-budget BYTES]
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import relay
+import transfer
+from bench_load import Recorder, SimClient, percentile, receive_loop, start_server, stop_server
+
+async def run(args, port, directory, transfers):
+    recorder = Recorder()
+    users = [SimClient(f"user{index}", f"password{index}", 20000 + index, recorder)
+             for index in range(args.clients + 2 * transfers)]
+    for user in users:
+        await user.connect(port)
+        await user.login()
+    chatters, pairs = users[:args.clients], users[args.clients:]
+
+    receivers = []
+    for audience in pairs[1::2]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", audience.udp_port))
+        sock.settimeout(0.5)
+        receiver = transfer.TransferReceiver(sock, directory)
+        thread = threading.Thread(target=receive_loop, args=(receiver,), daemon=True)
+        thread.start()
+        receivers.append((sock, thread))
+
+    source = os.path.join(directory, "video.bin")
+    stopping = time.monotonic() + args.duration
+    relayed = {"bytes": 0, "errors": 0}
+    loop = asyncio.get_running_loop()
+
+    async def chat(user):
+        while time.monotonic() < stopping:
+            peer = chatters[random.randrange(len(chatters))]
+            if peer is not user:
+                await user.request("/msgto", user.username, peer.username, f"lg {time.perf_counter_ns()}")
+            await asyncio.sleep(args.think_ms / 1000 * random.uniform(0.5, 1.5))
+
+    # Each presenter opens one relay and sends its files through it one after the other
+    async def present(presenter, audience):
+        reply = await presenter.request("/relay", audience.username, "video.bin", presenter.username)
+        if len(reply.args) != 2:
+            raise RuntimeError(reply.args[0])
+        for number in itertools.count():
+            if time.monotonic() >= stopping:
+                return
+            try:
+                stats = await loop.run_in_executor(None, transfer.send_file, ("127.0.0.1", reply.args[1]), source,
+                                                   presenter.username, f"video{number}.bin")
+            except transfer.TransferError:
+                relayed["errors"] += 1
+                continue
+            relayed["bytes"] += stats.size
+
+    started = time.monotonic()
+    await asyncio.gather(*(chat(user) for user in chatters),
+                         *(present(pairs[index], pairs[index + 1]) for index in range(0, len(pairs), 2)))
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(0.5) # Deliveries still in flight
+    for sock, thread in receivers:
+        sock.sendto(transfer.stop_packet(), sock.getsockname())
+        thread.join()
+        sock.close()
+    for user in users:
+        await user.close()
+    return recorder, relayed, elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=200, help="chat clients")
+    parser.add_argument("--transfers", type=int, default=4, help="files relayed at once")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--think-ms", type=float, default=50.0, help="average pause between one client's messages")
+    parser.add_argument("--file-mb", type=int, default=16)
+    parser.add_argument("--relay-rate", type=int, default=relay.DEFAULT_RATE)
+    parser.add_argument("--relay-budget", type=int, default=relay.DEFAULT_BUDGET)
+    args = parser.parse_args()
+
+    runs = [
+        ("chat", 0, []),
+        ("unlimited", args.transfers, ["--relay-rate", "0", "--relay-budget", "0"]),
+        ("limited", args.transfers, ["--relay-rate", str(args.relay_rate), "--relay-budget", str(args.relay_budget)]),
+    ]
+    for name, transfers, relay_args in runs:
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "video.bin"), "wb") as file:
+                file.write(os.urandom(args.file_mb * 1024 * 1024))
+            process, port = start_server(directory, args.clients + 2 * transfers, ["--relay"] + relay_args)
+            try:
+                recorder, relayed, elapsed = asyncio.run(run(args, port, directory, transfers))
+            finally:
+                stop_server(process)
+        latencies = sorted(recorder.latencies)
+        print(f"{name:10} chat {len(latencies) / elapsed:7.0f} msg/s  p50 {percentile(latencies, 0.5) * 1000:6.2f} ms  "
+              f"p99 {percentile(latencies, 0.99) * 1000:7.2f} ms  max {latencies[-1] * 1000 if latencies else 0:7.2f} ms  "
+              f"relayed {relayed['bytes'] / 1e6 / elapsed:7.1f} MB/s  {relayed['errors']} failed transfers")
+
+if __name__ == "__main__":
+    main()
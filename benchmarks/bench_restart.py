@@ -0,0 +1,69 @@
+# Benchmark of how long the server takes to come back with its state (state.py) as the state grows
+# For each of --sizes sessions, fills a state directory with that many login sessions, one group per
+# --group-size of them with every member joined, and a blocked account per hundred, then times:
+# snapshot  loading it after a clean shutdown, when everything is in the snapshot
+# journal   loading it after a crash, when every change is still in the journal
+# server    starting server.py on the crashed directory until it accepts connections
+#
+# Usage: python3 benchmarks/bench_restart.py [--sizes 1000,10000,100000] [--group-size 10]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import state
+from bench_load import start_server, stop_server
+
+def fill(directory, size, group_size):
+    store = state.StateStore(directory, interval=3600)
+    now = int(time.time())
+    for number in range(size):
+        store.record("@session", f"user{number}", state.new_token(), "18 Oct 2026 12:00:00", "127.0.0.1", str(20000 + number % 40000))
+        if number % 100 == 0:
+            store.record("@blocked", f"blocked{number}", now + 3600)
+    for first in range(0, size, group_size):
+        members = [f"user{number}" for number in range(first, min(first + group_size, size))]
+        store.record("@group", f"group{first}", *members)
+        for member in members[1:]:
+            store.record("@join", f"group{first}", member)
+    return store
+
+def load(directory):
+    store = state.StateStore(directory, interval=3600)
+    store.close()
+    return store.load_ms, store.loaded_records, store.replayed_records
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000", help="sessions, comma separated")
+    parser.add_argument("--group-size", type=int, default=10)
+    args = parser.parse_args()
+
+    # Every change stays in the journal until the store is closed, as after a crash
+    state.SNAPSHOT_RECORDS = float("inf")
+    for size in (int(size) for size in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as directory:
+            crashed = os.path.join(directory, "crashed", "state")
+            store = fill(crashed, size, args.group_size)
+            while not store.queue.empty():
+                time.sleep(0.01)
+            time.sleep(0.1) # The last batch is written
+            clean, journal, server = (os.path.join(directory, name, "state") for name in ("clean", "journal", "server"))
+            for copy in (clean, journal, server):
+                shutil.copytree(crashed, copy)
+            state.StateStore(clean, interval=3600).close() # A clean shutdown leaves only the snapshot
+
+            snapshot_ms, records, _ = load(clean)
+            journal_ms, _, replayed = load(journal)
+            started = time.perf_counter()
+            process, port = start_server(os.path.dirname(server), 1, ["--log-level", "off"])
+            server_ms = (time.perf_counter() - started) * 1000
+            stop_server(process)
+            print(f"{size:7} sessions  {records:8} records  snapshot {snapshot_ms:8.1f} ms  "
+                  f"journal ({replayed} records) {journal_ms:8.1f} ms  server accepting after {server_ms:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+# Shares presence, groups, the message logs and the history between the worker processes of a multi-core server
+#
+# With --workers N, server.py runs as a supervisor that owns the broker, the log writer, the history store
+# and userlog.txt, and starts N worker processes which all accept clients on the same port through SO_REUSEPORT.
+# Each worker keeps a replica of the presence registry and of the groups: reads go to the replica,
+# changes go to the broker over a Unix socket. The broker applies changes in one order and sends
+# them on to every worker, so all replicas see the same sequence of changes.
+#
+# A user logged in on another worker shows up in the replica with a RemoteSocket, whose sendall()
+# asks the broker to route the frame to that user's worker. Handlers therefore deliver /msgto and
+# /groupmsg the same way whichever worker the recipient is on. A frame for many users, such as a
+# group message, goes to the broker once with every remote recipient, and the broker sends it on
+# once per worker with that worker's recipients.
+#
+# Failed logins are counted by the broker, which blocks the account for every worker once the
+# count is reached, so N workers do not allow N times the attempts.
+#
+# The supervisor also owns the state kept across restarts (state.py). Workers send it their logins,
+# logouts, failed logins and dropped connections, and ask it for the session a reconnecting client wants to resume.
+#
+# Every link, in both directions, is written through an OutboundQueue that spills rather than drops,
+# and each batch taken from it goes out in one vectored write.
+import itertools
+import os
+import socket
+import threading
+import traceback
+import weakref
+from concurrent.futures import Future
+
+import protocol
+from history import HistoryReader
+from outbound import OutboundQueue, send_frames
+from presence import PresenceRegistry
+
+# Stands in for the connection of a user logged in on another worker
+class RemoteSocket:
+    __slots__ = ("link", "username")
+
+    def __init__(self, link, username):
+        self.link = link
+        self.username = username
+
+    def sendall(self, frame):
+        self.link.send("@route", frame, self.username)
+
+# One framed, bidirectional connection over a Unix socket, written from its own thread
+class Link:
+    def __init__(self, sock, name):
+        self.sock = sock
+        self.outbound = OutboundQueue(name, policy="spill")
+        self.writer = threading.Thread(target=self.write_loop, name=f"{name} writer", daemon=True)
+        self.writer.start()
+
+    def send(self, name, *args):
+        self.outbound.sendall(protocol.encode(name, *args))
+
+    def send_frame(self, frame):
+        self.outbound.sendall(frame)
+
+    def write_loop(self):
+        while True:
+            frames = self.outbound.take(block=True)
+            if frames is None:
+                return
+            try:
+                send_frames(self.sock, frames)
+            except OSError:
+                self.outbound.close(discard=True)
+                return
+
+    # Yields lists of commands until the other side closes the connection
+    def read_batches(self):
+        decoder = protocol.FrameDecoder()
+        while True:
+            try:
+                data = self.sock.recv(protocol.RECV_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+            yield decoder.feed(data)
+
+    def close(self):
+        self.outbound.close()
+        self.writer.join(1)
+        self.sock.close()
+
+# Worker side of the broker connection
+class BrokerLink(Link):
+    def __init__(self, path, worker_id):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        Link.__init__(self, sock, f"broker link {worker_id}")
+        self.worker_id = worker_id
+        self.handlers = {} # Command name -> function(command) for changes sent by the broker
+        self.schedule = None # If set, runs handle(commands) elsewhere, such as on an event loop
+        self.on_lost = None # Called if the broker goes away
+        self.requests = {} # Request id -> Future waiting for its @reply
+        self.request_ids = itertools.count(1)
+        self.send("@hello", worker_id)
+        self.reader = threading.Thread(target=self.read_loop, name="broker link reader", daemon=True)
+
+    # Call once the handlers are in place, the broker starts with a copy of the current state
+    def start(self):
+        self.reader.start()
+
+    # Returns a Future for the result field of the broker's @reply, a tuple if it has more than one
+    def request(self, name, *args):
+        request_id = next(self.request_ids)
+        future = Future()
+        self.requests[request_id] = future
+        self.send(name, request_id, *args)
+        return future
+
+    def read_loop(self):
+        for commands in self.read_batches():
+            if self.schedule is not None:
+                self.schedule(self.handle, commands)
+            else:
+                self.handle(commands)
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def handle(self, commands):
+        for command in commands:
+            if command.name == "@reply":
+                result = command.args[1] if len(command.args) == 2 else command.args[1:]
+                self.requests.pop(command.args[0]).set_result(result)
+            else:
+                self.handlers[command.name](command)
+
+# Worker side message log, records are written by the supervisor's LogWriter so numbering stays in one place
+class RemoteLogWriter:
+    def __init__(self, link):
+        self.link = link
+
+    def append(self, path, fields, numbered=True):
+        self.link.send("@log", path, int(numbered), *fields)
+
+# A worker reads history from the files, and sends what it adds to the supervisor's history store
+class RemoteHistory(HistoryReader):
+    def __init__(self, link, directory):
+        HistoryReader.__init__(self, directory)
+        self.link = link
+
+    def append(self, conversation, sender, timestamp, text, pending_for=None):
+        self.link.send("@history", conversation, sender, timestamp, text, pending_for or "")
+
+    def clear_pending(self, username, count):
+        self.link.send("@delivered", username, count)
+
+# A worker's presence registry: local logins and logouts are applied at once and sent to the broker,
+# changes from the broker are applied with the apply_ methods
+class ReplicatedPresence(PresenceRegistry):
+    def __init__(self, link):
+        PresenceRegistry.__init__(self)
+        self.link = link
+        self.connections = weakref.WeakValueDictionary() # token -> this worker's connection
+
+    # Names a connection across processes
+    def token(self, client_socket):
+        token = f"{self.link.worker_id}:{id(client_socket)}"
+        self.connections[token] = client_socket
+        return token
+
+    def login(self, username, client_socket, timestamp, ip_address, udp_port):
+        record = PresenceRegistry.login(self, username, client_socket, timestamp, ip_address, udp_port)
+        self.link.send("@login", username, self.token(client_socket), timestamp, ip_address, udp_port)
+        return record
+
+    def logout(self, username, client_socket=None):
+        record = PresenceRegistry.logout(self, username, client_socket)
+        if record is not None:
+            token = "" if client_socket is None else self.token(client_socket)
+            self.link.send("@logout", username, token)
+        return record
+
+    def set_udp_port(self, username, client_socket, udp_port):
+        if not PresenceRegistry.set_udp_port(self, username, client_socket, udp_port):
+            return False
+        self.link.send("@udpport", username, self.token(client_socket), udp_port)
+        return True
+
+    def apply_login(self, username, token, timestamp, ip_address, udp_port):
+        client_socket = self.connections.get(token)
+        if client_socket is None:
+            client_socket = RemoteSocket(self.link, username)
+        PresenceRegistry.login(self, username, client_socket, timestamp, ip_address, udp_port)
+
+    def apply_logout(self, username):
+        PresenceRegistry.logout(self, username)
+
+    def apply_udp_port(self, username, udp_port):
+        with self.lock:
+            record = self.users.get(username)
+            if record is not None:
+                self.update_udp_port(record, udp_port)
+
+    # Users on this worker get the frame now, the others in one @route however many there are
+    def send_to(self, usernames, frame):
+        remote = []
+        for username in usernames:
+            record = self.users.get(username)
+            if record is None:
+                continue
+            if isinstance(record.client_socket, RemoteSocket):
+                remote.append(username)
+            else:
+                record.client_socket.sendall(frame)
+        if remote:
+            self.link.send("@route", frame, *remote)
+
+    # A frame routed here by the broker for some of this worker's users
+    def deliver(self, frame, *usernames):
+        for username in usernames:
+            record = self.get(username)
+            if record is not None and not isinstance(record.client_socket, RemoteSocket):
+                record.client_socket.sendall(frame)
+
+# Supervisor side: the authoritative presence registry and groups, and a link per worker
+# Presence records hold the owning connection's token instead of a socket
+class Broker:
+    def __init__(self, path, presence, groups, log_writer, history, state, credentials):
+        self.path = path
+        self.presence = presence
+        self.groups = groups
+        self.log_writer = log_writer
+        self.history = history
+        self.state = state
+        self.credentials = credentials # Counts every worker's failed logins
+        self.credentials.journal = self.blocked
+        self.lock = threading.Lock() # Changes are applied and sent on in one order
+        self.links = {} # worker id -> Link
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.thread = threading.Thread(target=self.accept_loop, name="broker", daemon=True)
+        self.thread.start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        link = Link(sock, "worker link")
+        worker_id = None
+        for commands in link.read_batches():
+            for command in commands:
+                if command.name == "@hello":
+                    worker_id = command.args[0]
+                    link.outbound.name = f"worker link {worker_id}"
+                    self.add_worker(worker_id, link)
+                else:
+                    self.dispatch(worker_id, link, command)
+        if worker_id is not None:
+            self.remove_worker(worker_id)
+        link.close()
+
+    # A change that fails is skipped rather than dropping the worker's link, and a request that fails
+    # is answered, so the worker waiting on it goes on
+    def dispatch(self, worker_id, link, command):
+        try:
+            self.handlers[command.name](self, worker_id, link, command)
+        except Exception:
+            traceback.print_exc()
+            if command.name in self.failed_replies and command.args:
+                link.send("@reply", command.args[0], self.failed_replies[command.name])
+
+    # Sends the current state to a new worker, then includes it in every later change
+    def add_worker(self, worker_id, link):
+        with self.lock:
+            for record in self.presence.snapshot():
+                link.send("@login", record.username, record.client_socket, record.timestamp,
+                          record.ip_address, record.udp_port)
+            for group in self.groups.snapshot():
+                with group.lock:
+                    members, joined = list(group.members), list(group.joined - {group.creator})
+                link.send("@group", group.name, group.creator, *members)
+                for username in joined:
+                    link.send("@join", group.name, username)
+            for username, until in self.state.blocked_list():
+                link.send("@block", username, until)
+            self.links[worker_id] = link
+
+    # Users of a worker that exited are no longer logged in, their sessions can be resumed on another worker
+    def remove_worker(self, worker_id):
+        prefix = f"{worker_id}:"
+        with self.lock:
+            self.links.pop(worker_id, None)
+            for record in self.presence.snapshot():
+                if record.client_socket.startswith(prefix):
+                    self.presence.logout(record.username)
+                    self.broadcast("@logout", record.username)
+                    self.state.detach(record.username)
+
+    # Call with the lock held, the frame is encoded once for every worker
+    def broadcast(self, name, *args, skip=None):
+        frame = protocol.encode(name, *args)
+        for worker_id, link in self.links.items():
+            if worker_id != skip:
+                link.send_frame(frame)
+
+    def handle_login(self, worker_id, link, command):
+        username, token, timestamp, ip_address, udp_port = command.args
+        with self.lock:
+            self.presence.login(username, token, timestamp, ip_address, udp_port)
+            self.broadcast("@login", username, token, timestamp, ip_address, udp_port)
+
+    # An empty token logs the user out whichever connection owns the session
+    def handle_logout(self, worker_id, link, command):
+        username, token = command.args
+        with self.lock:
+            record = self.presence.get(username)
+            if record is None or (token and record.client_socket != token):
+                return
+            self.presence.logout(username)
+            self.broadcast("@logout", username)
+
+    def handle_udp_port(self, worker_id, link, command):
+        username, token, udp_port = command.args
+        with self.lock:
+            record = self.presence.get(username)
+            if record is None or record.client_socket != token:
+                return
+            # The registry checks the connection by identity, the token decoded from the frame is another string
+            self.presence.set_udp_port(username, record.client_socket, udp_port)
+            self.broadcast("@udpport", username, udp_port)
+
+    # The credential store blocked an account, every worker turns it away from now on
+    def blocked(self, name, username, until):
+        self.state.record(name, username, until)
+        with self.lock:
+            self.broadcast("@block", username, until)
+
+    # Replies "locked" once the attempt blocks the account. The @block reaches the worker before the reply.
+    def handle_failure(self, worker_id, link, command):
+        request_id, username = command.args
+        link.send("@reply", request_id, "locked" if self.credentials.record_failure(username) else "")
+
+    def handle_success(self, worker_id, link, command):
+        self.credentials.record_success(command.args[0])
+
+    # Group names are only unique if one place decides, so creating a group waits for the broker
+    def handle_create_group(self, worker_id, link, command):
+        request_id, group_name = command.args[:2]
+        group_members = list(command.args[2:])
+        if not group_members:
+            link.send("@reply", request_id, "A group needs at least one member.")
+            return
+        with self.lock:
+            if self.groups.create(group_name, group_members) is None:
+                link.send("@reply", request_id, "Group name already exists.")
+                return
+            self.broadcast("@group", group_name, group_members[0], *group_members)
+            link.send("@reply", request_id, "")
+
+    def handle_join(self, worker_id, link, command):
+        group_name, username = command.args
+        with self.lock:
+            if group_name not in self.groups or not self.groups.join(group_name, username):
+                return
+            self.broadcast("@join", group_name, username, skip=worker_id)
+
+    # Sends the frame on once to each worker with users among the recipients
+    def handle_route(self, worker_id, link, command):
+        frame, *usernames = command.args
+        targets = {} # worker id -> its users among the recipients
+        for username in usernames:
+            record = self.presence.get(username)
+            if record is not None:
+                targets.setdefault(int(record.client_socket.split(":", 1)[0]), []).append(username)
+        for target_id, recipients in targets.items():
+            target = self.links.get(target_id)
+            if target is not None:
+                target.send("@deliver", frame, *recipients)
+
+    def handle_log(self, worker_id, link, command):
+        path, numbered = command.args[:2]
+        self.log_writer.append(path, command.args[2:], numbered=bool(numbered))
+
+    def handle_history(self, worker_id, link, command):
+        conversation, sender, timestamp, text, pending_for = command.args
+        self.history.append(conversation, sender, timestamp, text, pending_for or None)
+
+    def handle_delivered(self, worker_id, link, command):
+        self.history.clear_pending(*command.args)
+
+    # @session and @endsession only go to the journal
+    def handle_session(self, worker_id, link, command):
+        self.state.record(command.name, *command.args)
+
+    def handle_detach(self, worker_id, link, command):
+        self.state.detach(*command.args)
+
+    def handle_resume(self, worker_id, link, command):
+        request_id, token = command.args
+        session = self.state.resume(token)
+        if session is None:
+            link.send("@reply", request_id, "")
+        else:
+            link.send("@reply", request_id, session.username, session.timestamp)
+
+    # What a request that failed is answered with, the same as for a request that was turned down
+    failed_replies = {
+        "@creategroup": "The request failed.",
+        "@resume": "",
+        "@failure": "",
+    }
+
+    handlers = {
+        "@login": handle_login,
+        "@logout": handle_logout,
+        "@udpport": handle_udp_port,
+        "@failure": handle_failure,
+        "@success": handle_success,
+        "@creategroup": handle_create_group,
+        "@join": handle_join,
+        "@route": handle_route,
+        "@log": handle_log,
+        "@history": handle_history,
+        "@delivered": handle_delivered,
+        "@session": handle_session,
+        "@endsession": handle_session,
+        "@detach": handle_detach,
+        "@resume": handle_resume,
+    }
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
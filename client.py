@@ -1,219 +1,645 @@
-# The following code can be run using Python3 
-from socket import *
+# The following code can be run using Python3
+#
+# The client runs on one asyncio event loop. Every request to the server carries a request id and
+# waits on a future that the TCP reader resolves when the reply with the same id arrives, so a reply
+# is never missed or mistaken for another. Frames the server pushes (messages, presence) go to
+# handlers instead. UDP files are received on the event loop as datagrams arrive, and files are sent
+# from worker threads, so several transfers can run while chat commands keep working.
+# With --play, files are played as they arrive instead of being saved, see playback.py.
+# A /p2pvideo file whose audience does not answer is sent through a relay on the server instead,
+# see relay.py, unless --relay says otherwise.
+# Unless --compression none, the client offers compression at login (see protocol.Compressor) and
+# sends /p2pvideo payloads deflated to receivers that accept them (see transfer.PayloadCompressor).
+# If the connection drops, or the server restarts, the client reconnects and resumes its session
+# with the token it got at login, see ServerConnection.resume().
+# Frames written during one pass of the event loop go to the server in one write. With --bulk the
+# commands in a file, or stdin, are sent without waiting for each reply, see bulk().
+import argparse
+import asyncio
+import collections
+import itertools
 import sys
 import threading
 import time
-import signal
-
-client_port_number = {}
-
-# Function to receive tcp messages from the server 
-# and print them to the client's terminal
-# This is the function started by receive_tcp_thread
-def receive_tcp_messages(client_tcp_socket, client_username, server_host):
-    while True:
-        try:
-            data = client_tcp_socket.recv(1024)
-            received_message = data.decode()
+from socket import *
 
-            # We add the udp port number to the client_port_number dictionary whenever a client calls /p2pvideo
-            if received_message.split(" ")[0] == 'p2pvideo' and len(received_message.split(" ")) == 3:
-                client_port_number[received_message.split(" ")[1]] = received_message.split(" ")[2]
-            else:
-                print(" ".join(received_message.split()[1:]))
-                # Prompt needs to be added because the normal functionality doesnt allow for the prompt to be printed when messages are received
-                if received_message.split(" ")[0] == 'msg_recieve' or received_message.split(" ")[0] == 'groupmsg_recieve':
-                    print("\nEnter one of the following commands (/msgto, /activeuser, /creategroup, /joingroup, /groupmsg, /p2pvideo, /logout):")      
-        except:
-            break
-
-# Function to receive udp messages from other clients
-# and print them to the client's terminal
-# This is the function started by receive_udp_thread
-def receive_udp_messages(client_udp_socket, client_username, server_host):
-    while True:
+import playback
+import protocol
+import transfer
+
+PROMPT = "Enter one of the following commands (/msgto, /activeuser, /creategroup, /joingroup, /groupmsg, /p2pvideo, /groupvideo, /history, /logout):"
+REPLY_TIMEOUT = 30 # Seconds to wait for the reply to a request
+EXPIRE_INTERVAL = 1 # Seconds between checks for incoming files whose sender went away
+HEARTBEAT_INTERVAL = 15 # Seconds without a request before a heartbeat is sent, the server's --idle-timeout is at least twice this
+DIRECT_HANDSHAKE_TIMEOUTS = 3 # Unanswered handshakes before --relay auto tries the server relay
+RESUME_TIMEOUT = 60 # Seconds to keep trying to reconnect after the connection drops
+RESUME_RETRY_INTERVAL = 1 # Seconds between attempts to reconnect
+MAX_ACTIVEUSER_PAGE_SIZE = 1000 # Largest page size the server accepts for /activeuser
+BULK_WINDOW = 256 # Requests --bulk has in flight unless --window says otherwise
+BULK_READ_LINES = 1000 # Lines --bulk reads from its file at once
+
+# Reads a line from the terminal without holding up the event loop
+# input() blocks, so it runs on a daemon thread that never keeps the client from exiting
+async def read_input(prompt=""):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    def read():
         try:
-            data, sender_address = client_udp_socket.recvfrom(1024)
-            received_message = data.decode()
-
-            if received_message.split(" ")[0] == '/logout':
+            line = input(prompt)
+        except EOFError as error:
+            loop.call_soon_threadsafe(settle, future.set_exception, error)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, line)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+# The TCP connection to the server
+class ServerConnection:
+    def __init__(self, reader, writer, address=None):
+        self.address = address # (host, port) to reconnect to
+        self.request_ids = itertools.count(1)
+        self.pending = {} # request id -> future waiting for the reply
+        self.handlers = {} # command name -> function for frames the server pushes
+        self.last_sent = time.monotonic()
+        self.compression = "zlib" # Offered at login, and used for files sent, unless --compression none
+        self.session_token = None # From the login reply, resumes the session on a new connection
+        self.reader_task = None
+        self.attach(reader, writer)
+
+    # Starts over on a new TCP connection
+    def attach(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = protocol.FrameDecoder()
+        self.closed = asyncio.get_running_loop().create_future()
+        self.compressor = None # Set once the server has accepted compression
+        self.unsent = [] # Frames written since the last flush()
+
+    def start(self):
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    # The method to offer the server at login
+    def offered(self):
+        return self.compression if self.compression != "none" else ""
+
+    # Sets up what the server's login reply agreed to
+    def logged_in(self, reply):
+        if len(reply.args) > 1 and reply.args[1] in protocol.COMPRESSION_METHODS:
+            self.compressor = protocol.Compressor()
+        if len(reply.args) > 2:
+            self.session_token = reply.args[2]
+
+    # Reconnects after the connection dropped and resumes the session, which keeps the user logged in
+    # with their groups. Returns False if the server could not be reached or the session has ended.
+    async def resume(self, client_udp_port):
+        deadline = time.monotonic() + RESUME_TIMEOUT
+        while self.session_token is not None and time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection(*self.address, limit=protocol.MAX_FRAME_SIZE)
+            except OSError:
+                await asyncio.sleep(RESUME_RETRY_INTERVAL)
+                continue
+            self.attach(reader, writer)
+            self.start()
+            try:
+                reply = await self.request("resume", self.session_token, client_udp_port, self.offered())
+            except (ConnectionError, asyncio.TimeoutError):
+                self.close()
+                await asyncio.sleep(RESUME_RETRY_INTERVAL)
+                continue
+            if reply.args[0] == "success":
+                self.logged_in(reply)
+                return True
+            self.session_token = None
+        return False
+
+    # Sends a request that has no reply
+    def send(self, name, *args):
+        self.write(protocol.encode(name, *args))
+
+    # Frames are only queued here, the first one schedules flush() for the end of this pass of the event loop
+    def write(self, frame):
+        self.last_sent = time.monotonic()
+        if not self.unsent:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.unsent.append(frame)
+
+    def flush(self):
+        if not self.unsent:
+            return
+        data = self.unsent[0] if len(self.unsent) == 1 else b"".join(self.unsent)
+        self.unsent = []
+        self.writer.write(data if self.compressor is None else self.compressor.compress(data))
+
+    # Sends a request without waiting, returns the future that read_loop() resolves with the reply
+    def submit(self, name, *args):
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        # Also forgets requests that timed out
+        future.add_done_callback(lambda _: self.pending.pop(request_id, None))
+        self.write(protocol.encode(name, *args, request_id=request_id))
+        return future
+
+    # Sends a request and returns the server's reply to it
+    async def request(self, name, *args):
+        return await asyncio.wait_for(self.submit(name, *args), REPLY_TIMEOUT)
+
+    # Function to receive tcp messages from the server, replies resolve their request's future
+    # and everything else is passed to the handler for its name
+    async def read_loop(self):
+        while True:
+            try:
+                data = await self.reader.read(protocol.RECV_SIZE)
+                commands = self.decoder.feed(data)
+            except (ConnectionError, protocol.ProtocolError):
                 break
-
-            chunks = received_message.split()
-            audience_username = chunks[1]
-            original_filename = chunks[2]
-
-            server_filename = f"{audience_username}_{original_filename}"
-            # From the internet
-            with open(server_filename, 'ab') as file:  
-                   while True:
-                    data, address = client_udp_socket.recvfrom(1024)
-                    if data == b"EOF":  
-                        break
-                    file.write(data)
-
-            print(f"File ({original_filename}) received from {audience_username}\n")
-
-            # Prompt needs to be added because the normal functionality doesnt allow for the prompt to be printed when a file is received
-            print("Enter one of the following commands (/msgto, /activeuser, /creategroup, /joingroup, /groupmsg, /p2pvideo, /logout):") 
-        except:
-            break
+            if data == b'':
+                break
+            for command in commands:
+                future = self.pending.pop(command.request_id, None)
+                if future is not None:
+                    if not future.done():
+                        future.set_result(command)
+                else:
+                    self.handlers.get(command.name, print_message)(command)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The server closed the connection."))
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    # The server disconnects clients it has heard nothing from for a while, a client that is only
+    # quiet sends a heartbeat now and then so it is not taken for one that went away
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(max(self.last_sent + HEARTBEAT_INTERVAL - time.monotonic(), 0))
+            if time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+                self.send("/heartbeat")
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+    def compression_summary(self):
+        stats = self.compressor.stats
+        stats.add_received(self.decoder)
+        return f"Compression: {stats.summary()}"
+
+# Prints a frame from the server that no request is waiting for
+def print_message(command):
+    print(" ".join(str(arg) for arg in command.args))
+
+# Prompt needs to be added because the normal functionality doesnt allow for the prompt to be printed when messages are received
+def print_received_message(command):
+    print_message(command)
+    print("\n" + PROMPT)
+
+# Pushed by the server after /subscribe: a snapshot of the active users, then one frame per change
+def print_presence(command):
+    kind, fields = command.args[0], command.args[2:]
+    if kind == "snapshot":
+        print("Active users:" if fields else "No active users.")
+        for line in fields:
+            print(line)
+    elif kind == "join":
+        print(f"Online: {fields[0]}")
+    elif kind == "update":
+        print(f"Updated: {fields[0]}")
+    elif kind == "leave":
+        print(f"Offline: {fields[0]}")
+    else:
+        print(fields[0])
+
+# Receives udp messages from other clients whenever the socket is readable
+# and prints the files that were completed to the client's terminal
+# Streams whose player is not keeping up are written to again once their sink is writable. Those
+# sinks are only watched between calls into the receiver, which may close them.
+class FileReceiver:
+    def __init__(self, client_udp_socket, incoming=transfer.IncomingTransfer, accept_compressed=True,
+                 max_file_size=transfer.DEFAULT_MAX_FILE_SIZE):
+        self.socket = client_udp_socket
+        self.socket.setblocking(False)
+        self.receiver = transfer.TransferReceiver(client_udp_socket, incoming=incoming, accept_compressed=accept_compressed,
+                                                  max_file_size=max_file_size)
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(client_udp_socket, self.on_readable)
+        self.expire_handle = self.loop.call_later(EXPIRE_INTERVAL, self.expire)
+        self.watched = [] # File descriptors of the blocked streams' sinks
+
+    def on_readable(self):
+        self.unwatch_sinks()
+        try:
+            completed = self.receiver.receive()
+        except OSError:
+            completed = []
+        for incoming in completed:
+            self.report(incoming)
+        self.watch_sinks()
+        if self.receiver.stopped:
+            self.close()
+
+    def on_writable(self):
+        self.unwatch_sinks()
+        for incoming in self.receiver.drain_streams():
+            self.report(incoming)
+        self.watch_sinks()
+
+    def watch_sinks(self):
+        for incoming in self.receiver.blocked.values():
+            self.loop.add_writer(incoming.sink.fileno(), self.on_writable)
+            self.watched.append(incoming.sink.fileno())
+
+    def unwatch_sinks(self):
+        for fd in self.watched:
+            self.loop.remove_writer(fd)
+        self.watched.clear()
+
+    def report(self, incoming):
+        if isinstance(incoming, playback.IncomingStream):
+            print(f"File ({incoming.filename}) from {incoming.sender} played ({incoming.stats.summary()})\n")
+        else:
+            print(f"File ({incoming.filename}) received from {incoming.sender} ({incoming.stats.summary()}, {incoming.stats.duplicates} duplicates)\n")
+        # Prompt needs to be added because the normal functionality doesnt allow for the prompt to be printed when a file is received
+        print(PROMPT)
+
+    def expire(self):
+        self.unwatch_sinks()
+        for incoming in self.receiver.expire_idle():
+            print(f"File ({incoming.filename}) from {incoming.sender} was not completed\n")
+        self.watch_sinks()
+        self.expire_handle = self.loop.call_later(EXPIRE_INTERVAL, self.expire)
+
+    def close(self):
+        self.expire_handle.cancel()
+        self.unwatch_sinks()
+        self.loop.remove_reader(self.socket)
+        self.receiver.close()
 
 # Function to login the client and handle blocking, locking, and multiple login failures
-def login(client_tcp_socket, client_udp_socket, client_udp_port, server_host):
-    print("Please login \n")
-    input_username = input("Username: ")
-    input_password = input("Password: ")
-
-    if len(input_username.strip().split(" ")) != 1:
-        print("Error: Invalid username or password. Please try again.\n")
-        main()
-
-    message = f"credentials {input_username.strip()} {input_password.strip()} {client_udp_port}"
-    client_tcp_socket.send(message.encode())
-
-    data = client_tcp_socket.recv(1024)
-    received_message = data.decode()
-
-    if received_message == "login success":
-        print("Welcome to TESSENGER!")
-        client_tcp_socket.send(f"Log {input_username} {client_udp_port}".encode())
-        handle_client(client_tcp_socket, client_udp_socket, input_username, server_host, client_udp_port)
-    elif received_message == "login failed":
-        print("Login failed. Please try again.\n")
-        login(client_tcp_socket, client_udp_socket, client_udp_port, server_host)
-    elif received_message == "account locked":
-        print("Your account has been locked. Please try again later.")
-    elif received_message == "client blocked":
-        print("Your account is blocked due to multiple login failures. Please try again later")
-
-def msgto(client_tcp_socket, command, sender_username):
+# Returns the username once logged in, or None
+async def login(connection, client_udp_port):
+    while True:
+        print("Please login \n")
+        input_username = await read_input("Username: ")
+        input_password = await read_input("Password: ")
+
+        if len(input_username.strip().split(" ")) != 1:
+            print("Error: Invalid username or password. Please try again.\n")
+            continue
+
+        reply = await connection.request("credentials", input_username.strip(), input_password.strip(), client_udp_port,
+                                         connection.offered())
+        login_status = reply.args[0]
+
+        if login_status == "success":
+            connection.logged_in(reply)
+            print("Welcome to TESSENGER!")
+            connection.send("Log", input_username.strip(), client_udp_port)
+            return input_username.strip()
+        elif login_status == "failed":
+            print("Login failed. Please try again.\n")
+        elif login_status == "locked":
+            print("Your account has been locked. Please try again later.")
+            return None
+        elif login_status == "blocked":
+            print("Your account is blocked due to multiple login failures. Please try again later")
+            return None
+
+# Sends a request and prints the server's reply
+async def request_and_print(connection, name, *args):
+    print_message(await connection.request(name, *args))
+
+# The commands that are a single request, each function returns the request for a command line,
+# or None after printing what is wrong with it. They are also the commands --bulk can send.
+def msgto_request(command, sender_username):
     if len(command.split(" ")) < 3:
         print("Error: Invalid syntax. Command should be in the form of /msgto USERNAME MESSAGE_CONTENT\n")
-        return
+        return None
     receiver_username = command.split(" ")[1]
     message = " ".join(command.split()[2:])
-    message = f"/msgto {sender_username} {receiver_username} {message}"
-    client_tcp_socket.send(message.encode())
-
-def activeuser(client_tcp_socket):
-    message = "/activeuser"
-    client_tcp_socket.send(message.encode())
-
-def creategroup(client_tcp_socket, command, client_username):
+    return "/msgto", sender_username, receiver_username, message
+
+def activeuser_request(command, client_username):
+    if len(command.split()) > 3 or not all(arg.isdigit() for arg in command.split()[1:]):
+        print("Error: Invalid syntax. Command should be in the form of /activeuser [PAGE] [PAGE_SIZE]\n")
+        return None
+    args = [int(arg) for arg in command.split()[1:]]
+    if args and args[0] < 1 or len(args) > 1 and not 1 <= args[1] <= MAX_ACTIVEUSER_PAGE_SIZE:
+        print(f"Error: PAGE must be at least 1 and PAGE_SIZE from 1 to {MAX_ACTIVEUSER_PAGE_SIZE}.\n")
+        return None
+    return ("/activeuser", *args)
+
+def creategroup_request(command, client_username):
     if len(command.split(" ")) < 3:
         print("Error: Invalid syntax. Command should be in the form of /creategroup GROUPNAME USERNAMES\n")
-        return
-    members = command.split(" ")[2:]
-    message = f"/creategroup {command.split()[1]} {client_username} {' '.join(members)}"
-    client_tcp_socket.send(message.encode())
+        return None
+    members = command.split()[2:]
+    return ("/creategroup", command.split()[1], client_username, *members)
 
-def joingroup(client_tcp_socket, command, client_username):
+def joingroup_request(command, client_username):
     if len(command.split(" ")) != 2:
         print("Error: Invalid syntax. Command should be in the form of /joingroup GROUPNAME\n")
-        return
-    message = f"/joingroup {command.split()[1]} {client_username}"
-    client_tcp_socket.send(message.encode())
+        return None
+    return "/joingroup", command.split()[1], client_username
 
-def groupmsg(client_tcp_socket, command, client_username):
+def groupmsg_request(command, client_username):
     if len(command.split(" ")) < 3:
         print("Error: Invalid syntax. Command should be in the form of /groupmsg GROUPNAME MESSAGE_CONTENT\n")
-        return
-    message = f"/groupmsg {command.split()[1]} {client_username} {' '.join(command.split()[2:])}"
-    client_tcp_socket.send(message.encode())
-
-def p2pvideo(client_udp_socket, client_tcp_socket, command, presenter_username, server_host):
+        return None
+    return "/groupmsg", command.split()[1], client_username, ' '.join(command.split()[2:])
+
+# A page of the conversation with a user or a group, BEFORE is a message id from an earlier page
+def history_request(command, client_username):
+    args = command.split()[1:]
+    if not 1 <= len(args) <= 3 or not all(arg.isdigit() for arg in args[1:]):
+        print("Error: Invalid syntax. Command should be in the form of /history USERNAME|GROUPNAME [BEFORE] [LIMIT]\n")
+        return None
+    # BEFORE and LIMIT are only sent when given, the server has defaults for them
+    return ("/history", args[0], *(int(arg) for arg in args[1:]))
+
+REQUESTS = {
+    "/msgto": msgto_request,
+    "/activeuser": activeuser_request,
+    "/creategroup": creategroup_request,
+    "/joingroup": joingroup_request,
+    "/groupmsg": groupmsg_request,
+    "/history": history_request,
+}
+
+# Asks the server for the audience's UDP port, then sends the file from a worker thread
+# The transfer runs as a task of its own, so more commands and transfers can start meanwhile
+async def p2pvideo(connection, command, presenter_username, server_host, transfers, relay_mode):
     if len(command.split(" ")) != 3:
         print("Error: Invalid syntax. Command should be in the form of /p2pvideo USERNAME FILENAME\n")
         return
-    message = command.strip() + " " + presenter_username
-    client_tcp_socket.send(message.encode())
-    time.sleep(0.0001)
     filename = command.split(" ")[2]
     audience_username = command.split(" ")[1]
-    
-    if audience_username not in client_port_number:
+    reply = await connection.request("/p2pvideo", audience_username, filename, presenter_username)
+    if len(reply.args) != 2:
+        print_message(reply)
+        return
+
+    audience_address = (server_host, int(reply.args[1]))
+    if relay_mode == "always":
+        audience_address = await open_relay(connection, audience_username, filename, presenter_username, server_host)
+        if audience_address is None:
+            return
+    task = asyncio.create_task(send_video(connection, audience_username, audience_address, filename,
+                                          presenter_username, server_host, relay_mode == "auto"))
+    transfers.add(task)
+    task.add_done_callback(transfers.discard)
+
+# Asks the server for a relay to the audience, returns the address to send the file to or None
+async def open_relay(connection, audience_username, filename, presenter_username, server_host):
+    try:
+        reply = await connection.request("/relay", audience_username, filename, presenter_username)
+    except asyncio.TimeoutError:
+        print("Error: The server did not reply in time.")
+        return None
+    except ConnectionError as error:
+        print(f"Error: {error}")
+        return None
+    if len(reply.args) != 2:
+        print_message(reply)
+        return None
+    return (server_host, int(reply.args[1]))
+
+# With fallback, an audience that does not answer a few handshakes gets the file through the server
+async def send_video(connection, audience_username, audience_address, filename, presenter_username, server_host, fallback):
+    loop = asyncio.get_running_loop()
+    handshake_timeouts = DIRECT_HANDSHAKE_TIMEOUTS if fallback else transfer.MAX_TIMEOUTS
+    compress = connection.compression != "none"
+    try:
+        try:
+            stats = await loop.run_in_executor(None, transfer.send_file, audience_address, filename,
+                                               presenter_username, filename, None, handshake_timeouts, compress)
+        except transfer.ReceiverUnreachable as error:
+            if not fallback:
+                raise
+            print(f"{audience_username} cannot be reached directly ({error}), sending ({filename}) through the server")
+            relay_address = await open_relay(connection, audience_username, filename, presenter_username, server_host)
+            if relay_address is None:
+                return
+            stats = await loop.run_in_executor(None, transfer.send_file, relay_address, filename,
+                                               presenter_username, filename, None, transfer.MAX_TIMEOUTS, compress)
+    except (OSError, transfer.TransferError) as error:
+        print(f"Error: File ({filename}) could not be sent: {error}")
         return
 
-    server_address = (server_host, int(client_port_number[audience_username]))
-    # From the internet
-    with open(filename, 'rb') as file:
-        message = message 
-        client_udp_socket.sendto(message.encode(), server_address)
-        data = file.read(1024)
-        while data:
-            client_udp_socket.sendto(data, server_address)
-            data = file.read(1024)
-            time.sleep(0.00001)
-        end_marker = b"EOF"  
-        client_udp_socket.sendto(end_marker, server_address)
-
-    print("File sent successfully")
-
-def logout(client_tcp_socket, client_udp_socket, client_username, client_udp_port, server_host):
-    message = f"/logout {client_username}"
-    client_tcp_socket.send(message.encode())
-    client_udp_socket.sendto(message.encode(), (server_host, client_udp_port))
-    client_udp_socket.close()
-    client_tcp_socket.close()  
-    sys.exit()  
-
-def user_input(client_tcp_socket, client_udp_socket, client_username, server_host, client_udp_port):
-    commands = ["/msgto", "/activeuser", "/creategroup", "/joingroup", "/groupmsg", "/p2pvideo", "/logout"]
+    print(f"File ({filename}) sent successfully ({stats.summary()}, {stats.retransmits} retransmits, {stats.timeouts} timeouts)")
+
+# Asks the server for the UDP ports of the group's members online, then sends the file to all of
+# them at once from one worker thread, which reads the file once, see transfer.send_file_to_group()
+async def groupvideo(connection, command, presenter_username, server_host, transfers):
+    if len(command.split(" ")) != 3:
+        print("Error: Invalid syntax. Command should be in the form of /groupvideo GROUPNAME FILENAME\n")
+        return
+    group_name, filename = command.split(" ")[1:]
+    reply = await connection.request("/groupvideo", group_name, filename, presenter_username)
+    if len(reply.args) < 3:
+        print_message(reply)
+        return
+
+    audience = {(server_host, int(port)): username for username, port in zip(reply.args[1::2], reply.args[2::2])}
+    task = asyncio.create_task(send_group_video(audience, group_name, filename, presenter_username,
+                                                connection.compression != "none"))
+    transfers.add(task)
+    task.add_done_callback(transfers.discard)
+
+async def send_group_video(audience, group_name, filename, presenter_username, compress):
+    try:
+        stats, errors = await asyncio.get_running_loop().run_in_executor(
+            None, transfer.send_file_to_group, list(audience), filename, presenter_username, filename, None, compress)
+    except (OSError, transfer.TransferError) as error:
+        print(f"Error: File ({filename}) could not be sent to group {group_name}: {error}")
+        return
+
+    for address, member_stats in stats.items():
+        print(f"File ({filename}) sent to {audience[address]} ({member_stats.summary()}, {member_stats.retransmits} retransmits, {member_stats.timeouts} timeouts)")
+    for address, error in errors.items():
+        print(f"Error: File ({filename}) could not be sent to {audience[address]}: {error}")
+    print(f"File ({filename}) sent to {len(stats)} of {len(audience)} members of group {group_name}")
+
+# Admin command, the server replies with its metrics as JSON
+async def stats(connection):
+    await request_and_print(connection, "/stats")
+
+# Live presence: the server sends the active users now and every login and logout after that
+def subscribe(connection):
+    connection.send("/subscribe")
+
+def unsubscribe(connection):
+    connection.send("/unsubscribe")
+
+async def logout(connection, client_udp_socket, client_username, client_udp_port, server_host):
+    connection.session_token = None
+    await request_and_print(connection, "/logout", client_username)
+    client_udp_socket.sendto(transfer.stop_packet(), (server_host, client_udp_port))
+
+# Runs commands until /logout, returns early if the server goes away
+async def user_input(connection, client_udp_socket, client_username, server_host, client_udp_port, relay_mode):
+    commands = ["/msgto", "/activeuser", "/creategroup", "/joingroup", "/groupmsg", "/p2pvideo", "/groupvideo", "/history", "/logout", "/stats", "/subscribe", "/unsubscribe"]
+    transfers = set() # Files being sent
+    reading = None # The line being read, kept while the client reconnects
     while True:
-        print("\n Enter one of the following commands (/msgto, /activeuser, /creategroup, /joingroup, /groupmsg, /p2pvideo, /logout):")
-        command = input().strip()
-
-        if command.split(" ")[0] not in commands:
-            print("Error: Invalid command. Please try again.\n")
-        elif command.split(" ")[0] == "/msgto":
-            msgto(client_tcp_socket, command, client_username)
-        elif command.strip() == "/activeuser":
-            activeuser(client_tcp_socket)
-        elif command.split(" ")[0] == "/creategroup":
-            creategroup(client_tcp_socket, command, client_username)
-        elif command.split(" ")[0] == "/joingroup":
-            joingroup(client_tcp_socket, command, client_username)
-        elif command.split(" ")[0] == "/groupmsg":
-            groupmsg(client_tcp_socket, command, client_username)
-        elif command.split(" ")[0] == "/p2pvideo":
-            p2pvideo(client_udp_socket, client_tcp_socket, command, client_username, server_host)
-        elif command.strip() == "/logout":
-            logout(client_tcp_socket, client_udp_socket, client_username, client_udp_port, server_host)
-
-        time.sleep(0.0001)
-
-# All threads are started here
-def handle_client(client_tcp_socket, client_udp_socket, client_username, server_host, client_udp_port):
-    receive_tcp_thread = threading.Thread(target=receive_tcp_messages, args=(client_tcp_socket, client_username, server_host))
-    receive_tcp_thread.start()
-    receive_udp_thread = threading.Thread(target=receive_udp_messages, args=(client_udp_socket, client_username, server_host))
-    receive_udp_thread.start()
-    user_input_thread = threading.Thread(target=user_input, args=(client_tcp_socket, client_udp_socket, client_username, server_host, client_udp_port))
-    user_input_thread.start()
-
-    receive_tcp_thread.join()
-    receive_udp_thread.join()
-    user_input_thread.join()
+        if reading is None:
+            print("\n " + PROMPT)
+            reading = asyncio.ensure_future(read_input())
+        await asyncio.wait((reading, connection.closed), return_when=asyncio.FIRST_COMPLETED)
+        if connection.closed.done():
+            print("Error: The connection to the server was lost, reconnecting.")
+            if not await connection.resume(client_udp_port):
+                print("Error: The server closed the connection.")
+                return
+            print("Reconnected, you are still logged in and in your groups.")
+            continue
+        try:
+            command = reading.result().strip()
+        except EOFError:
+            command = "/logout"
+        reading = None
 
-def main():
-    if len(sys.argv) != 4:
-        print("\nError: Usage, python3 client.py SERVER_IP SERVER_PORT CLIENT_UDP_PORT\n")
-        exit(0)
-    server_host = sys.argv[1]
-    server_port = int(sys.argv[2])
-    server_address = (server_host, server_port)
-
-    client_udp_port = int(sys.argv[3])
-    client_tcp_socket = socket(AF_INET, SOCK_STREAM)
-    client_tcp_socket.connect(server_address)
+        try:
+            if command.split(" ")[0] not in commands:
+                print("Error: Invalid command. Please try again.\n")
+            elif command.split(" ")[0] in REQUESTS:
+                request = REQUESTS[command.split(" ")[0]](command, client_username)
+                if request is not None:
+                    await request_and_print(connection, *request)
+            elif command.split(" ")[0] == "/p2pvideo":
+                await p2pvideo(connection, command, client_username, server_host, transfers, relay_mode)
+            elif command.split(" ")[0] == "/groupvideo":
+                await groupvideo(connection, command, client_username, server_host, transfers)
+            elif command == "/stats":
+                await stats(connection)
+            elif command == "/subscribe":
+                subscribe(connection)
+            elif command == "/unsubscribe":
+                unsubscribe(connection)
+            elif command == "/logout":
+                if transfers:
+                    print(f"Waiting for {len(transfers)} file transfers to finish")
+                    await asyncio.wait(transfers)
+                await logout(connection, client_udp_socket, client_username, client_udp_port, server_host)
+                return
+        except asyncio.TimeoutError:
+            print("Error: The server did not reply in time.")
+        except ConnectionError as error:
+            # The next pass reconnects
+            print(f"Error: {error}")
+
+# Sends the commands in source, a file or "-" for stdin, one per line, without waiting for each reply:
+# up to window requests are in flight at once, and their replies are printed in order as they arrive.
+# Commands written in the same pass of the event loop reach the server in one write.
+async def bulk(connection, source, client_username, window):
+    loop = asyncio.get_running_loop()
+    file = sys.stdin if source == "-" else open(source)
+    in_flight = collections.deque()
+    sent = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            lines = await loop.run_in_executor(None, lambda: list(itertools.islice(file, BULK_READ_LINES)))
+            if not lines:
+                break
+            for line in lines:
+                command = line.strip()
+                if not command:
+                    continue
+                if command.split(" ")[0] not in REQUESTS:
+                    print(f"Error: Only {', '.join(REQUESTS)} can be sent in bulk, not {command.split(' ')[0]}\n")
+                    continue
+                request = REQUESTS[command.split(" ")[0]](command, client_username)
+                if request is None:
+                    continue
+                if len(in_flight) >= window:
+                    print_message(await asyncio.wait_for(in_flight.popleft(), REPLY_TIMEOUT))
+                in_flight.append(connection.submit(*request))
+                sent += 1
+        while in_flight:
+            print_message(await asyncio.wait_for(in_flight.popleft(), REPLY_TIMEOUT))
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    elapsed = time.perf_counter() - started
+    print(f"{sent} commands sent in {elapsed:.2f} s ({sent / max(elapsed, 1e-9):.0f} per second)")
+
+async def run(server_host, server_port, client_udp_port, incoming=transfer.IncomingTransfer, relay_mode="auto",
+              compression="zlib", bulk_source=None, bulk_window=BULK_WINDOW, max_file_size=transfer.DEFAULT_MAX_FILE_SIZE):
+    reader, writer = await asyncio.open_connection(server_host, server_port, limit=protocol.MAX_FRAME_SIZE)
+    connection = ServerConnection(reader, writer, (server_host, server_port))
+    connection.compression = compression
+    connection.handlers = {
+        "msg_recieve": print_received_message,
+        "groupmsg_recieve": print_received_message,
+        "presence": print_presence,
+    }
+    connection.start()
+    heartbeat_task = asyncio.create_task(connection.heartbeat_loop())
     client_udp_socket = socket(AF_INET, SOCK_DGRAM)
     client_udp_socket.bind((server_host, client_udp_port))
 
-    login(client_tcp_socket, client_udp_socket, client_udp_port, server_host)
+    try:
+        client_username = await login(connection, client_udp_port)
+        if client_username is not None:
+            receiver = FileReceiver(client_udp_socket, incoming, compression != "none", max_file_size)
+            if bulk_source is not None:
+                await bulk(connection, bulk_source, client_username, bulk_window)
+                await logout(connection, client_udp_socket, client_username, client_udp_port, server_host)
+            else:
+                await user_input(connection, client_udp_socket, client_username, server_host, client_udp_port, relay_mode)
+            receiver.close()
+            if connection.compressor is not None:
+                print(connection.compression_summary())
+    except ConnectionError:
+        print("Error: The server closed the connection.")
+    except asyncio.TimeoutError:
+        print("Error: The server did not reply in time.")
+    finally:
+        connection.close()
+        heartbeat_task.cancel()
+        client_udp_socket.close()
 
-    client_tcp_socket.close()
-    client_udp_socket.close()
+def main():
+    parser = argparse.ArgumentParser(usage="python3 client.py SERVER_IP SERVER_PORT CLIENT_UDP_PORT [options]")
+    parser.add_argument("server_host")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("client_udp_port", type=int)
+    parser.add_argument("--play", default=None, metavar="PLAYER",
+                        help='play received files as they arrive instead of saving them: a command that reads '
+                             'the file from its stdin, "-" for stdout or tcp:PORT for a player listening on that port')
+    parser.add_argument("--jitter-buffer", type=int, default=playback.DEFAULT_BUFFER_SIZE // 1024, metavar="KB",
+                        help="memory for reordering each file being played, also the most that is sent ahead of the player")
+    parser.add_argument("--relay", choices=["auto", "always", "never"], default="auto",
+                        help="send /p2pvideo files through the server: when the audience does not answer (auto), always, or never")
+    parser.add_argument("--compression", choices=["zlib", "none"], default="zlib",
+                        help="offer the server compression at login and deflate /p2pvideo payloads (zlib), or never")
+    parser.add_argument("--bulk", default=None, metavar="FILE",
+                        help='after login, send the commands in FILE ("-" for stdin) without waiting for each reply, then log out')
+    parser.add_argument("--window", type=int, default=BULK_WINDOW,
+                        help="requests --bulk sends before it waits for the oldest reply")
+    parser.add_argument("--max-file-size", type=int, default=transfer.DEFAULT_MAX_FILE_SIZE // 1024 ** 2, metavar="MB",
+                        help=f"largest file accepted from /p2pvideo and /groupvideo, at most {transfer.MAX_FILE_SIZE // 1024 ** 2}")
+    args = parser.parse_args()
+
+    incoming = transfer.IncomingTransfer
+    if args.play is not None:
+        incoming = playback.player(args.play, args.jitter_buffer * 1024)
+        if args.play == "-":
+            # stdout carries the stream, everything else goes to the terminal through stderr
+            sys.stdout = sys.stderr
+    asyncio.run(run(args.server_host, args.server_port, args.client_udp_port, incoming, args.relay, args.compression,
+                    args.bulk, args.window, args.max_file_size * 1024 ** 2))
+    sys.exit()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+# Credential store for the server, replaces scanning credentials.txt on every login
+#
+# credentials.txt is loaded into a dict once and loaded again only when its modification time
+# or size changes. Each line is "username password", where the password is either plain text
+# or a salted hash "pbkdf2_sha256$iterations$salt$hash" (see hash_password and the command below).
+# Hash checks are slow on purpose, so they run on a worker pool and return a Future.
+#
+# Failed attempts and temporary blocks are kept here as well and expire on their own: a timer on the
+# server's timer wheel (timerwheel.py) drops each entry when its deadline passes instead of waiting
+# for the user's next login. A block made here is passed to journal, if set, so it outlasts a restart
+# of the server (see state.py).
+#
+# To hash a password for credentials.txt: python3 credentials.py USERNAME PASSWORD
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from timerwheel import TimerWheel
+
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 100000
+MAX_HASH_ITERATIONS = 10 * HASH_ITERATIONS # More would hold up a password check worker for seconds
+BLOCK_SECONDS = 10 # How long an account stays blocked after too many failed attempts
+ATTEMPT_WINDOW = 300 # Failed attempts older than this are forgotten
+
+def hash_password(password, iterations=HASH_ITERATIONS, salt=None):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+# Returns (iterations, salt, expected digest) of a salted hash, None if it cannot be used
+def parse_hash(stored):
+    parts = stored.split("$")
+    if len(parts) != 4 or not parts[1].isdigit() or not 1 <= int(parts[1]) <= MAX_HASH_ITERATIONS:
+        return None
+    try:
+        return int(parts[1]), bytes.fromhex(parts[2]), bytes.fromhex(parts[3])
+    except ValueError:
+        return None
+
+# A hash that cannot be parsed, such as a line edited by hand, matches no password
+def verify_password(password, stored):
+    if not stored.startswith(HASH_SCHEME + "$"):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    parsed = parse_hash(stored)
+    if parsed is None:
+        return False
+    iterations, salt, expected = parsed
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return hmac.compare_digest(digest, expected)
+
+class CredentialStore:
+    def __init__(self, path, max_invalid_attempts, block_seconds=BLOCK_SECONDS, workers=4, timers=None):
+        self.path = path
+        self.max_invalid_attempts = max_invalid_attempts
+        self.block_seconds = block_seconds
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-check")
+
+        self.lock = threading.Lock()
+        self.passwords = {} # username -> stored password or hash
+        self.file_version = None # (mtime, size) of the loaded file
+        self.reloads = 0
+
+        self.invalid_attempts = {} # username -> (count, time the count expires)
+        self.blocked_clients = {} # username -> time the block ends
+        self.timers = timers if timers is not None else TimerWheel()
+        self.expiry_timers = {} # username -> timer that expires their block or failed attempts
+        self.journal = None # Called as journal("@blocked", username, until) when an account is blocked here
+        self.warn = None # Called with a message for each unusable hash, once each time the file is loaded
+
+    # Loads credentials.txt again if it changed since the last load
+    def refresh(self):
+        try:
+            status = os.stat(self.path)
+        except FileNotFoundError:
+            status = None
+        version = status and (status.st_mtime_ns, status.st_size)
+        if version == self.file_version:
+            return
+        passwords = {}
+        if status is not None:
+            with open(self.path, "r") as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        passwords[parts[0]] = parts[1]
+                        if (parts[1].startswith(HASH_SCHEME + "$") and parse_hash(parts[1]) is None
+                                and self.warn is not None):
+                            self.warn(f"Error: The password hash of {parts[0]} in {self.path} cannot be read, they cannot log in")
+        with self.lock:
+            self.passwords = passwords
+            self.file_version = version
+            self.reloads += 1
+
+    def exists(self, username):
+        self.refresh()
+        return username in self.passwords
+
+    # Returns a Future that resolves to True or False, or to None when the username does not exist
+    def check_password(self, username, password):
+        self.refresh()
+        stored = self.passwords.get(username)
+        if stored is None or not stored.startswith(HASH_SCHEME + "$"):
+            # Unknown users and plain text passwords are answered without using the pool
+            future = Future()
+            future.set_result(None if stored is None else verify_password(password, stored))
+            return future
+        return self.pool.submit(verify_password, password, stored)
+
+    def is_blocked(self, username):
+        return username in self.blocked_clients
+
+    # Counts a failed attempt, returns True when it blocks the account
+    def record_failure(self, username):
+        now = time.time()
+        with self.lock:
+            count, _ = self.invalid_attempts.get(username, (0, 0))
+            count += 1
+            self.invalid_attempts[username] = (count, now + ATTEMPT_WINDOW)
+            if count < self.max_invalid_attempts:
+                self.schedule(now + ATTEMPT_WINDOW, username)
+                return False
+            until = self.block_locked(username, now)
+        if self.journal is not None:
+            self.journal("@blocked", username, until)
+        return True
+
+    # Blocks an account locked somewhere else, such as by another worker process or before a restart
+    def block(self, username, until=None):
+        with self.lock:
+            self.block_locked(username, time.time(), until)
+
+    # Returns when the block ends, in whole seconds since the epoch
+    def block_locked(self, username, now, until=None):
+        until = until or int(now + self.block_seconds) + 1
+        self.blocked_clients[username] = until
+        self.schedule(until, username)
+        return until
+
+    def record_success(self, username):
+        with self.lock:
+            self.invalid_attempts.pop(username, None)
+
+    # One timer per user, called with the lock held, a later deadline replaces the earlier timer
+    def schedule(self, deadline, username):
+        timer = self.expiry_timers.get(username)
+        if timer is not None:
+            self.timers.cancel(timer)
+        self.expiry_timers[username] = self.timers.schedule(deadline - time.time(), lambda: self.expire(username))
+
+    # Drops the user's block or failed attempts once their time has passed, runs on the timer wheel
+    # The wheel keeps monotonic time and deadlines are wall clock time, so an entry that is not quite
+    # due yet gets a new timer
+    def expire(self, username):
+        with self.lock:
+            self.expiry_timers.pop(username, None)
+            now = time.time()
+            block_end = self.blocked_clients.get(username)
+            if block_end is not None:
+                if block_end > now:
+                    self.schedule(block_end, username)
+                    return
+                del self.blocked_clients[username]
+                self.invalid_attempts.pop(username, None)
+                return
+            attempts = self.invalid_attempts.get(username)
+            if attempts is not None:
+                if attempts[1] > now:
+                    self.schedule(attempts[1], username)
+                else:
+                    del self.invalid_attempts[username]
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("\nError: Usage, python3 credentials.py USERNAME PASSWORD\n")
+        exit(0)
+    print(f"{sys.argv[1]} {hash_password(sys.argv[2])}")
@@ -0,0 +1,154 @@
+# Registry of groups, replaces the groups and members_joined dicts of lists
+#
+# A group keeps its members (the users named when it was created) and the members who have joined
+# in sets, so every membership check is a hash lookup. It also keeps which joined members are
+# logged in: the registry listens to the presence registry and, through a reverse index from each
+# user to their groups, updates only that user's groups when they log in, log out or disconnect.
+# A group message is then sent to the members online, however many members the group has.
+#
+# The registry lock covers the group names and the reverse index, each group has a lock of its own
+# for its sets, so busy groups do not hold each other up. Locks are always taken in the order
+# presence registry, group registry, group.
+#
+# Groups are written to groups.txt by a snapshot thread, one line per group:
+#   NAME; CREATOR; MEMBER MEMBER ...; JOINED JOINED ...
+# Across restarts the server keeps groups in its state store (state.py), which the registry tells
+# about every change through journal. groups.txt is only loaded when the state store is empty.
+import os
+import threading
+
+from presence import UserlogSnapshot
+
+class Group:
+    __slots__ = ("name", "creator", "members", "joined", "online", "lock")
+
+    def __init__(self, name, creator, members, joined):
+        self.name = name
+        self.creator = creator
+        self.members = set(members)
+        self.joined = set(joined)
+        self.online = set() # Joined members who are logged in, the recipients of a group message
+        self.lock = threading.Lock()
+
+    # Copy of the members to send a group message to
+    def recipients(self):
+        with self.lock:
+            return list(self.online)
+
+    def line(self):
+        with self.lock:
+            return f"{self.name}; {self.creator}; {' '.join(sorted(self.members))}; {' '.join(sorted(self.joined))}\n"
+
+class GroupRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {} # name -> Group
+        self.user_groups = {} # username -> names of the groups the user is a member of
+        self.version = 0 # Bumped on every change so snapshots know when to write
+        self.presence = None
+        self.journal = None # Called with the state store record of every change, see state.py
+
+    # Follows logins and logouts from now on, see presence.py
+    def attach(self, presence):
+        self.presence = presence
+        presence.listeners.append(self.presence_changed)
+
+    def online(self, username):
+        return self.presence is not None and username in self.presence
+
+    # Adds a group, the creator has joined it already. Returns None if the name is taken.
+    def create(self, name, members, creator=None, joined=()):
+        creator = creator or members[0]
+        with self.lock:
+            if name in self.groups:
+                return None
+            group = Group(name, creator, members, [creator, *joined])
+            group.online = {username for username in group.joined if self.online(username)}
+            self.groups[name] = group
+            for username in group.members:
+                self.user_groups.setdefault(username, set()).add(name)
+            self.version += 1
+            if self.journal is not None:
+                self.journal("@group", name, creator, *members)
+                for username in joined:
+                    self.journal("@join", name, username)
+            return group
+
+    # Returns False if the user had joined already
+    def join(self, name, username):
+        group = self.groups[name]
+        with group.lock:
+            if username in group.joined:
+                return False
+            group.joined.add(username)
+            if self.online(username):
+                group.online.add(username)
+        with self.lock:
+            self.version += 1
+        if self.journal is not None:
+            self.journal("@join", name, username)
+        return True
+
+    # Called by the presence registry with its lock held
+    def presence_changed(self, kind, username):
+        with self.lock:
+            names = list(self.user_groups.get(username, ()))
+        for name in names:
+            group = self.groups[name]
+            with group.lock:
+                if kind == "leave":
+                    group.online.discard(username)
+                elif username in group.joined:
+                    group.online.add(username)
+
+    # Names of the groups a user is a member of
+    def groups_of(self, username):
+        with self.lock:
+            return set(self.user_groups.get(username, ()))
+
+    def get(self, name):
+        return self.groups.get(name)
+
+    def __contains__(self, name):
+        return name in self.groups
+
+    def __len__(self):
+        return len(self.groups)
+
+    # Copy of the group names, safe to iterate while groups are created
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.groups))
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.groups.values())
+
+    def lines(self):
+        version = self.version
+        return version, [group.line() for group in sorted(self.snapshot(), key=lambda group: group.name)]
+
+    # Adds the groups saved in a snapshot file, if there is one
+    def load(self, path):
+        if not os.path.isfile(path):
+            return
+        with open(path) as file:
+            for line in file:
+                parts = line.rstrip("\n").split("; ")
+                if len(parts) != 4:
+                    continue
+                name, creator, members, joined = parts
+                # A group always has members, a line without any was not written by a snapshot
+                if not members.split():
+                    continue
+                self.create(name, members.split(), creator, joined.split())
+
+# Keeps groups.txt in step with the group registry, written like userlog.txt
+class GroupSnapshot(UserlogSnapshot):
+    def lines(self):
+        return self.registry.lines()
+
+    # Writes the last changes before the server stops
+    def close(self):
+        UserlogSnapshot.close(self)
+        self.write()
@@ -0,0 +1,374 @@
+# Chat history kept across restarts, read a page at a time by /history
+#
+# Every private and group message is appended to a segment file, history/segments/ID.seg, named by
+# the id of its first message. A record is its length and id (RECORD) followed by the JSON list
+# [conversation, sender, timestamp, text]. Each conversation has an index file in history/index/
+# with one fixed size entry per message (INDEX_ENTRY: id, segment, offset in the segment), in id
+# order. A page is found by binary search on the index for the "before" id, then the page's entries
+# are read with one seek and each message with one more, so a page costs the same however long the
+# history is.
+#
+# A segment is closed once it reaches the segment size and a new one is started. Closed segments are
+# compressed on a thread of their own into ID.zseg, in blocks of BLOCK_SIZE bytes compressed on their
+# own with a table of where each block starts, so a message is still read by seeking, to its block.
+# Index offsets always count in uncompressed bytes and stay valid.
+#
+# Conversations are "@alice,bob" for private messages (the two usernames in order) and "#NAME" for
+# a group. Messages for a user who is offline can also go on their pending index in
+# history/pending/, which the server sends them at their next login and then clears.
+#
+# One writer thread owns every file, appends are queued like the message logs (messagelog.py) and
+# written in batches: segment first, then the index entries that point into it, so an index never
+# points past the data. Readers in any thread or worker process only ever read the files.
+import json
+import os
+import queue
+import struct
+import threading
+import zlib
+from urllib.parse import quote
+
+RECORD = struct.Struct("!IQ") # length of the JSON body, message id
+INDEX_ENTRY = struct.Struct("!QQI") # message id, first id of its segment, offset in the segment
+ZSEG_HEADER = struct.Struct("!4sII") # magic, block size, number of blocks
+ZSEG_OFFSET = struct.Struct("!Q")
+ZSEG_MAGIC = b"HSZ1"
+BLOCK_SIZE = 16 * 1024
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_BATCH = 1024 # Appends written per pass
+
+# Marks the end of the queue when the store is closed
+STOP = object()
+
+def private_conversation(first, second):
+    return "@" + ",".join(sorted((first, second)))
+
+def group_conversation(name):
+    return "#" + name
+
+# Yields the offset after each complete record, a record cut short at the end is left out
+def records(data):
+    offset = 0
+    while offset + RECORD.size <= len(data):
+        length, _ = RECORD.unpack_from(data, offset)
+        if offset + RECORD.size + length > len(data):
+            return
+        offset += RECORD.size + length
+        yield offset
+
+class Message:
+    __slots__ = ("id", "sender", "timestamp", "text")
+
+    def __init__(self, message_id, sender, timestamp, text):
+        self.id = message_id
+        self.sender = sender
+        self.timestamp = timestamp
+        self.text = text
+
+# A closed and compressed segment, blocks are decompressed as a read needs them
+class CompressedSegment:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        magic, self.block_size, blocks = ZSEG_HEADER.unpack(self.file.read(ZSEG_HEADER.size))
+        if magic != ZSEG_MAGIC:
+            raise ValueError(f"{path} is not a compressed history segment")
+        table = self.file.read(ZSEG_OFFSET.size * (blocks + 1))
+        self.offsets = [ZSEG_OFFSET.unpack_from(table, index * ZSEG_OFFSET.size)[0] for index in range(blocks + 1)]
+        self.data_start = ZSEG_HEADER.size + len(table)
+        self.cached = (None, b"") # The last block read, pages tend to read neighbouring messages
+
+    def block(self, number):
+        if self.cached[0] != number:
+            self.file.seek(self.data_start + self.offsets[number])
+            self.cached = (number, zlib.decompress(self.file.read(self.offsets[number + 1] - self.offsets[number])))
+        return self.cached[1]
+
+    def read(self, offset, size):
+        parts = []
+        while size > 0:
+            number, start = divmod(offset, self.block_size)
+            if number >= len(self.offsets) - 1:
+                break
+            part = self.block(number)[start:start + size]
+            if not part:
+                break # Past the end of the last block, which is usually shorter than the others
+            parts.append(part)
+            offset += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def close(self):
+        self.file.close()
+
+class RawSegment:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+
+    def read(self, offset, size):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+# Reads pages of history, used on its own by the worker processes of a multi-core server
+class HistoryReader:
+    def __init__(self, directory):
+        self.directory = directory
+        self.segment_directory = os.path.join(directory, "segments")
+        self.index_directory = os.path.join(directory, "index")
+        self.pending_directory = os.path.join(directory, "pending")
+
+    def index_path(self, conversation):
+        return os.path.join(self.index_directory, quote(conversation, safe="") + ".idx")
+
+    def pending_path(self, username):
+        return os.path.join(self.pending_directory, quote(username, safe="") + ".idx")
+
+    def segment_path(self, first_id, suffix=".seg"):
+        return os.path.join(self.segment_directory, f"{first_id:012d}{suffix}")
+
+    # Up to limit messages of the conversation with an id below before (the newest if None),
+    # oldest first, and whether there are older ones
+    def page(self, conversation, before=None, limit=DEFAULT_PAGE_SIZE):
+        try:
+            index = open(self.index_path(conversation), "rb")
+        except FileNotFoundError:
+            return [], False
+        with index:
+            count = os.fstat(index.fileno()).st_size // INDEX_ENTRY.size
+            end = count if before is None else self.find(index, count, before)
+            start = max(end - limit, 0)
+            index.seek(start * INDEX_ENTRY.size)
+            entries = index.read((end - start) * INDEX_ENTRY.size)
+        return self.read_messages(entries), start > 0
+
+    # Number of entries with an id below message_id, by binary search on the index file
+    def find(self, index, count, message_id):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            index.seek(middle * INDEX_ENTRY.size)
+            if INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0] < message_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Messages queued for a user while they were offline, oldest first
+    def pending(self, username):
+        try:
+            with open(self.pending_path(username), "rb") as index:
+                entries = index.read()
+        except FileNotFoundError:
+            return []
+        return self.read_messages(entries[:len(entries) - len(entries) % INDEX_ENTRY.size])
+
+    def read_messages(self, entries):
+        segments = {}
+        messages = []
+        try:
+            for message_id, first_id, offset in INDEX_ENTRY.iter_unpack(entries):
+                segment = segments.get(first_id)
+                if segment is None:
+                    segment = segments[first_id] = self.open_segment(first_id)
+                length, record_id = RECORD.unpack(segment.read(offset, RECORD.size))
+                _, sender, timestamp, text = json.loads(segment.read(offset + RECORD.size, length))
+                messages.append(Message(record_id, sender, timestamp, text))
+        finally:
+            for segment in segments.values():
+                segment.close()
+        return messages
+
+    # A closed segment may be compressed meanwhile, its .seg is only removed once the .zseg is complete
+    def open_segment(self, first_id):
+        try:
+            return RawSegment(self.segment_path(first_id))
+        except FileNotFoundError:
+            return CompressedSegment(self.segment_path(first_id, ".zseg"))
+
+# The history of a single server or of a supervisor, the only place that writes to it
+class HistoryStore(HistoryReader):
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, fsync_policy="none"):
+        HistoryReader.__init__(self, directory)
+        self.segment_size = segment_size
+        self.fsync_policy = fsync_policy
+        for path in (self.segment_directory, self.index_directory, self.pending_directory):
+            os.makedirs(path, exist_ok=True)
+        self.queue = queue.Queue()
+        self.appended = 0
+        self.compressed = 0
+        self.compressed_bytes = 0 # Size of the closed segments before and after compression
+        self.uncompressed_bytes = 0
+        self.compressors = []
+        self.recover()
+        self.thread = threading.Thread(target=self.run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    # Finds the segment to append to and the next message id, and compresses closed segments that
+    # were not compressed before the last shutdown
+    def recover(self):
+        firsts = sorted({int(name.split(".")[0]) for name in os.listdir(self.segment_directory)
+                         if name.endswith((".seg", ".zseg"))})
+        if not firsts:
+            self.open_segment_for_append(1)
+            return
+        for first_id in firsts[:-1]:
+            if os.path.exists(self.segment_path(first_id)):
+                self.compress_later(first_id)
+        last = firsts[-1]
+        path = self.segment_path(last)
+        if not os.path.exists(path):
+            # Stopped between closing the last segment and starting the next one
+            segment = self.open_segment(last)
+            data = segment.read(0, len(segment.offsets) * segment.block_size)
+            segment.close()
+            self.open_segment_for_append(last + sum(1 for _ in records(data)))
+            return
+        with open(path, "rb") as file:
+            data = file.read()
+        count = 0
+        offset = 0
+        for offset in records(data):
+            count += 1
+        if offset < len(data):
+            # A record cut short by a crash, nothing in an index points at it
+            with open(path, "r+b") as file:
+                file.truncate(offset)
+        self.segment_first = last
+        self.next_id = last + count
+        self.segment = open(path, "ab")
+        self.segment_offset = offset
+
+    def open_segment_for_append(self, first_id):
+        self.segment_first = first_id
+        self.next_id = first_id
+        self.segment = open(self.segment_path(first_id), "ab")
+        self.segment_offset = 0
+
+    # Queues a message, pending_for also puts it on that user's pending index
+    def append(self, conversation, sender, timestamp, text, pending_for=None):
+        self.queue.put((conversation, sender, timestamp, text, pending_for))
+
+    # Drops the first count messages of a user's pending index, once they have been sent
+    def clear_pending(self, username, count):
+        self.queue.put((None, username, count, None, None))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is STOP
+            if stopping:
+                batch.pop()
+            self.write_batch(batch)
+            if stopping:
+                self.segment.close()
+                return
+
+    def write_batch(self, batch):
+        entries = {} # index path -> entries to append
+        for conversation, sender, timestamp, text, pending_for in batch:
+            if conversation is None:
+                # Cleared in order with the appends, so nothing queued meanwhile is lost
+                self.flush_entries(entries)
+                entries = {}
+                self.drop_pending(sender, timestamp)
+                continue
+            body = json.dumps([conversation, sender, timestamp, text]).encode()
+            message_id = self.next_id
+            self.next_id += 1
+            self.segment.write(RECORD.pack(len(body), message_id) + body)
+            entry = INDEX_ENTRY.pack(message_id, self.segment_first, self.segment_offset)
+            self.segment_offset += RECORD.size + len(body)
+            entries.setdefault(self.index_path(conversation), []).append(entry)
+            if pending_for is not None:
+                entries.setdefault(self.pending_path(pending_for), []).append(entry)
+            self.appended += 1
+        self.flush_entries(entries)
+        if self.segment_offset >= self.segment_size:
+            self.roll_over()
+
+    # The segment reaches the disk before the entries that point into it
+    def flush_entries(self, entries):
+        if not entries:
+            return
+        self.segment.flush()
+        if self.fsync_policy != "none":
+            os.fsync(self.segment.fileno())
+        for path, path_entries in entries.items():
+            with open(path, "ab") as index:
+                index.write(b"".join(path_entries))
+                if self.fsync_policy != "none":
+                    index.flush()
+                    os.fsync(index.fileno())
+
+    def drop_pending(self, username, count):
+        path = self.pending_path(username)
+        try:
+            with open(path, "rb") as index:
+                rest = index.read()[count * INDEX_ENTRY.size:]
+        except FileNotFoundError:
+            return
+        if not rest:
+            os.remove(path)
+            return
+        with open(path + ".tmp", "wb") as index:
+            index.write(rest)
+        os.replace(path + ".tmp", path)
+
+    def roll_over(self):
+        self.segment.close()
+        closed = self.segment_first
+        self.open_segment_for_append(self.next_id)
+        self.compress_later(closed)
+
+    def compress_later(self, first_id):
+        self.compressors = [thread for thread in self.compressors if thread.is_alive()]
+        thread = threading.Thread(target=self.compress, args=(first_id,), name="history-compress", daemon=True)
+        self.compressors.append(thread)
+        thread.start()
+
+    # Writes ID.zseg next to ID.seg and only then removes ID.seg, readers can use either meanwhile
+    def compress(self, first_id):
+        path = self.segment_path(first_id)
+        with open(path, "rb") as file:
+            data = file.read()
+        blocks = [zlib.compress(data[offset:offset + BLOCK_SIZE]) for offset in range(0, len(data), BLOCK_SIZE)]
+        offsets = [0]
+        for block in blocks:
+            offsets.append(offsets[-1] + len(block))
+        compressed_path = self.segment_path(first_id, ".zseg")
+        with open(compressed_path + ".tmp", "wb") as file:
+            file.write(ZSEG_HEADER.pack(ZSEG_MAGIC, BLOCK_SIZE, len(blocks)))
+            file.write(b"".join(ZSEG_OFFSET.pack(offset) for offset in offsets))
+            file.write(b"".join(blocks))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(compressed_path + ".tmp", compressed_path)
+        os.remove(path)
+        self.compressed += 1
+        self.uncompressed_bytes += len(data)
+        self.compressed_bytes += offsets[-1]
+
+    # Writes everything still queued, waits for compressions under way
+    def close(self):
+        self.queue.put(STOP)
+        self.thread.join()
+        for thread in self.compressors:
+            thread.join()
+
+    def stats(self):
+        return {
+            "messages": self.appended,
+            "next_id": self.next_id,
+            "queue_depth": self.queue.qsize(),
+            "segments_compressed": self.compressed,
+            "compressed_ratio": round(self.compressed_bytes / self.uncompressed_bytes, 3) if self.uncompressed_bytes else None,
+        }
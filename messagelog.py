@@ -0,0 +1,169 @@
+# Writes the server's message logs (messagelog.txt and {group}_messagelog.txt) from one thread
+#
+# Handlers only put records on a queue, so logging a message costs the same however long the log is.
+# The writer thread keeps one open append handle and one sequence counter per log file, which makes
+# numbering race free, and writes everything queued since its last pass as one batch (group commit):
+# each file touched by the batch is flushed once, and fsynced according to the fsync policy.
+#   none    flush to the OS only, the original behaviour
+#   batch   one fsync per file per batch
+#   always  fsync after every record
+# A record that cannot be written, such as on a full disk, is reported and dropped, and the log is
+# opened again for the next record, so one bad write does not stop the logging of every message.
+# Line breaks in fields are written as \n and \r, so message text cannot start a line of its own,
+# which would look like a record and move where the numbering goes on after a restart.
+import os
+import queue
+import re
+import time
+from threading import Thread
+
+from metrics import Histogram
+
+FSYNC_POLICIES = ("none", "batch", "always")
+MAX_BATCH = 1024 # Records written per pass
+# A numbered record: its sequence and at least two fields. Unnumbered records, such as the
+# "group; members" line that starts a group's log, have fewer, so a group named 123 is not one
+NUMBERED_LINE = re.compile(r"(\d+); [^;\n]*; ")
+
+LINE_BREAKS = str.maketrans({"\n": "\\n", "\r": "\\r"})
+
+# Marks the end of the queue when the writer is closed
+STOP = object()
+
+class LogWriter:
+    def __init__(self, fsync_policy="none"):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync_policy}")
+        self.fsync_policy = fsync_policy
+        self.queue = queue.Queue()
+        self.files = {} # path -> open append handle
+        self.counters = {} # path -> sequence number of the last numbered record
+
+        self.records = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.max_queue_depth = 0
+        self.latency = Histogram() # Time from append() to the record being written
+        self.write_errors = 0
+        self.report = None # Called with a message when a log cannot be written
+
+        self.thread = Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    # Queues a record, numbered records are written as "sequence; field; field; ..." and need two fields or more
+    def append(self, path, fields, numbered=True):
+        self.queue.put((path, fields, numbered, time.monotonic()))
+
+    # Writes everything still queued and closes the log files
+    def close(self):
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.max_queue_depth = max(self.max_queue_depth, len(batch) + self.queue.qsize())
+            stopping = batch[-1] is STOP
+            if stopping:
+                batch.pop()
+            self.write_batch(batch)
+            if stopping:
+                for path, file in list(self.files.items()):
+                    try:
+                        file.close()
+                    except OSError as error:
+                        self.failed(path, error)
+                self.files.clear()
+                return
+
+    def write_batch(self, batch):
+        touched = {}
+        for path, fields, numbered, queued_at in batch:
+            try:
+                file = self.open(path)
+                text = "; ".join(field.translate(LINE_BREAKS) for field in fields)
+                if numbered:
+                    line = f"{self.counters[path] + 1}; {text}\n"
+                else:
+                    line = text + "\n"
+                file.write(line)
+                if numbered:
+                    self.counters[path] += 1
+                if self.fsync_policy == "always":
+                    file.flush()
+                    os.fsync(file.fileno())
+            except OSError as error:
+                self.failed(path, error)
+                touched.pop(path, None)
+                continue
+            touched[path] = file
+
+        for path, file in touched.items():
+            try:
+                file.flush()
+                if self.fsync_policy == "batch":
+                    os.fsync(file.fileno())
+            except OSError as error:
+                self.failed(path, error)
+
+        now = time.monotonic()
+        for _, _, _, queued_at in batch:
+            latency = now - queued_at
+            self.latency.observe(latency)
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        self.records += len(batch)
+        self.batches += 1
+
+    # Drops the log's handle, the next record opens it again and numbering goes on from what reached the file
+    def failed(self, path, error):
+        self.write_errors += 1
+        file = self.files.pop(path, None)
+        if file is not None:
+            try:
+                file.close()
+            except OSError:
+                pass # What was still buffered is lost with the record that failed
+        if self.report is not None:
+            self.report(f"Error: Cannot write {path}: {error}")
+
+    # Opens a log the first time it is written, numbering goes on from its last numbered record
+    def open(self, path):
+        file = self.files.get(path)
+        if file is None:
+            self.counters[path] = last_sequence(path)
+            file = open(path, "a")
+            self.files[path] = file
+        return file
+
+    def stats(self):
+        average = self.total_latency / self.records if self.records else 0.0
+        latency = self.latency.snapshot()
+        return {
+            "records": self.records,
+            "batches": self.batches,
+            "average_latency_ms": average * 1000,
+            "max_latency_ms": self.max_latency * 1000,
+            "p99_latency_ms": latency["p99_ms"],
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "write_errors": self.write_errors,
+        }
+
+def last_sequence(path):
+    if not os.path.isfile(path):
+        return 0
+    sequence = 0
+    with open(path, "r") as file:
+        for line in file:
+            match = NUMBERED_LINE.match(line)
+            if match:
+                sequence = int(match.group(1))
+    return sequence
@@ -0,0 +1,175 @@
+# Counters, latency histograms and a sampling profiler for the server
+#
+# Handlers are timed into one histogram each, other parts of the server add counters (bytes in,
+# frames per command) and gauges (connections, queue depths, log writer stats) that are read when
+# a snapshot is taken. A snapshot is plain JSON, served by the /stats command and, with --stats-port,
+# by a small HTTP server on localhost:
+#   GET /stats                 the snapshot
+#   GET /profile?seconds=N     samples every thread's stack for N seconds (default 5, at most 60),
+#                              returns collapsed stacks ("frame;frame;frame count" lines, the input
+#                              format of flamegraph.pl)
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Bucket i holds observations below 2**i microseconds, the last bucket holds the rest
+HISTOGRAM_BUCKETS = 32
+DEFAULT_PROFILE_SECONDS = 5
+MAX_PROFILE_SECONDS = 60
+
+class Histogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    # Upper bound of the bucket holding the given fraction of observations, in milliseconds
+    def percentile(self, fraction):
+        rank = self.count * fraction
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** bucket / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+                "p50_ms": round(self.percentile(0.5), 3),
+                "p99_ms": round(self.percentile(0.99), 3),
+                "p999_ms": round(self.percentile(0.999), 3),
+                "max_ms": round(self.max * 1000, 3),
+            }
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = Counter()
+        self.histograms = {}
+        self.gauges = {} # name -> function returning a JSON value, called for each snapshot
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(seconds)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "counters": counters,
+            "latency": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+            "gauges": {name: function() for name, function in self.gauges.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+# Counts the stacks of every thread at a fixed interval, cheap enough to leave on while serving
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self, path):
+        with open(path, "w") as file:
+            file.write(self.collapsed())
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            self.reply("application/json", self.server.metrics.to_json())
+        elif url.path == "/profile":
+            try:
+                seconds = float(parse_qs(url.query, keep_blank_values=True).get("seconds", [DEFAULT_PROFILE_SECONDS])[0])
+            except ValueError:
+                seconds = None
+            # Also turns down nan
+            if seconds is None or not 0 < seconds <= MAX_PROFILE_SECONDS:
+                self.send_error(400, f"seconds has to be a number above 0 and at most {MAX_PROFILE_SECONDS}")
+                return
+            profiler = SamplingProfiler().start()
+            time.sleep(seconds)
+            self.reply("text/plain", profiler.stop().collapsed())
+        else:
+            self.send_error(404)
+
+    def reply(self, content_type, body):
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Requests are not worth a line on the server's console
+    def log_message(self, format, *args):
+        pass
+
+# Serves /stats and /profile on localhost from a thread of its own
+def start_stats_server(metrics, port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StatsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="stats-http", daemon=True).start()
+    return server
@@ -0,0 +1,265 @@
+# Bounded outbound queue per connection, replaces writing to other clients' sockets from the sender's thread
+#
+# Handlers only queue encoded frames (the same bytes object is shared by every recipient of a group
+# message), and each connection's own writer sends them. A slow or stalled client therefore never
+# holds up the sender or the other recipients. When a queue holds more than its limit in bytes the
+# backpressure policy decides what happens to new frames:
+#   drop        the frame is discarded and counted
+#   disconnect  the slow consumer is disconnected
+#   spill       frames go to a temporary file and are sent from there, in order, once the client catches up
+#
+# A writer takes everything queued at once as a list of frames and sends the list with one vectored
+# write (send_frames), so a burst of replies and deliveries costs one system call, not one per frame,
+# and the frames are never copied into one buffer first.
+import os
+import tempfile
+import threading
+from collections import deque
+
+BACKPRESSURE_POLICIES = ("drop", "disconnect", "spill")
+DEFAULT_LIMIT = 1024 * 1024 # Bytes held in memory per connection
+MAX_WRITE = 256 * 1024 # Bytes handed to the writer at once
+IOV_MAX = 1024 # Buffers one sendmsg() takes on Linux
+
+class OutboundQueue:
+    def __init__(self, name, limit=DEFAULT_LIMIT, policy="spill", spill_directory=None,
+                 on_ready=None, on_overflow=None, metrics=None):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy {policy}")
+        self.name = name
+        self.limit = limit
+        self.policy = policy
+        self.spill_directory = spill_directory
+        self.on_ready = on_ready # Called after a frame is queued, lets an event loop wake its writer
+        self.on_overflow = on_overflow # Called once when the disconnect policy gives up on the client
+        self.metrics = metrics
+
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.taken = threading.Condition(self.lock) # Notified when the writer takes frames, see catch_up()
+        self.frames = deque()
+        self.bytes = 0 # Bytes queued in memory
+        self.closed = False
+        self.waiting = False # A writer is blocked in take()
+        self.held = 0 # While above 0 the writer is not woken, see hold()
+
+        self.spill_file = None
+        self.spill_read = 0 # Offsets into the spill file
+        self.spill_write = 0
+
+        self.frames_queued = 0
+        self.bytes_sent = 0
+        self.writes = 0 # Batches taken by the writer
+        self.dropped = 0
+        self.spilled = 0 # Bytes that went through the spill file
+        self.max_depth = 0 # Most bytes waiting at once, memory and spill file together
+        self.overflowed = False
+        self.finished = False
+
+        if metrics is not None:
+            metrics.register(self)
+
+    # Queues a frame, named like socket.sendall so presence records and handlers can treat the queue
+    # as the connection. Never blocks on the network.
+    def sendall(self, frame):
+        overflowed = False
+        with self.lock:
+            if self.closed:
+                return
+            # An event loop's writer only sleeps on an empty queue, so only the first frame needs to wake it
+            was_empty = not self.frames and self.spill_file is None
+            if self.spill_file is None and self.bytes + len(frame) <= self.limit:
+                self.frames.append(frame)
+                self.bytes += len(frame)
+            elif self.policy == "spill":
+                self.spill(frame)
+            elif self.policy == "drop":
+                self.dropped += 1
+                return
+            else:
+                self.dropped += 1
+                # The client is already being disconnected, later frames are only counted as dropped
+                if self.overflowed:
+                    return
+                overflowed = True
+                self.overflowed = True
+            if not overflowed:
+                self.frames_queued += 1
+                depth = self.depth()
+                if depth > self.max_depth:
+                    self.max_depth = depth
+                if self.waiting and not self.holding_back():
+                    self.ready.notify()
+        if overflowed:
+            if self.on_overflow is not None:
+                self.on_overflow()
+        elif was_empty and self.on_ready is not None:
+            self.on_ready()
+
+    # Once a queue spills, every later frame goes to the file too until it is drained, so order is kept
+    def spill(self, frame):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_directory)
+        os.pwrite(self.spill_file.fileno(), frame, self.spill_write)
+        self.spill_write += len(frame)
+        self.spilled += len(frame)
+
+    def depth(self):
+        return self.bytes + self.spill_write - self.spill_read
+
+    # Holds back the writer of a blocking take() while a batch of commands is handled, so their
+    # replies go out together in one write once release() is called. Replies that add up to a write,
+    # or to half the limit, are let through at once so a long batch never overflows the queue.
+    def hold(self):
+        with self.lock:
+            self.held += 1
+
+    def release(self):
+        with self.lock:
+            self.held -= 1
+            if not self.held and self.waiting and (self.frames or self.spill_file is not None or self.closed):
+                self.ready.notify()
+
+    # Called with the lock held
+    def holding_back(self):
+        return self.held and self.spill_file is None and not self.backlogged()
+
+    def backlogged(self):
+        return self.bytes >= min(MAX_WRITE, self.limit // 2)
+
+    # Called by the connection's own reader between the commands of a held batch, waits up to timeout
+    # for the writer to take what the batch has queued so far. A client pipelining commands whose replies
+    # outgrow the queue is slowed down to the pace of its writer rather than overflowing it.
+    # Frames from other connections are still only queued, sendall() never waits.
+    def catch_up(self, timeout):
+        with self.lock:
+            if self.held and self.backlogged() and not self.closed:
+                self.taken.wait(timeout)
+
+    # Returns a list of the next frames to send, up to MAX_WRITE bytes of them, [] when nothing is queued
+    # right now, or None once the queue is closed and empty. With block=True waits for data instead of returning [].
+    def take(self, block=False):
+        with self.lock:
+            while block and (self.holding_back() or not self.frames and self.spill_write == self.spill_read) and not self.closed:
+                self.waiting = True
+                self.ready.wait()
+                self.waiting = False
+            if self.frames:
+                batch = []
+                size = 0
+                while self.frames and size < MAX_WRITE:
+                    frame = self.frames.popleft()
+                    batch.append(frame)
+                    size += len(frame)
+                self.bytes -= size
+                self.bytes_sent += size
+                self.writes += 1
+                self.taken.notify_all()
+                return batch
+            if self.spill_write > self.spill_read:
+                start = self.spill_read
+                size = min(MAX_WRITE, self.spill_write - start)
+                self.spill_read += size
+                self.bytes_sent += size
+                self.writes += 1
+                data = os.pread(self.spill_file.fileno(), size, start)
+                if self.spill_read == self.spill_write:
+                    self.release_spill()
+                return [data]
+            if self.closed:
+                self.finish()
+                return None
+            return []
+
+    # Called with the lock held once nothing more will be sent, counts the queue into the closed totals
+    def finish(self):
+        self.release_spill()
+        if self.metrics is not None and not self.finished:
+            self.metrics.unregister(self)
+        self.finished = True
+
+    def release_spill(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spill_read = self.spill_write = 0
+
+    # Stops accepting frames, the writer still sends what is queued unless discard is set
+    def close(self, discard=False):
+        with self.lock:
+            self.closed = True
+            self.taken.notify_all()
+            if discard:
+                self.frames.clear()
+                self.bytes = 0
+                self.finish()
+            self.ready.notify_all()
+        if self.on_ready is not None:
+            self.on_ready()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "depth": self.depth(),
+            "queued_frames": len(self.frames),
+            "max_depth": self.max_depth,
+            "frames": self.frames_queued,
+            "bytes_sent": self.bytes_sent,
+            "writes": self.writes,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "overflowed": self.overflowed,
+        }
+
+# sendall() for a list of frames taken from a queue, sent with as few vectored writes as the kernel allows
+# The list is changed as frames go out
+def send_frames(sock, frames):
+    start = 0
+    while start < len(frames):
+        sent = sock.sendmsg(frames[start:start + IOV_MAX])
+        while start < len(frames) and sent >= len(frames[start]):
+            sent -= len(frames[start])
+            start += 1
+        if sent:
+            frames[start] = memoryview(frames[start])[sent:]
+
+# Queue depths of the open connections, plus totals that include connections already closed
+class DeliveryMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = set()
+        self.closed_totals = new_totals()
+
+    def register(self, queue):
+        with self.lock:
+            self.queues.add(queue)
+
+    def unregister(self, queue):
+        with self.lock:
+            self.queues.discard(queue)
+            add_to_totals(self.closed_totals, queue)
+
+    # Current depth of every open queue, deepest first
+    def depths(self):
+        with self.lock:
+            queues = list(self.queues)
+        return sorted(((queue.name, queue.depth()) for queue in queues), key=lambda item: item[1], reverse=True)
+
+    def totals(self):
+        with self.lock:
+            totals = dict(self.closed_totals)
+            for queue in self.queues:
+                add_to_totals(totals, queue)
+        return totals
+
+def new_totals():
+    return {"frames": 0, "bytes_sent": 0, "writes": 0, "dropped": 0, "spilled": 0, "disconnected": 0, "max_depth": 0}
+
+def add_to_totals(totals, queue):
+    totals["frames"] += queue.frames_queued
+    totals["bytes_sent"] += queue.bytes_sent
+    totals["writes"] += queue.writes
+    totals["dropped"] += queue.dropped
+    totals["spilled"] += queue.spilled
+    totals["disconnected"] += queue.overflowed
+    totals["max_depth"] = max(totals["max_depth"], queue.max_depth)
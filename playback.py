@@ -0,0 +1,287 @@
+# Live playback of /p2pvideo files while they arrive
+#
+# A client started with --play receives files as streams instead of saving them. Payloads go into a
+# jitter buffer, a ring with one slot per payload, and bytes are written to the player as soon as
+# every payload before them has arrived, so a player starts on the first payload rather than after
+# the whole file. A payload that arrives in order while nothing is held is written straight from
+# the datagram without touching the ring.
+#
+# The ring is the only memory a stream needs, --jitter-buffer bytes rounded down to whole payloads.
+# Every ack carries the receive window, the payloads that still fit in the ring, and the sender
+# never sends past it. A player that reads slower than the file arrives closes the window, the
+# sender then sends one probe per retransmission timeout, and the receiver acks again once its
+# player has taken a quarter of the ring.
+#
+# Players are a shell command reading its stdin (a new one for each stream), "-" for stdout, or
+# "tcp:PORT" for a player listening on a local TCP port. Chunk hashes are not checked on a stream,
+# a chunk would have to be held back until all of it had arrived.
+#
+# Reported for each stream: startup latency (START to the first byte written), stalls (the player
+# had everything in order and waited for a missing payload while later ones were held) and how much
+# of the ring was in use.
+import os
+import socket
+import subprocess
+import time
+
+import transfer
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+
+stdout_busy = False # stdout can only play one stream at a time
+
+class StreamStats(transfer.TransferStats):
+    __slots__ = ("buffer_size", "startup", "stalls", "stall_time", "dropped", "peak_buffer",
+                 "buffer_total", "buffer_samples", "sink_error")
+
+    def __init__(self, size, buffer_size):
+        transfer.TransferStats.__init__(self, size)
+        self.buffer_size = buffer_size
+        self.startup = None # Seconds from START to the first byte written
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.dropped = 0 # Payloads past the end of the ring
+        self.peak_buffer = 0
+        self.buffer_total = 0
+        self.buffer_samples = 0
+        self.sink_error = None
+
+    def observe_buffer(self, nbytes):
+        self.buffer_total += nbytes
+        self.buffer_samples += 1
+        if nbytes > self.peak_buffer:
+            self.peak_buffer = nbytes
+
+    def summary(self):
+        summary = transfer.TransferStats.summary(self)
+        if self.startup is not None:
+            summary += f", first byte after {self.startup * 1000:.1f} ms"
+        summary += f", {self.stalls} stalls ({self.stall_time * 1000:.0f} ms)"
+        mean = self.buffer_total / self.buffer_samples if self.buffer_samples else 0
+        summary += (f", buffer peak {self.peak_buffer / 1e6:.2f} MB and mean {mean / 1e6:.2f} MB "
+                    f"of {self.buffer_size / 1e6:.2f} MB")
+        if self.sink_error:
+            summary += f", player stopped reading: {self.sink_error}"
+        return summary
+
+# Writes to a file descriptor without blocking, returns how much was written
+class FileSink:
+    def __init__(self, fd):
+        self.fd = fd
+        os.set_blocking(fd, False)
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, view):
+        try:
+            return os.write(self.fd, view)
+        except BlockingIOError:
+            return 0
+
+    def close(self):
+        os.close(self.fd)
+
+class StdoutSink(FileSink):
+    def __init__(self):
+        global stdout_busy
+        if stdout_busy:
+            raise OSError("stdout is playing another stream")
+        stdout_busy = True
+        FileSink.__init__(self, 1)
+
+    # stdout stays open for the next stream
+    def close(self):
+        global stdout_busy
+        os.set_blocking(self.fd, True)
+        stdout_busy = False
+
+# A player started for one stream, reading it from its stdin
+class ProcessSink(FileSink):
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        FileSink.__init__(self, self.process.stdin.fileno())
+
+    # The player keeps running until it has played what it was sent
+    def close(self):
+        self.process.stdin.close()
+
+class SocketSink:
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=2)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, view):
+        try:
+            return self.sock.send(view)
+        except BlockingIOError:
+            return 0
+
+    def close(self):
+        self.sock.close()
+
+# "-" for stdout, "tcp:PORT" for a local socket, anything else is a shell command
+def open_sink(spec):
+    if spec == "-":
+        return StdoutSink()
+    if spec.startswith("tcp:"):
+        return SocketSink(int(spec[4:]))
+    return ProcessSink(spec)
+
+# State of one file being played, the ring replaces the mapped output file of IncomingTransfer
+class IncomingStream(transfer.IncomingTransfer):
+    __slots__ = ("sink", "buffer_size", "slots", "ring", "ring_view", "flags", "played", "played_offset",
+                 "held", "stall_started", "closed")
+
+    def __init__(self, *args, sink, buffer_size=DEFAULT_BUFFER_SIZE):
+        transfer.IncomingTransfer.__init__(self, *args)
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.slots = max(min(buffer_size // self.payload_size, transfer.MAX_WINDOW), 1)
+        self.ring = None
+        self.ring_view = None
+        self.flags = None # 1 for the slots that hold a payload
+        self.played = 0 # Payloads written to the player, everything below it has left the ring
+        self.played_offset = 0 # Bytes of payload number played already written
+        self.held = 0 # Payloads in the ring
+        self.stall_started = None
+        self.closed = False
+        self.stats = StreamStats(self.size, self.slots * self.payload_size)
+
+    def ready(self):
+        return self.ring is not None
+
+    # Played, not saved
+    def disk_needed(self):
+        return 0
+
+    # Nothing on disk is picked up, HAVE answers that no chunk is here yet
+    def open(self):
+        self.ring = bytearray(self.slots * self.payload_size)
+        self.ring_view = memoryview(self.ring)
+        self.flags = bytearray(self.slots)
+
+    def store(self, seq, payload):
+        slots = self.slots
+        payload_size = self.payload_size
+        if seq < self.cum or (seq < self.played + slots and self.flags[seq % slots]):
+            self.stats.duplicates += 1
+            return
+        if seq >= self.played + slots:
+            # Past the end of the ring, a sender only sends it to probe a closed window
+            self.stats.dropped += 1
+            return
+        length = len(payload)
+        if length > payload_size or seq * payload_size + length > self.size:
+            return
+        self.stats.datagrams += 1
+        if seq > self.highest:
+            self.highest = seq
+
+        written = 0
+        if seq == self.cum == self.played:
+            # In order with nothing held, straight from the datagram to the player
+            written = self.write(payload)
+        if written == length:
+            self.played += 1
+        else:
+            slot = seq % slots
+            self.ring[slot * payload_size:slot * payload_size + length] = payload
+            self.flags[slot] = 1
+            self.held += 1
+            if seq == self.played:
+                self.played_offset = written
+
+        cum = self.cum
+        end = min(self.total, self.played + slots)
+        while self.cum < end and (self.cum < self.played or self.flags[self.cum % slots]):
+            self.cum += 1
+        if self.cum > cum:
+            if self.stall_started is not None:
+                self.stats.stall_time += time.monotonic() - self.stall_started
+                self.stall_started = None
+            self.drain()
+        elif self.played == self.cum and self.stats.startup is not None and self.stall_started is None:
+            # The player has everything in order and a later payload came first
+            self.stall_started = time.monotonic()
+            self.stats.stalls += 1
+        self.stats.observe_buffer(self.held * payload_size)
+
+    # Writes the payloads that are in order, as far as the player takes them without blocking
+    def drain(self):
+        payload_size = self.payload_size
+        while self.played < self.cum:
+            first = self.played % self.slots
+            run = min(self.cum - self.played, self.slots - first)
+            start = first * payload_size + self.played_offset
+            end = (first + run) * payload_size
+            if self.played + run == self.total:
+                end -= self.total * payload_size - self.size
+            written = self.write(self.ring_view[start:end])
+            if start + written == end:
+                done, self.played_offset = run, 0
+            else:
+                done, self.played_offset = divmod(self.played_offset + written, payload_size)
+            self.flags[first:first + done] = bytes(done)
+            self.held -= done
+            self.played += done
+            if start + written < end:
+                return
+
+    # A player that went away is not an error for the transfer, the rest of the file is dropped
+    def write(self, view):
+        if self.stats.sink_error:
+            return len(view)
+        try:
+            written = self.sink.write(view)
+        except OSError as error:
+            self.stats.sink_error = error.strerror or str(error)
+            return len(view)
+        if written and self.stats.startup is None:
+            self.stats.startup = time.monotonic() - self.stats.started
+        return written
+
+    def window(self):
+        return max(self.played + self.slots - self.cum, 0)
+
+    def sack(self):
+        if self.highest <= self.cum:
+            return b""
+        start = self.cum + 1
+        count = min(self.played + self.slots, self.total) - start
+        if count <= 0:
+            return b""
+        first = start % self.slots
+        if first + count <= self.slots:
+            flags = self.flags[first:first + count]
+        else:
+            flags = self.flags[first:] + self.flags[:first + count - self.slots]
+        return transfer.encode_sack(flags, 0, count)
+
+    def waiting(self):
+        return self.played < self.cum
+
+    def finish(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.ring_view is not None:
+            self.ring_view.release()
+        self.sink.close()
+
+# Returns the incoming argument of TransferReceiver for a client that plays files
+# A file is saved as usual if its player cannot be started
+def player(spec, buffer_size=DEFAULT_BUFFER_SIZE):
+    def incoming(*args):
+        try:
+            sink = open_sink(spec)
+        except OSError:
+            return transfer.IncomingTransfer(*args)
+        return IncomingStream(*args, sink=sink, buffer_size=buffer_size)
+    return incoming
@@ -0,0 +1,198 @@
+# Registry of logged in users, replaces the connected_clients dict of 4 element lists
+#
+# Each user gets a slot number when they log in and keeps it until they log out, freed slots
+# are reused smallest first. Logging in or out is a dict update and a heap operation under a lock.
+# userlog.txt is no longer edited on every login and logout, a snapshot thread rewrites it from
+# the registry when something changed, at most once per interval.
+#
+# The registry also keeps usernames in sorted order with each user's /activeuser line cached, so a
+# page of /activeuser is a slice rather than a pass over every user. Connections can subscribe to
+# presence: they get one snapshot frame, then a small frame for every change, each frame encoded
+# once and queued for every subscriber:
+#   presence snapshot VERSION LINE...   the /activeuser line of every logged in user
+#   presence join VERSION LINE          a user logged in
+#   presence update VERSION LINE        a user logged in again or reported a new UDP port
+#   presence leave VERSION USERNAME     a user logged out or disconnected
+# Other registries that follow presence, such as the group registry, add a listener that is called
+# with "join" or "leave" and the username, with the lock held.
+import bisect
+import heapq
+import os
+import threading
+
+import protocol
+
+class Presence:
+    __slots__ = ("username", "client_socket", "timestamp", "ip_address", "udp_port", "slot", "activeuser_line")
+
+    def __init__(self, username, client_socket, timestamp, ip_address, udp_port, slot):
+        self.username = username
+        self.client_socket = client_socket
+        self.timestamp = timestamp
+        self.ip_address = ip_address
+        self.udp_port = udp_port
+        self.slot = slot
+        self.activeuser_line = f"{username}; {ip_address}; {udp_port}; active since {timestamp}."
+
+    def userlog_line(self):
+        return f"{self.slot}; {self.timestamp}; {self.username}; {self.ip_address}; {self.udp_port}\n"
+
+class PresenceRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {} # username -> Presence
+        self.free_slots = [] # heap of slot numbers given back by logouts
+        self.next_slot = 1
+        self.version = 0 # Bumped on every change so snapshots know when to write
+        self.order = [] # Usernames in sorted order, for paging
+        self.subscribers = set() # Connections that get every change pushed to them
+        self.listeners = [] # Functions called with (kind, username) on every login and logout
+
+    # Adds a user, a user who logs in again from a new connection keeps their slot
+    def login(self, username, client_socket, timestamp, ip_address, udp_port):
+        with self.lock:
+            previous = self.users.get(username)
+            if previous is not None:
+                slot = previous.slot
+            elif self.free_slots:
+                slot = heapq.heappop(self.free_slots)
+            else:
+                slot = self.next_slot
+                self.next_slot += 1
+            record = Presence(username, client_socket, timestamp, ip_address, udp_port, slot)
+            self.users[username] = record
+            self.version += 1
+            if previous is None:
+                bisect.insort(self.order, username)
+                self.notify("join", record.activeuser_line)
+                for listener in self.listeners:
+                    listener("join", username)
+            elif previous.activeuser_line != record.activeuser_line or previous.client_socket is not client_socket:
+                self.notify("update", record.activeuser_line)
+            return record
+
+    # Removes a user, if client_socket is given only while that connection still owns the session
+    def logout(self, username, client_socket=None):
+        with self.lock:
+            record = self.users.get(username)
+            if record is None or (client_socket is not None and record.client_socket is not client_socket):
+                return None
+            del self.users[username]
+            heapq.heappush(self.free_slots, record.slot)
+            del self.order[bisect.bisect_left(self.order, username)]
+            self.version += 1
+            self.notify("leave", username)
+            for listener in self.listeners:
+                listener("leave", username)
+            return record
+
+    # Records the UDP port a client reported, only for the connection that owns the session
+    def set_udp_port(self, username, client_socket, udp_port):
+        with self.lock:
+            record = self.users.get(username)
+            if record is None or record.client_socket is not client_socket:
+                return False
+            self.update_udp_port(record, udp_port)
+            return True
+
+    # Call with the lock held
+    def update_udp_port(self, record, udp_port):
+        record.udp_port = udp_port
+        record.activeuser_line = f"{record.username}; {record.ip_address}; {udp_port}; active since {record.timestamp}."
+        self.version += 1
+        self.notify("update", record.activeuser_line)
+
+    # Call with the lock held, so subscribers see changes in the order they happened
+    def notify(self, kind, field):
+        if self.subscribers:
+            frame = protocol.encode("presence", kind, self.version, field)
+            for client_socket in self.subscribers:
+                client_socket.sendall(frame)
+
+    # Sends the current users, then every change, to a connection
+    def subscribe(self, client_socket):
+        with self.lock:
+            lines = [self.users[username].activeuser_line for username in self.order]
+            client_socket.sendall(protocol.encode("presence", "snapshot", self.version, *lines))
+            self.subscribers.add(client_socket)
+
+    def unsubscribe(self, client_socket):
+        with self.lock:
+            self.subscribers.discard(client_socket)
+
+    # /activeuser lines of the users at positions offset to offset + count in username order,
+    # leaving out exclude. Returns the lines and how many users there are besides exclude.
+    def page(self, offset, count, exclude=None):
+        with self.lock:
+            order = self.order
+            position = bisect.bisect_left(order, exclude) if exclude in self.users else len(order)
+            if position >= offset + count:
+                names = order[offset:offset + count]
+            elif position < offset:
+                names = order[offset + 1:offset + 1 + count]
+            else:
+                names = order[offset:position] + order[position + 1:offset + count + 1]
+            others = len(order) - (position < len(order))
+            return [self.users[username].activeuser_line for username in names], others
+
+    def get(self, username):
+        return self.users.get(username)
+
+    # Sends one encoded frame to each of the users who is logged in
+    def send_to(self, usernames, frame):
+        for username in usernames:
+            record = self.users.get(username)
+            if record is not None:
+                record.client_socket.sendall(frame)
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    # Copy of the current records, safe to iterate while other threads log in and out
+    def snapshot(self):
+        with self.lock:
+            return list(self.users.values())
+
+    def userlog_lines(self):
+        with self.lock:
+            version = self.version
+            records = sorted(self.users.values(), key=lambda record: record.slot)
+        return version, [record.userlog_line() for record in records]
+
+# Keeps a file such as userlog.txt in step with the registry
+# Writes go to a temporary file that replaces the old one, so readers never see half a snapshot
+class UserlogSnapshot:
+    def __init__(self, registry, path="userlog.txt", interval=1.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.written_version = -1
+        self.writes = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="userlog-snapshot", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.registry.version == self.written_version:
+            return
+        version, lines = self.lines()
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.writelines(lines)
+        os.replace(temporary_path, self.path)
+        self.written_version = version
+        self.writes += 1
+
+    def lines(self):
+        return self.registry.userlog_lines()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,355 @@
+# Wire protocol shared by server.py and client.py
+#
+# Every message on the TCP connection is one frame:
+#   header:  version (1 byte), command code (1 byte), field count (2 bytes), payload length (4 bytes),
+#            request id (4 bytes)
+#   payload: the command fields, each one a type tag (1 byte) followed by its value
+#            's' UTF-8 string and 'b' raw bytes carry a 4 byte length, 'i' is an 8 byte signed integer
+# Frames carry their own length so any number of them can be read with a single recv()
+# and a frame larger than one read is put back together before it is parsed
+#
+# A client numbers its requests and the server puts the same request id on its reply, so a client
+# can wait on the reply to one request while other frames arrive. Frames the server pushes, such
+# as msg_recieve, carry request id 0. Version 2 added the request id.
+#
+# A client may offer compression at login, see Compressor. Once the server has picked it, each
+# side compresses what it writes into "compressed" frames. Such a frame has no fields, its payload
+# is a method byte (STORED or DEFLATED, raw deflate with the preset DICTIONARY) and the bytes of the
+# frames inside it. Those frames are one stream of their own, a frame may begin in one compressed
+# frame and end in the next, so a writer can compress whatever it has queued however it was cut.
+# Plain frames only come between compressed ones where that stream is between two frames.
+import struct
+import threading
+import time
+import zlib
+
+PROTOCOL_VERSION = 2
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Larger payloads are rejected as a protocol error
+RECV_SIZE = 65536 # Frames are length prefixed so sockets can be read in large blocks
+
+HEADER = struct.Struct("!BBHII")
+FIELD_LENGTH = struct.Struct("!I")
+FIELD_INT = struct.Struct("!q")
+
+# Command names as they appear in the client and server code, the position is the code on the wire
+# New commands are only ever appended so older codes keep their meaning
+COMMANDS = (
+    # Client requests
+    "credentials", "Log", "/msgto", "/activeuser", "/creategroup",
+    "/joingroup", "/groupmsg", "/p2pvideo", "/logout",
+    # Server replies and pushes
+    "login", "msg_sent", "msg_recieve", "groupmsg_recieve", "msgto", "activeuser",
+    "creategroup", "joingroup", "groupmsg", "p2pvideo", "logout",
+    # Between the broker and the worker processes of a multi-core server, see broker.py
+    "@hello", "@login", "@logout", "@udpport", "@block", "@creategroup", "@group",
+    "@join", "@reply", "@route", "@deliver", "@log",
+    "@history", "@delivered",
+    # Admin request and its reply
+    "/stats", "stats",
+    # Presence subscriptions, see presence.py
+    "/subscribe", "/unsubscribe", "presence",
+    # One file to a whole group, see transfer.send_file_to_group()
+    "/groupvideo", "groupvideo",
+    # Server relay for /p2pvideo, see relay.py
+    "/relay", "relay",
+    # Sent by a quiet client so the server does not reap its connection
+    "/heartbeat",
+    # Chat history, see history.py
+    "/history", "history",
+    # Frames compressed together, see Compressor
+    "compressed",
+    # Server state kept across restarts, see state.py: journal records, the broker's session request,
+    # and the client's request to resume its session after a reconnect
+    "@blocked", "@session", "@endsession", "@resume", "resume",
+    # A worker tells the broker that a connection on a session dropped, see StateStore.detach()
+    "@detach",
+    # Reply to a request the server could not handle, so a client waiting on it does not time out
+    "error",
+    # Failed and successful logins on a worker, counted by the broker so every worker sees the same count
+    "@failure", "@success",
+)
+COMMAND_CODES = {name: code for code, name in enumerate(COMMANDS)}
+
+COMPRESSED_CODE = COMMAND_CODES["compressed"]
+
+COMPRESSION_METHODS = ("zlib",) # Offered by a client at login, the server picks one of them or none
+COMPRESSION_THRESHOLD = 128 # Writes smaller than this are sent as plain frames
+STORED = 0
+DEFLATED = 1
+MAX_PIECE = 1024 * 1024 # Bytes of frames per compressed frame
+MIN_SAVING = 0.1 # Deflated data has to be this much smaller than the frames, or they are sent stored
+MAX_SKIP = 64 # Writes sent stored without trying, after data that did not compress
+SMALL_PIECE = 4096 # Pieces up to this size are deflated with a 4 KB window, which sets up three times faster
+
+class ProtocolError(Exception):
+    pass
+
+# A decoded frame, the fields are parsed once so handlers never split strings
+class Command:
+    __slots__ = ("name", "args", "request_id")
+
+    def __init__(self, name, args, request_id=0):
+        self.name = name
+        self.args = args
+        self.request_id = request_id
+
+    def __repr__(self):
+        return f"Command({self.name!r}, {self.args!r}, request_id={self.request_id})"
+
+# Builds one frame from a command name and its fields (str, bytes or int)
+def encode(name, *args, request_id=0):
+    parts = []
+    for arg in args:
+        if isinstance(arg, str):
+            data = arg.encode()
+            parts.append(b"s" + FIELD_LENGTH.pack(len(data)) + data)
+        elif isinstance(arg, int):
+            parts.append(b"i" + FIELD_INT.pack(arg))
+        else:
+            parts.append(b"b" + FIELD_LENGTH.pack(len(arg)) + bytes(arg))
+    payload = b"".join(parts)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame for {name} is too large ({len(payload)} bytes)")
+    return HEADER.pack(PROTOCOL_VERSION, COMMAND_CODES[name], len(args), len(payload), request_id) + payload
+
+# Parses the fields of one frame payload
+def decode_fields(payload, field_count):
+    args = []
+    offset = 0
+    for _ in range(field_count):
+        tag = payload[offset]
+        offset += 1
+        if tag == 0x69: # 'i'
+            args.append(FIELD_INT.unpack_from(payload, offset)[0])
+            offset += FIELD_INT.size
+            continue
+        (length,) = FIELD_LENGTH.unpack_from(payload, offset)
+        offset += FIELD_LENGTH.size
+        value = payload[offset:offset + length]
+        offset += length
+        if tag == 0x73: # 's'
+            args.append(str(value, "utf-8"))
+        elif tag == 0x62: # 'b'
+            args.append(bytes(value))
+        else:
+            raise ProtocolError(f"Unknown field type {tag}")
+    if offset != len(payload):
+        raise ProtocolError("Frame payload does not match its fields")
+    return tuple(args)
+
+# Streaming decoder, feed() takes whatever recv() returned and gives back every complete frame in it
+# Any trailing partial frame is kept until the rest of it arrives
+# Compressed frames are unpacked into a decoder of their own, which keeps a frame that goes on
+# in the next compressed frame
+class FrameDecoder:
+    def __init__(self, inner=False):
+        self.buffer = bytearray()
+        self.inner = inner
+        self.unpacked = None # Decoder of the frames inside compressed frames, made for the first one
+        self.packed_bytes = 0 # Payload bytes of the compressed frames and of the frames inside them
+        self.unpacked_bytes = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        commands = []
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            version, code, field_count, length, request_id = HEADER.unpack_from(buffer, offset)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}")
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame is too large ({length} bytes)")
+            if code >= len(COMMANDS):
+                raise ProtocolError(f"Unknown command code {code}")
+            end = offset + HEADER.size + length
+            if end > len(buffer):
+                break
+            if code == COMPRESSED_CODE and not self.inner:
+                if self.unpacked is None:
+                    self.unpacked = FrameDecoder(inner=True)
+                with memoryview(buffer) as view:
+                    frames = unpack(view[offset + HEADER.size:end])
+                self.packed_bytes += length
+                self.unpacked_bytes += len(frames)
+                commands.extend(self.unpacked.feed(frames))
+                offset = end
+                continue
+            if code == COMPRESSED_CODE or (self.unpacked is not None and self.unpacked.buffer):
+                raise ProtocolError("Frame inside another frame")
+            try:
+                with memoryview(buffer) as view:
+                    args = decode_fields(view[offset + HEADER.size:end], field_count)
+            except (IndexError, struct.error, UnicodeDecodeError) as error:
+                raise ProtocolError(f"Malformed {COMMANDS[code]} frame: {error}")
+            commands.append(Command(COMMANDS[code], args, request_id))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return commands
+
+# The frames inside one compressed frame
+def unpack(payload):
+    if not payload:
+        raise ProtocolError("Empty compressed frame")
+    if payload[0] == STORED:
+        return bytes(payload[1:])
+    if payload[0] != DEFLATED:
+        raise ProtocolError(f"Unknown compression method {payload[0]}")
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DICTIONARY)
+    try:
+        frames = inflater.decompress(payload[1:], MAX_PIECE)
+    except zlib.error as error:
+        raise ProtocolError(f"Damaged compressed frame: {error}")
+    if not inflater.eof or inflater.unconsumed_tail:
+        raise ProtocolError("Compressed frame is cut short or too large")
+    return frames
+
+def compressed_frame(method, data):
+    return HEADER.pack(PROTOCOL_VERSION, COMPRESSED_CODE, 0, 1 + len(data), 0) + bytes((method,)) + data
+
+# Preset dictionary for deflate, strings that chat frames share so that even a single short frame
+# compresses. Deflate reaches the end of the dictionary with the shortest distances, so the most
+# common strings go last.
+DICTIONARY = b"".join((
+    b"Error: User  is not a member of group  has not joined group  is not logged in. is not online. ",
+    b"Group  created successfully. Group members:  Older messages: /history No other active users. ",
+    b" (sent while you were offline) message queued at  gets it when they log in",
+    b"Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec 2025 2026 2027 ",
+    encode("presence", "login", 0, ""),
+    encode("activeuser", "user, 127.0.0.1, 00:00:00"),
+    encode("msg_sent", "message sent at 01 Jan 2026 00:00:00"),
+    encode("groupmsg", "Group message sent at 01 Jan 2026 00:00:00"),
+    encode("groupmsg_recieve", "01 Jan 2026 00:00:00, group, user: "),
+    encode("msg_recieve", "01 Jan 2026 00:00:00, user: "),
+))
+
+# Bytes in and out of the Compressors of a process, and the CPU time they took
+class CompressionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.plain = 0 # Writes sent as they were
+        self.stored = 0 # Compressed frames sent stored
+        self.deflated = 0
+        self.incompressible = 0 # Deflated, but not enough smaller to be worth it
+        self.cpu_seconds = 0.0
+        self.received_packed = 0 # Payloads of compressed frames received, and the frames in them
+        self.received_unpacked = 0
+
+    def add(self, bytes_in, bytes_out, plain, stored, deflated, incompressible, cpu_seconds):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.plain += plain
+            self.stored += stored
+            self.deflated += deflated
+            self.incompressible += incompressible
+            self.cpu_seconds += cpu_seconds
+
+    # Counts of a FrameDecoder whose connection closed
+    def add_received(self, decoder):
+        with self.lock:
+            self.received_packed += decoder.packed_bytes
+            self.received_unpacked += decoder.unpacked_bytes
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+                "plain_writes": self.plain,
+                "stored": self.stored,
+                "deflated": self.deflated,
+                "incompressible": self.incompressible,
+                "cpu_s": round(self.cpu_seconds, 3),
+                "cpu_us_per_kb": round(self.cpu_seconds * 1e6 / (self.bytes_in / 1024), 2) if self.bytes_in else None,
+                "received_packed": self.received_packed,
+                "received_unpacked": self.received_unpacked,
+            }
+
+    def summary(self):
+        snapshot = self.snapshot()
+        summary = (f"sent {snapshot['bytes_in']} bytes as {snapshot['bytes_out']} "
+                   f"({snapshot['deflated']} deflated, {snapshot['stored']} stored, {snapshot['plain_writes']} plain, "
+                   f"{snapshot['incompressible']} did not compress, {snapshot['cpu_s']:.3f} CPU s)")
+        if self.received_packed:
+            summary += f", received {self.received_unpacked} bytes as {self.received_packed}"
+        return summary
+
+# Compresses everything one side of a connection writes, from one thread
+# A write smaller than the threshold that holds whole frames goes out as it is. Larger ones are
+# deflated in pieces of up to MAX_PIECE, and a piece that does not get MIN_SAVING smaller is sent
+# stored. After that the next writes are stored without trying, twice as many each time it happens
+# again up to MAX_SKIP, so data that does not compress costs little CPU.
+class Compressor:
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, stats=None, level=6):
+        self.threshold = threshold
+        self.stats = stats if stats is not None else CompressionStats()
+        self.level = level
+        self.owed = 0 # Bytes still to come of the last frame the previous write began
+        self.head = b"" # Part of a header the previous write ended in
+        self.skip = 0
+        self.backoff = 1
+
+    def compress(self, data):
+        started = time.thread_time()
+        aligned = not self.owed and not self.head
+        self.follow(data)
+        if len(data) < self.threshold and aligned and not self.owed and not self.head:
+            self.stats.add(len(data), len(data), 1, 0, 0, 0, time.thread_time() - started)
+            return data
+        parts = []
+        stored = deflated = incompressible = 0
+        with memoryview(data) as view:
+            for offset in range(0, len(data), MAX_PIECE):
+                piece = view[offset:offset + MAX_PIECE]
+                packed = self.deflate(piece) if len(piece) >= self.threshold else None
+                if packed is False:
+                    incompressible += 1
+                if packed:
+                    parts.append(compressed_frame(DEFLATED, packed))
+                    deflated += 1
+                else:
+                    parts.append(compressed_frame(STORED, bytes(piece)))
+                    stored += 1
+        data_out = parts[0] if len(parts) == 1 else b"".join(parts)
+        self.stats.add(len(data), len(data_out), 0, stored, deflated, incompressible, time.thread_time() - started)
+        return data_out
+
+    # Returns the deflated piece, None when it was not tried and False when it did not pay
+    def deflate(self, piece):
+        if self.skip:
+            self.skip -= 1
+            return None
+        if len(piece) <= SMALL_PIECE:
+            deflater = zlib.compressobj(self.level, zlib.DEFLATED, -12, 4, zdict=DICTIONARY)
+        else:
+            deflater = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=DICTIONARY)
+        packed = deflater.compress(piece) + deflater.flush()
+        if len(packed) > len(piece) * (1 - MIN_SAVING):
+            self.skip = self.backoff
+            self.backoff = min(self.backoff * 2, MAX_SKIP)
+            return False
+        self.backoff = 1
+        return packed
+
+    # Walks the frame headers in data to know where the next write starts
+    def follow(self, data):
+        offset = self.owed
+        if self.head:
+            header = self.head + bytes(data[:HEADER.size - len(self.head)])
+            if len(header) < HEADER.size:
+                self.head = header
+                return
+            offset = HEADER.size - len(self.head) + HEADER.unpack(header)[3]
+            self.head = b""
+        while offset + HEADER.size <= len(data):
+            offset += HEADER.size + HEADER.unpack_from(data, offset)[3]
+        if offset < len(data):
+            self.head = bytes(data[offset:])
+            self.owed = 0
+        else:
+            self.owed = offset - len(data)
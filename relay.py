@@ -0,0 +1,260 @@
+# Relays /p2pvideo datagrams through the server when the presenter cannot reach the audience
+#
+# A relay is one UDP socket on the server, opened by /relay for one presenter and one audience. The
+# presenter sends to the relay's port instead of the audience's, and the relay sends every datagram
+# on from the same socket, so the audience's acks come back to it and go on to the presenter. The
+# relay never looks inside the datagrams, transfer.py works through it unchanged. Only datagrams
+# from the presenter's IP address are relayed, acks go to wherever the presenter last sent from, so
+# one relay carries one transfer at a time. A relay closes once it has been idle for IDLE_TIMEOUT.
+# A user has at most MAX_RELAYS_PER_USER relays open, so one user cannot take every relay.
+#
+# Every relay runs on one thread with a select loop. Each relay has a ring of preallocated buffers
+# that datagrams are read into with recvfrom_into() and sent from, so nothing is allocated per
+# datagram. Datagrams towards the audience are paced by two token buckets, one for the relay
+# (--relay-rate) and one shared by all relays (--relay-budget), so relays together cannot take the
+# CPU and the bandwidth the chat connections need. Relays take turns one datagram at a time, so one
+# busy relay does not use the whole budget.
+#
+# A relay whose ring is full stops reading its socket. Datagrams then wait in the kernel's socket
+# buffer and are dropped once it is full, which the sender sees as loss and slows down for. Acks
+# towards the presenter are small and go out as soon as they arrive, they are only charged to the
+# buckets.
+import select
+import socket
+import threading
+import time
+
+import transfer
+
+RING_SLOTS = 32 # Datagrams held per relay, each slot is as large as a UDP datagram can be
+DEFAULT_RATE = 20 * 1000 * 1000 # Bytes per second through one relay
+DEFAULT_BUDGET = 50 * 1000 * 1000 # Bytes per second through all relays together
+DEFAULT_MAX_RELAYS = 16
+MAX_RELAYS_PER_USER = 2
+BURST = 0.02 # Seconds of its rate a bucket can send at once
+IDLE_TIMEOUT = 5.0 # Seconds without a datagram before a relay is closed and its slot freed
+IDLE_CHECK_INTERVAL = 1.0
+
+class RelayError(Exception):
+    pass
+
+# Allows rate bytes per second on average and up to BURST seconds of them at once, 0 is no limit
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate * BURST, transfer.MAX_DATAGRAM)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    # Seconds until nbytes may be sent, 0 if they may be sent now
+    def delay(self, nbytes, now):
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.capacity)
+        self.updated = now
+        if self.tokens >= nbytes:
+            return 0.0
+        return (nbytes - self.tokens) / self.rate
+
+    # May go below zero, acks are sent whatever the bucket holds
+    def consume(self, nbytes):
+        if self.rate:
+            self.tokens -= nbytes
+
+# One presenter to one audience
+class Relay:
+    def __init__(self, host, presenter_ip, audience, rate, slots=RING_SLOTS, owner=None):
+        self.owner = owner # Username of the presenter who opened it
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.presenter_ip = presenter_ip
+        self.presenter = None # Address of the presenter's socket, from its last datagram
+        self.audience = audience
+        self.bucket = TokenBucket(rate)
+        self.buffer = bytearray(slots * transfer.MAX_DATAGRAM)
+        view = memoryview(self.buffer)
+        self.slots = [view[index * transfer.MAX_DATAGRAM:(index + 1) * transfer.MAX_DATAGRAM] for index in range(slots)]
+        self.lengths = [0] * slots
+        self.head = 0 # Oldest datagram in the ring
+        self.queued = 0
+        self.blocked = False # The socket buffer was full, waits until the socket is writable
+        self.last_active = time.monotonic()
+
+        self.datagrams = 0 # Relayed to the audience
+        self.bytes = 0
+        self.acks = 0 # Relayed to the presenter
+        self.refused = 0 # From neither the presenter nor the audience
+        self.full = 0 # Times the ring filled up
+
+    def ring_full(self):
+        return self.queued == len(self.slots)
+
+    # Reads until the socket is empty or the ring is full
+    def read(self, budget):
+        slots = self.slots
+        while self.queued < len(slots):
+            slot = (self.head + self.queued) % len(slots)
+            try:
+                nbytes, address = self.sock.recvfrom_into(slots[slot])
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                # One of the peers went away, the transfer's own timeouts deal with that
+                continue
+            self.last_active = time.monotonic()
+            if address == self.audience:
+                if self.presenter is not None:
+                    try:
+                        self.sock.sendto(slots[slot][:nbytes], self.presenter)
+                    except (BlockingIOError, ConnectionRefusedError):
+                        pass # A lost ack, the next one covers it
+                    self.bucket.consume(nbytes)
+                    budget.consume(nbytes)
+                    self.acks += 1
+            elif address[0] == self.presenter_ip:
+                self.presenter = address
+                self.lengths[slot] = nbytes
+                self.queued += 1
+            else:
+                self.refused += 1
+        self.full += 1
+
+    # Sends the oldest datagram in the ring to the audience
+    # Returns 0 once it was sent, the seconds to wait when a bucket is empty, None if the socket is full
+    def forward(self, budget, now):
+        nbytes = self.lengths[self.head]
+        wait = max(self.bucket.delay(nbytes, now), budget.delay(nbytes, now))
+        if wait:
+            return wait
+        try:
+            self.sock.sendto(self.slots[self.head][:nbytes], self.audience)
+        except BlockingIOError:
+            self.blocked = True
+            return None
+        except ConnectionRefusedError:
+            pass # Dropped, the audience's port was closed
+        self.bucket.consume(nbytes)
+        budget.consume(nbytes)
+        self.datagrams += 1
+        self.bytes += nbytes
+        self.head = (self.head + 1) % len(self.slots)
+        self.queued -= 1
+        return 0.0
+
+    def close(self):
+        self.sock.close()
+
+# Every relay of this server process and the thread that runs them
+class RelayServer:
+    def __init__(self, host, rate=DEFAULT_RATE, budget=DEFAULT_BUDGET, max_relays=DEFAULT_MAX_RELAYS):
+        self.host = host
+        self.rate = rate
+        self.budget = TokenBucket(budget)
+        self.max_relays = max_relays
+        self.lock = threading.Lock()
+        self.relays = {} # socket -> Relay
+        self.stopped = False
+        # Wakes the select loop when a relay is opened
+        self.wakeup_read, self.wakeup_write = socket.socketpair()
+        self.wakeup_read.setblocking(False)
+
+        self.opened = 0
+        self.rejected = 0 # /relay requests over max_relays or a user's share
+        self.closed_totals = {"datagrams": 0, "bytes": 0, "acks": 0, "refused": 0, "full": 0}
+        self.thread = threading.Thread(target=self.run, name="relay", daemon=True)
+        self.thread.start()
+
+    # Returns the port the presenter sends to
+    def open(self, presenter_ip, audience, owner=None):
+        with self.lock:
+            if len(self.relays) >= self.max_relays:
+                self.rejected += 1
+                raise RelayError(f"All {self.max_relays} relays are in use, try again later.")
+            if owner is not None and sum(relay.owner == owner for relay in self.relays.values()) >= MAX_RELAYS_PER_USER:
+                self.rejected += 1
+                raise RelayError(f"You already have {MAX_RELAYS_PER_USER} relays open, try again once a transfer is done.")
+            relay = Relay(self.host, presenter_ip, audience, self.rate, owner=owner)
+            self.relays[relay.sock] = relay
+            self.opened += 1
+        self.wakeup_write.send(b"\0")
+        return relay.port
+
+    def run(self):
+        next_idle_check = time.monotonic() + IDLE_CHECK_INTERVAL
+        while not self.stopped:
+            now = time.monotonic()
+            if now >= next_idle_check:
+                self.expire_idle(now)
+                next_idle_check = now + IDLE_CHECK_INTERVAL
+            with self.lock:
+                relays = list(self.relays.values())
+            wait = self.forward(relays, now)
+            readers = [self.wakeup_read] + [relay.sock for relay in relays if not relay.ring_full()]
+            writers = [relay.sock for relay in relays if relay.blocked]
+            timeout = max(min(wait, next_idle_check - now) if wait is not None else next_idle_check - now, 0)
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+            for sock in writable:
+                self.relays[sock].blocked = False
+            for sock in readable:
+                if sock is self.wakeup_read:
+                    try:
+                        sock.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.relays[sock].read(self.budget)
+
+    # Relays take turns one datagram at a time until every ring is empty or has to wait
+    # Returns the seconds until a bucket lets the next datagram through, None if nothing waits on one
+    def forward(self, relays, now):
+        wait = None
+        turn = [relay for relay in relays if relay.queued and not relay.blocked]
+        while turn:
+            next_turn = []
+            for relay in turn:
+                delay = relay.forward(self.budget, now)
+                if delay == 0:
+                    if relay.queued:
+                        next_turn.append(relay)
+                elif delay is not None:
+                    wait = delay if wait is None else min(wait, delay)
+            turn = next_turn
+        return wait
+
+    # Only this thread closes relays, so the ones selected on are still open
+    def expire_idle(self, now):
+        with self.lock:
+            idle = [relay for relay in self.relays.values() if now - relay.last_active > IDLE_TIMEOUT]
+            for relay in idle:
+                self.retire(relay)
+
+    # Keeps the counts of a relay that is going away, called with the lock held
+    def retire(self, relay):
+        del self.relays[relay.sock]
+        for name in self.closed_totals:
+            self.closed_totals[name] += getattr(relay, name)
+        relay.close()
+
+    # Counts for /stats and the shutdown summary
+    def totals(self):
+        with self.lock:
+            totals = dict(self.closed_totals)
+            for relay in self.relays.values():
+                for name in totals:
+                    totals[name] += getattr(relay, name)
+            totals["open"] = len(self.relays)
+            totals["opened"] = self.opened
+            totals["rejected"] = self.rejected
+        return totals
+
+    def close(self):
+        self.stopped = True
+        self.wakeup_write.send(b"\0")
+        self.thread.join()
+        with self.lock:
+            for relay in list(self.relays.values()):
+                self.retire(relay)
+        self.wakeup_read.close()
+        self.wakeup_write.close()
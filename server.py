@@ -2,378 +2,1184 @@
 import sys
 import socket
 import time
+import asyncio
+import argparse
+import resource
 from threading import Thread
 from datetime import datetime
 import os.path
 import signal
+import subprocess
+import tempfile
 
-if len(sys.argv) != 3:
-    print("\n===== Error usage, python3 server.py SERVER_PORT MAX_INVALID_ATTEMPTS ======\n")
-    exit(0)
-    
-if not sys.argv[2].isdigit() or not isinstance(int(sys.argv[2]), int):
-    print("\n===== Error: Invalid value for MAX_INVALID_ATTEMPTS. Please provide an integer value. ======\n")
-    exit(0)
+import protocol
+from messagelog import LogWriter, FSYNC_POLICIES
+from presence import PresenceRegistry, UserlogSnapshot
+from credentials import CredentialStore
+from outbound import OutboundQueue, DeliveryMetrics, BACKPRESSURE_POLICIES, DEFAULT_LIMIT, send_frames
+from metrics import Metrics, SamplingProfiler, start_stats_server
+from serverlog import ServerLog, LEVELS
+from groups import GroupRegistry, GroupSnapshot
+from broker import Broker, BrokerLink, RemoteLogWriter, ReplicatedPresence, RemoteHistory
+from history import HistoryStore, private_conversation, group_conversation, DEFAULT_SEGMENT_SIZE, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from relay import RelayServer, RelayError, DEFAULT_RATE, DEFAULT_BUDGET, DEFAULT_MAX_RELAYS
+from timerwheel import TimerWheel
+from state import StateStore, new_token, DEFAULT_SNAPSHOT_INTERVAL, DEFAULT_SESSION_TIMEOUT
 
 server_host = "127.0.0.1"
-server_port = int(sys.argv[1])
-server_address = (server_host, server_port)
-max_invalid_attempts = sys.argv[2]
-max_invalid_attempts = int(max_invalid_attempts)
-connected_clients = {} # key: username, value: client socket, timestamp, ip address, udp port
-invalid_attempts = {} # Tracks login attempts
-blocked_clients = {} # Holds temporarily blocked users
-groups = {} # Holds groups and their members
-members_joined = {} # Keeps track of members who have joined the group
-
-if max_invalid_attempts < 1 or max_invalid_attempts > 5:
-    print("\n===== Error: Invalid number of allowed failed consecutive attempts:", max_invalid_attempts)
-    print("The valid value of argument number is an integer between 1 and 5 ======\n")
-    exit(0)
-
-server_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_tcp_socket.bind(server_address)
+log = ServerLog() # Console log, replaced in main() once the options are known
+metrics = Metrics() # Handler latencies, counters and gauges, see metrics.py
+profiler = None # Set with --profile, samples every thread until shutdown
+profile_path = None
+admins = None # Users allowed to run /stats, everyone logged in if not given
+server_mode = "threaded"
+server_role = "single" # single, or with --workers the supervisor and its worker processes
+worker_id = None
+broker = None # Supervisor only, shares presence and groups between workers, see broker.py
+broker_link = None # Worker only, the connection to the supervisor's broker
+worker_processes = [] # Supervisor only
+WORKER_POLL_INTERVAL = 0.5 # Seconds between checks that every worker is still running
+max_invalid_attempts = 0
+server_tcp_socket = None
+log_writer = None # Owns every log file, see messagelog.py
+userlog_snapshot = None # Writes userlog.txt from the presence registry
+presence = PresenceRegistry() # Logged in users, see presence.py
+credential_store = None # Credentials, failed login attempts and blocked users, see credentials.py
+groups = GroupRegistry() # Groups, their members and who has joined, see groups.py
+group_snapshot = None # Writes groups.txt from the group registry
+delivery_metrics = DeliveryMetrics() # Outbound queue depths and totals, see outbound.py
+outbound_limit = DEFAULT_LIMIT
+outbound_policy = "spill"
+spill_directory = None
+WRITER_CLOSE_TIMEOUT = 5 # Seconds a closing connection gets to send what is still queued
+CATCH_UP_TIMEOUT = 1 # Seconds a batch of commands waits for its replies to be sent before going on
+ACTIVEUSER_PAGE_SIZE = 100 # Users per /activeuser reply unless the client asks for another size
+MAX_ACTIVEUSER_PAGE_SIZE = 1000
+relays = None # With --relay, forwards /p2pvideo datagrams for presenters that cannot reach their audience, see relay.py
+compression = "zlib" # Offered by clients at login, --compression none turns it down
+compression_threshold = protocol.COMPRESSION_THRESHOLD
+compression_stats = protocol.CompressionStats() # Every connection of this process
+history = None # Every private and group message, kept across restarts, see history.py
+state = None # Groups, blocks and sessions kept across restarts, see state.py
+offline_delivery = False # With --offline-delivery, /msgto to a user who is offline is sent at their next login
+timers = None # Idle connection deadlines and account lockouts, see timerwheel.py
+idle_timeout = 60 # Seconds a connection may send nothing before it is reaped, 0 to never reap
+MIN_IDLE_TIMEOUT = 30 # Twice the heartbeat interval of client.py, so a late heartbeat does not get a client reaped
+connection_count = 0 # Currently open TCP connections
+peak_connection_count = 0 # Highest number of simultaneous connections seen
 
 # From the internet handles graaceful server shutdown and removes log files
+# A worker only stops its own connections, the supervisor owns the log files and userlog.txt
 def shutdown_server(sig, frame):
     print("\n===== Server is shutting down gracefully =====")
-    if os.path.isfile('userlog.txt'):
-        os.remove('userlog.txt')
-    if os.path.isfile('messagelog.txt'):
-        os.remove('messagelog.txt')
-    for group in groups:
-        if os.path.isfile(f'{group}_messagelog.txt'):
-            os.remove(f'{group}_messagelog.txt')
-    print("===== All log files deleted =====")
-    server_tcp_socket.close()  
+    if server_role == "supervisor":
+        stop_workers()
+    if credential_store is not None:
+        credential_store.close()
+    if timers is not None:
+        timers.close()
+    if server_role == "worker":
+        broker_link.on_lost = None
+        broker_link.close()
+    else:
+        log_writer.close()
+        userlog_snapshot.close()
+        group_snapshot.close()
+        if broker is not None:
+            broker.close()
+        # After the broker, which may still be adding messages and changes from the workers
+        history.close()
+        state.close()
+        state_stats = state.stats()
+        print(f"===== State: {state_stats['groups']} groups, {state_stats['sessions']} sessions, "
+              f"{state_stats['blocked']} blocked accounts, {state_stats['records']} changes journaled, "
+              f"{state_stats['snapshots']} snapshots, last in {state_stats['last_snapshot_ms']:.1f} ms =====")
+        history_stats = history.stats()
+        print(f"===== History: {history_stats['messages']} messages added, {history_stats['next_id'] - 1} in total, "
+              f"{history_stats['segments_compressed']} segments compressed =====")
+        log_stats = log_writer.stats()
+        print(f"===== Log writer: {log_stats['records']} records in {log_stats['batches']} batches, "
+              f"average latency {log_stats['average_latency_ms']:.2f} ms, p99 {log_stats['p99_latency_ms']:.2f} ms, "
+              f"max latency {log_stats['max_latency_ms']:.2f} ms, "
+              f"max queue depth {log_stats['max_queue_depth']}, {log_stats['write_errors']} write errors =====")
+    if relays is not None:
+        relays.close()
+        relay_totals = relays.totals()
+        print(f"===== Relays: {relay_totals['opened']} opened, {relay_totals['rejected']} refused, "
+              f"{relay_totals['bytes']} bytes in {relay_totals['datagrams']} datagrams relayed, "
+              f"{relay_totals['acks']} acks, rings full {relay_totals['full']} times =====")
+    if server_role != "supervisor":
+        delivery = delivery_metrics.totals()
+        print(f"===== Outbound queues ({outbound_policy}): {delivery['frames']} frames, {delivery['bytes_sent']} bytes sent, "
+              f"{delivery['dropped']} dropped, {delivery['spilled']} bytes spilled, "
+              f"{delivery['disconnected']} slow consumers disconnected, max depth {delivery['max_depth']} bytes =====")
+        print(f"===== Compression: {compression_stats.summary()} =====")
+    # The message logs are kept, their numbering goes on after a restart. Nobody is logged in
+    # until clients reconnect, so userlog.txt goes.
+    if server_role != "worker":
+        if os.path.isfile('userlog.txt'):
+            os.remove('userlog.txt')
+    # Lets the threaded and async modes be compared on connections and memory per process
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if server_role == "supervisor":
+        worker_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print(f"===== Supervisor of {len(worker_processes)} workers; max RSS: {max_rss} KB, largest worker: {worker_rss} KB =====")
+    elif server_role == "worker":
+        print(f"===== Worker {worker_id} mode: {server_mode}; peak connections: {peak_connection_count}; max RSS: {max_rss} KB =====")
+    else:
+        print(f"===== Mode: {server_mode}; peak connections: {peak_connection_count}; max RSS: {max_rss} KB =====")
+    # In async mode the listening socket is owned and closed by the asyncio server
+    if profiler is not None:
+        profiler.stop().write(profile_path)
+        print(f"===== Profile of {profiler.samples} samples written to {profile_path} =====")
+    if server_mode == "threaded" and server_tcp_socket is not None:
+        server_tcp_socket.close()  
     sys.exit(0)
 
-signal.signal(signal.SIGINT, shutdown_server)
+# Journals a change to the state kept across restarts, a worker sends it to the supervisor's store
+def record_state(name, *args):
+    if broker_link is not None:
+        broker_link.send(name, *args)
+    else:
+        state.record(name, *args)
 
-# Thread handles each TCP client connection 
-class ClientThread(Thread):
+# A connection on the session dropped, the session is ended unless it is resumed in time, see state.py
+def detach_session(username, token):
+    if broker_link is not None:
+        broker_link.send("@detach", username, token)
+    else:
+        state.detach(username, token)
+
+# Keeps track of open connections for both server modes
+def connection_opened():
+    global connection_count, peak_connection_count
+    connection_count += 1
+    if connection_count > peak_connection_count:
+        peak_connection_count = connection_count
+
+def connection_closed():
+    global connection_count
+    connection_count -= 1
+
+# Every connection's replies and deliveries go through its own bounded queue, see outbound.py
+def open_outbound_queue(name, on_ready=None, on_overflow=None):
+    return OutboundQueue(name, outbound_limit, outbound_policy, spill_directory, on_ready, on_overflow, delivery_metrics)
+
+# Holds the command handlers shared by the threaded and the async server modes
+# Subclasses provide self.client_address and a self.client_socket, the connection's OutboundQueue,
+# whose sendall() only queues the frame for the connection's writer
+class ClientHandler:
     def __init__(self, client_address, client_socket):
-        Thread.__init__(self)
         self.client_address = client_address
         self.client_socket = client_socket
         self.client_alive = False
+        self.username = None # Set once this connection logs in
+        self.session_token = None # Of the session it logged in to, to resume it with
+        self.request_id = 0 # Of the command being handled, put on every reply to it
+        self.decoder = protocol.FrameDecoder()
+        self.compressor = None # Set at login if the client offered compression, used by the writer
+        self.last_seen = time.monotonic() # When anything last arrived from the client
+        self.idle_timer = timers.schedule(idle_timeout, self.check_idle) if idle_timeout else None
 
-        print("===== New connection created for: ", client_address)
+        log.info(f"New connection created for: {client_address}")
         self.client_alive = True
-        
-    def run(self):
-        message = ''
-        while self.client_alive:
-            data = self.client_socket.recv(1024)
-            message = data.decode()
-            
-            if message == '':
-                self.client_alive = False
-                print("===== the user disconnected - ", client_address)
-                break
-            
-            if message.split(" ")[0] == 'credentials':
-                self.authenticate(message)
-            elif message.split(" ")[0] == 'Log':
-                self.handle_user_log(message)
-            elif message.split(" ")[0] == '/msgto':
-                self.handle_msg_to(message)
-            elif message.split(" ")[0] == '/activeuser':
-                self.handle_active_user()
-            elif message.split(" ")[0] == '/creategroup':
-                self.handle_create_group(message)
-            elif message.split(" ")[0] == '/joingroup':
-                self.handle_join_group(message)
-            elif message.split(" ")[0] == '/groupmsg':
-                self.handle_group_msg(message)
-            elif message.split(" ")[0] == '/p2pvideo':
-                self.handle_p2p_video(message)
-            elif message.split(" ")[0] == '/logout':
-                self.handle_logout(message)
+        connection_opened()
+
+    # Decodes every complete frame in a block of received data
+    # Returns None when the peer broke the protocol and the connection should be dropped
+    def receive(self, data):
+        self.last_seen = time.monotonic()
+        metrics.increment("bytes_in", len(data))
+        try:
+            return self.decoder.feed(data)
+        except protocol.ProtocolError as error:
+            log.error(f"Error: Protocol error from {self.client_address}: {error}")
+            metrics.increment("errors.protocol")
+            return None
+
+    # Runs the handler matching the command name and records how long it took
+    # A handler that waits on a worker thread returns whatever wait_for() gave it
+    def dispatch(self, command):
+        handler = self.handlers.get(command.name)
+        if handler is None:
+            log.error(f"Error: Unexpected command {command.name}")
+            metrics.increment("errors.unexpected_command")
+            return None
+        metrics.increment(f"commands.{command.name}")
+        self.request_id = command.request_id
+        started = time.perf_counter()
+        try:
+            pending = handler(self, command)
+        except (IndexError, ValueError, TypeError) as error:
+            self.malformed(command, error)
+            return None
+        if pending is None:
+            metrics.observe(handler.__name__, time.perf_counter() - started)
+            return None
+        return self.timed(pending, command, handler.__name__, started)
+
+    # A handler still waiting on a worker is timed once it is done, and fails like any other handler
+    async def timed(self, pending, command, name, started):
+        try:
+            await pending
+        except (IndexError, ValueError, TypeError) as error:
+            self.malformed(command, error)
+            return
+        metrics.observe(name, time.perf_counter() - started)
+
+    def malformed(self, command, error):
+        log.error(f"Error: Malformed {command.name} request: {error}")
+        metrics.increment("errors.malformed")
+        self.send("error", f"Error: Malformed {command.name} request.")
+
+    # Calls callback with the result of a concurrent Future
+    # A threaded connection has nothing else to do, so it just blocks until the result is ready
+    def wait_for(self, future, callback):
+        return callback(future.result())
+
+    # Replies to the command being handled, commands from one connection are handled one at a time
+    def send(self, name, *args):
+        self.client_socket.sendall(protocol.encode(name, *args, request_id=self.request_id))
+
+    # What the writer sends for frames taken from the outbound queue, compressed together if compressing
+    def outgoing(self, frames):
+        if self.compressor is None:
+            return frames
+        return [self.compressor.compress(frames[0] if len(frames) == 1 else b"".join(frames))]
+
+    # Runs on the timer wheel. A client that sent anything since the timer was set gets a timer for
+    # the rest of its idle time, so receiving a frame never touches the wheel. A client that vanished
+    # without closing its connection is dropped like any disconnect, which logs it out and takes
+    # it out of its groups' recipients.
+    def check_idle(self):
+        if not self.client_alive:
+            return
+        idle = time.monotonic() - self.last_seen
+        if idle < idle_timeout:
+            self.idle_timer = timers.schedule(idle_timeout - idle, self.check_idle)
+            return
+        log.warning(f"Error: Reaping {self.username or self.client_address}, nothing received for {idle:.0f} seconds")
+        metrics.increment("connections_reaped")
+        self.reap()
+
+    def disconnected(self):
+        self.client_alive = False
+        if self.idle_timer is not None:
+            timers.cancel(self.idle_timer)
+        connection_closed()
+        compression_stats.add_received(self.decoder)
+        presence.unsubscribe(self.client_socket)
+        # A client that disconnects without /logout no longer shows up as active
+        if self.username is not None:
+            presence.logout(self.username, self.client_socket)
+            # The session can still be resumed, until the session timeout
+            detach_session(self.username, self.session_token)
+        log.info(f"the user disconnected - {self.client_address}")
     
     # This function sends information to the client who requested a p2p video
     # in order for the client to initiate a udp connection to send a file as they require port numbers
     # as well as error handling
-    def handle_p2p_video(self, message):
-        print('===== P2P video request received =====')
-        audience_username = message.split(" ")[1]
-        filename = message.split(" ")[2]
-        presenter_username = message.split(" ")[3]
-        presenter_udp_port = connected_clients[presenter_username][3]
+    def handle_p2p_video(self, command):
+        log.debug('P2P video request received')
+        audience_username, filename, presenter_username = command.args
 
         if audience_username == presenter_username:
-            message = f"p2pvideo Error: User {audience_username} cannot send messages to themselves."
-            print(f"===== Error: User {audience_username} cannot send messages to themselves. =====")
-            self.client_socket.send(message.encode())
-            return
-        if audience_username not in connected_clients:
-            message = f"p2pvideo Error: User {audience_username} is not logged in."
-            print(f"===== Error: User {audience_username} is not logged in. =====")
-            self.client_socket.send(message.encode())
-            return
-        audience_udp_port = connected_clients[audience_username][3]
-        message = f"p2pvideo {audience_username} {audience_udp_port}"
-        print(f"===== Sending p2pvideo credentials =====")
-        self.client_socket.send(message.encode())
-
-
-    def handle_logout(self, message):
-        username = message.split(" ")[1]
-        print(f"===== Logout request received from user {username} =====")
-        with open("userlog.txt", "r") as infile:
-            lines = infile.readlines()
-            
-        # Edit userlog.txt to remove the user and update the serial numbers
-        with open("userlog.txt", "w") as outfile:
-            serial_number_offset = 0
-            for line in lines:
-                parts = line.strip().split('; ')
-                if len(parts) >= 3 and parts[2] == username:
-                    serial_number_offset = -1
-                else:
-                    parts[0] = str(int(parts[0]) + serial_number_offset)
-                    outfile.write('; '.join(parts) + '\n')
-        
-        if username in connected_clients:
-            del connected_clients[username]
+            log.warning(f"Error: User {audience_username} cannot send messages to themselves.")
+            self.send("p2pvideo", f"Error: User {audience_username} cannot send messages to themselves.")
+            return
+        audience = presence.get(audience_username)
+        if audience is None:
+            log.warning(f"Error: User {audience_username} is not logged in.")
+            self.send("p2pvideo", f"Error: User {audience_username} is not logged in.")
+            return
+        log.info(f"Sending p2pvideo credentials")
+        self.send("p2pvideo", audience_username, audience.udp_port)
 
-        print(f"===== User {username} logged out. =====")
-        message = f"logout Bye, {username}!"
-        self.client_socket.send(message.encode())
+    # Sent by clients that have been quiet for a while, receive() has already noted that the client
+    # is still there
+    def handle_heartbeat(self, command):
+        return
 
-    def handle_group_msg(self, message):
-        group_name = message.split(" ")[1]
-        username = message.split(" ")[2]
-        message_content = " ".join(message.split(" ")[3:])
+    # Opens a relay for a presenter whose datagrams did not reach the audience, the presenter then
+    # sends the file to the relay's port on this server instead, see relay.py
+    def handle_relay(self, command):
+        log.debug('Relay request received')
+        audience_username, filename, presenter_username = command.args
+
+        if relays is None:
+            log.warning("Error: Relays are not enabled.")
+            self.send("relay", "Error: This server does not relay files.")
+            return
+        # Only for the logged in user's own transfers, whatever the client sends
+        if self.username is None or presenter_username != self.username:
+            log.warning(f"Error: {self.username or self.client_address} asked for a relay for {presenter_username}.")
+            self.send("relay", "Error: Log in before asking for a relay, and only for your own files.")
+            return
+        if audience_username == presenter_username:
+            log.warning(f"Error: User {audience_username} cannot send messages to themselves.")
+            self.send("relay", f"Error: User {audience_username} cannot send messages to themselves.")
+            return
+        audience = presence.get(audience_username)
+        if audience is None:
+            log.warning(f"Error: User {audience_username} is not logged in.")
+            self.send("relay", f"Error: User {audience_username} is not logged in.")
+            return
+        try:
+            port = relays.open(self.client_address[0], (audience.ip_address, audience.udp_port), self.username)
+        except (RelayError, OSError) as error:
+            log.warning(f"Error: No relay for {presenter_username}: {error}")
+            self.send("relay", f"Error: {error}")
+            return
+        log.info(f"Relaying {filename} from {presenter_username} to {audience_username} on port {port}")
+        self.send("relay", audience_username, port)
+
+    # Sends the UDP port of every joined member of the group who is online, so the presenter can send
+    # the file to all of them at once: "groupvideo", GROUP, USERNAME, PORT, USERNAME, PORT, ...
+    def handle_group_video(self, command):
+        log.debug('Group video request received')
+        group_name, filename, presenter_username = command.args
+
+        group = groups.get(group_name)
+        if group is None:
+            log.warning("Error: Group does not exist.")
+            self.send("groupvideo", f"Error: Group {group_name} does not exist.")
+            return
+        if presenter_username not in group.members:
+            log.warning("Error: User is not a member of the group.")
+            self.send("groupvideo", f"Error: User {presenter_username} is not a member of group {group_name}.")
+            return
+        if presenter_username not in group.joined:
+            log.warning("Error: User has not joined the group.")
+            self.send("groupvideo", f"Error: User {presenter_username} has not joined group {group_name}.")
+            return
+
+        audience = []
+        for member in sorted(group.recipients()):
+            if member == presenter_username:
+                continue
+            member_presence = presence.get(member)
+            if member_presence is not None:
+                audience += [member, member_presence.udp_port]
+        if not audience:
+            log.warning("Error: No other member of the group is online.")
+            self.send("groupvideo", f"Error: No other member of group {group_name} is online.")
+            return
+        log.info(f"Sending groupvideo credentials for {len(audience) // 2} members of {group_name}")
+        self.send("groupvideo", group_name, *audience)
+
+    # The logged in user, whatever name the client put in the request, or None after an error reply
+    def sender(self, reply_name):
+        if self.username is None:
+            log.warning(f"Error: {self.client_address} sent a {reply_name} request without logging in.")
+            self.send(reply_name, "Error: Log in first.")
+        return self.username
+
+    def handle_logout(self, command):
+        log.debug(f"Logout request received from user {command.args[0]}")
+        username = self.sender("logout")
+        if username is None:
+            return
+
+        # userlog.txt drops the user with the next presence snapshot, a session this connection
+        # does not own is left alone
+        presence.logout(username, self.client_socket)
+        presence.unsubscribe(self.client_socket)
+        # A client that logged out has nothing to resume
+        record_state("@endsession", username)
+        self.username = None
+        self.session_token = None
+
+        log.info(f"User {username} logged out.")
+        self.send("logout", f"Bye, {username}!")
+
+    def handle_group_msg(self, command):
+        group_name, _, message_content = command.args
+        username = self.sender("groupmsg")
+        if username is None:
+            return
 
         # Error handling
-        if group_name not in groups:
-            print("===== Error: Group does not exist. =====")
-            message = f"groupmsg Error: Group {group_name} does not exist."
-            self.client_socket.send(message.encode())
+        group = groups.get(group_name)
+        if group is None:
+            log.warning("Error: Group does not exist.")
+            self.send("groupmsg", f"Error: Group {group_name} does not exist.")
             return
 
-        if username not in groups[group_name]:
-            print("===== Error: User is not a member of the group. =====")
-            message = f"groupmsg Error: User {username} is not a member of group {group_name}."
-            self.client_socket.send(message.encode())
+        if username not in group.members:
+            log.warning("Error: User is not a member of the group.")
+            self.send("groupmsg", f"Error: User {username} is not a member of group {group_name}.")
             return
 
-        if username not in members_joined[group_name]:
-            print("===== Error: User has not joined the group. =====")
-            message = f"groupmsg Error: User {username} has not joined group {group_name}."
-            self.client_socket.send(message.encode())
+        if username not in group.joined:
+            log.warning("Error: User has not joined the group.")
+            self.send("groupmsg", f"Error: User {username} has not joined group {group_name}.")
             return
 
-        # Handles logging
-        with open(f'{group_name}_messagelog.txt', 'r') as file:
-            message_number = len(file.readlines())
+        # Handles logging, the log writer numbers the message
+        timestamp = datetime.now().strftime('%d %b %Y %H:%M:%S')
+        log_writer.append(f'{group_name}_messagelog.txt', (timestamp, username, message_content))
+        history.append(group_conversation(group_name), username, timestamp, message_content)
 
-        with open(f'{group_name}_messagelog.txt', 'a') as file:
-            timestamp = datetime.now().strftime('%d %b %Y %H:%M:%S')
-            log_message = f"{message_number}; {timestamp}; {username}; {message_content}"
-            file.write(log_message + "\n")
+        # The frame is encoded once and the same bytes are queued for every member online
+        frame = protocol.encode("groupmsg_recieve", f"{timestamp}, {group_name}, {username}: {message_content}")
+        presence.send_to([member for member in group.recipients() if member != username], frame)
 
-        for member in members_joined[group_name]:
-            if member not in connected_clients or member == username:
-                continue
-            member_socket = connected_clients[member][0]
-            private_message = f"groupmsg_recieve {timestamp}, {group_name}, {username}: {message_content}"
-            member_socket.send(private_message.encode())
-
-        print(f"===== Group Message on {group_name}; {message_number}; {timestamp}; {username}; {message_content}  =====")
-
-
-    def handle_join_group(self, message):
-        group_name = message.split(" ")[1]
-        username = message.split(" ")[2]
-
-        if group_name not in groups:
-            print("===== Error: Group does not exist. =====")
-            message = f"joingroup Error: Group {group_name} does not exist."
-        elif username not in groups[group_name]:
-            print("===== Error: User is not a member of the group. =====")
-            message = f"joingroup Error: User {username} is not a member of group {group_name}."
-        elif username in members_joined[group_name]:
-            print("===== Error: User has already joined the group. =====")
-            message = f"joingroup Error: User {username} has already joined group {group_name}."
+        self.send("groupmsg", f"Group message sent at {timestamp}")
+        log.info(f"Group Message on {group_name}; {timestamp}; {username}; {message_content}")
+
+
+    def handle_join_group(self, command):
+        group_name, _ = command.args
+        username = self.sender("joingroup")
+        if username is None:
+            return
+
+        group = groups.get(group_name)
+        if group is None:
+            log.warning("Error: Group does not exist.")
+            message = f"Error: Group {group_name} does not exist."
+        elif username not in group.members:
+            log.warning("Error: User is not a member of the group.")
+            message = f"Error: User {username} is not a member of group {group_name}."
+        elif not groups.join(group_name, username):
+            log.warning("Error: User has already joined the group.")
+            message = f"Error: User {username} has already joined group {group_name}."
         else:
-            members_joined[group_name].append(username)
-            print("===== User joined group successfully. =====")
-            message = f"joingroup {group_name} joined successfully."
+            if broker_link is not None:
+                broker_link.send("@join", group_name, username)
+            log.info("User joined group successfully.")
+            message = f"{group_name} joined successfully."
 
-        self.client_socket.send(message.encode())
+        self.send("joingroup", message)
 
-    def handle_create_group(self, message):
-        print("===== Create group request received =====")
-        group_name = message.split(" ")[1]
-        group_members = message.split(" ")[2:]
+    def handle_create_group(self, command):
+        log.debug("Create group request received")
+        group_name = command.args[0]
+        group_members = list(command.args[1:])
 
         # Error handling
+        if not group_members:
+            log.warning("Error: Group creation request without members.")
+            self.send("creategroup", f"Error: Group {group_name} creation failed. A group needs at least one member.")
+            return
         if not group_name.isalnum():
-            print("===== Error: Group name must only consist of letter a-z and digit 0-9. =====")
-            message = f"creategroup Error: Group {group_name} creation failed. Group name must only consist of letter a-z and digit 0-9."
-            self.client_socket.send(message.encode())
+            log.warning("Error: Group name must only consist of letter a-z and digit 0-9.")
+            self.send("creategroup", f"Error: Group {group_name} creation failed. Group name must only consist of letter a-z and digit 0-9.")
             return
         if group_name in groups:
-            print("===== Error: Group name already exists. =====")
-            message = f"creategroup Error: Group {group_name} creation failed. Group name already exists."
-            self.client_socket.send(message.encode())
+            log.warning("Error: Group name already exists.")
+            self.send("creategroup", f"Error: Group {group_name} creation failed. Group name already exists.")
             return
         for member in group_members:
-            if member not in connected_clients:
-                print("===== Error: User is not valid or not online. =====")
-                message = f"creategroup Error: Group {group_name} creation failed. User {member} is not valid or not online."
-                self.client_socket.send(message.encode())
+            if member not in presence:
+                log.warning("Error: User is not valid or not online.")
+                self.send("creategroup", f"Error: Group {group_name} creation failed. User {member} is not valid or not online.")
                 return
 
-        # Update groups and members_joined
-        groups[group_name] = group_members
-        members_joined[group_name] = [group_members[0]]
+        # Adds the group to the registry, with workers the broker decides whether the name is still free
+        if broker_link is not None:
+            created = broker_link.request("@creategroup", group_name, *group_members)
+            return self.wait_for(created, lambda error: self.finish_create_group(group_name, group_members, error))
+        error = "" if groups.create(group_name, group_members) is not None else "Group name already exists."
+        self.finish_create_group(group_name, group_members, error)
+
+    def finish_create_group(self, group_name, group_members, error):
+        if error:
+            log.warning(f"Error: {error}")
+            self.send("creategroup", f"Error: Group {group_name} creation failed. {error}")
+            return
 
-        message = f"Group {group_name} created successfully. Group members: {' '.join(group_members)}"
-        self.client_socket.send(message.encode())
-        print(f"===== Group {group_name} created successfully. Group members: {' '.join(group_members)} =====")
+        self.send("creategroup", f"Group {group_name} created successfully. Group members: {' '.join(group_members)}")
+        log.info(f"Group {group_name} created successfully. Group members: {' '.join(group_members)}")
         
         # Handles logging
-        with open(f"{group_name}_messagelog.txt", 'a') as file:
-            log_message = f"{group_name}; {' '.join(group_members)}"
-            file.write(log_message + "\n")
+        log_writer.append(f"{group_name}_messagelog.txt", (group_name, ' '.join(group_members)), numbered=False)
 
 
-    def handle_active_user(self):
-        print("===== Active user request received =====")
+    # /activeuser [PAGE] [PAGE_SIZE], a page is a slice of the registry's cached lines in username order
+    def handle_active_user(self, command):
+        log.debug("Active user request received")
+        page = command.args[0] if command.args else 1
+        page_size = command.args[1] if len(command.args) > 1 else ACTIVEUSER_PAGE_SIZE
+        if page < 1 or not 1 <= page_size <= MAX_ACTIVEUSER_PAGE_SIZE:
+            log.warning(f"Error: Page {page} of size {page_size} of active users is out of range.")
+            self.send("activeuser", f"Error: The page must be at least 1 and the page size from 1 to {MAX_ACTIVEUSER_PAGE_SIZE}.")
+            return
 
-        if len(connected_clients) < 2:
-            message = "activeuser No other active users."
-            self.client_socket.send(message.encode())
-            print("===== No other active users. =====")
+        lines, others = presence.page((page - 1) * page_size, page_size, exclude=self.username)
+        if others == 0:
+            self.send("activeuser", "No other active users.")
+            log.info("No other active users.")
             return
 
+        pages = (others + page_size - 1) // page_size
+        if not lines:
+            log.warning(f"Error: Page {page} of active users does not exist.")
+            self.send("activeuser", f"Error: Page {page} does not exist, there are {pages} pages.")
+            return
         # In order to incorporate multiple users in a single message to avoid the 'enter command' prompt from
-        # printing again at the client side we send the message using a single string
-        message = 'activeuser '
-        for username in connected_clients:
-            client_socket, timestamp, ip_address, udp_port = connected_clients[username]
-            if client_socket != self.client_socket:
-                message += f"{username}; {ip_address}; {udp_port}; active since {timestamp}.\n"
-                print(f"===== {username}; {ip_address}; {udp_port}; active since {timestamp}. =====")
-                
-        self.client_socket.send(message.encode())
-
-    def handle_msg_to(self, message):
-        sender_username = message.split(" ")[1]
-        recipient_username = message.split(" ")[2]
-        message_content = " ".join(message.split(" ")[3:])
+        # printing again at the client side we send the message using a single frame
+        if pages > 1:
+            lines.append(f"Page {page} of {pages}, {others} other active users.")
+        log.debug(f"Sending page {page} of {pages} of active users")
+        self.send("activeuser", "\n".join(lines))
+
+    # Pushes presence to this connection from now on, a snapshot first and then every change
+    def handle_subscribe(self, command):
+        if self.username is None:
+            log.warning(f"Error: {self.client_address} subscribed to presence without logging in.")
+            self.send("presence", "error", 0, "Error: Log in before subscribing to presence.")
+            return
+        log.info(f"{self.username} subscribed to presence")
+        presence.subscribe(self.client_socket)
+
+    def handle_unsubscribe(self, command):
+        log.info(f"{self.username} unsubscribed from presence")
+        presence.unsubscribe(self.client_socket)
+
+    def handle_msg_to(self, command):
+        _, recipient_username, message_content = command.args
+        sender_username = self.sender("msgto")
+        if sender_username is None:
+            return
         timestamp = datetime.now().strftime('%d %b %Y %H:%M:%S')
 
         if sender_username == recipient_username:
-            error_message = f"msg_sent Error: User {sender_username} cannot send messages to themselves."
-            print("===== Error:User cannot send messages to themselves. =====")
-            self.client_socket.send(error_message.encode())
+            log.warning("Error:User cannot send messages to themselves.")
+            self.send("msg_sent", f"Error: User {sender_username} cannot send messages to themselves.")
             return
 
-        if recipient_username in connected_clients:
-            recipient_socket = connected_clients[recipient_username][0]
-            private_message = f"msg_recieve {timestamp}, {sender_username}: {message_content}"
-            recipient_socket.send(private_message.encode())
-            confirmation_message = f"msg_sent message sent at {timestamp}"
+        recipient = presence.get(recipient_username)
+        if recipient is not None:
+            recipient.client_socket.sendall(protocol.encode("msg_recieve", f"{timestamp}, {sender_username}: {message_content}"))
             
             # Sends message confirmation to sender
-            self.client_socket.send(confirmation_message.encode())
-            print(f"===== {sender_username} sent a message to {recipient_username} \"{message}\" at {timestamp} =====")
+            self.send("msg_sent", f"message sent at {timestamp}")
+            log.info(f"{sender_username} sent a message to {recipient_username} \"{message_content}\" at {timestamp}")
             
             # Handles logging
-            if os.path.isfile('messagelog.txt'):
-                with open('messagelog.txt', 'r') as file:
-                    message_number = len(file.readlines())
-                message_number += 1
-            else:
-                message_number = 1
-            with open("messagelog.txt", 'a') as file:
-                log_message = f"{message_number}; {timestamp}; {sender_username}; {message_content}"
-                file.write(log_message + "\n")
+            log_writer.append("messagelog.txt", (timestamp, sender_username, message_content))
+            history.append(private_conversation(sender_username, recipient_username), sender_username, timestamp, message_content)
+        elif offline_delivery and credential_store.exists(recipient_username):
+            history.append(private_conversation(sender_username, recipient_username), sender_username, timestamp,
+                           message_content, pending_for=recipient_username)
+            self.send("msg_sent", f"message queued at {timestamp}, {recipient_username} gets it when they log in")
+            log.info(f"{sender_username} queued a message for {recipient_username} \"{message_content}\" at {timestamp}")
+            log_writer.append("messagelog.txt", (timestamp, sender_username, message_content))
         else:
-            error_message = f"msgto Error: User {recipient_username} is not online."
-            print(f"===== Error: User {recipient_username} is not online. =====")
-            self.client_socket.send(error_message.encode())
+            log.warning(f"Error: User {recipient_username} is not online.")
+            self.send("msgto", f"Error: User {recipient_username} is not online.")
 
 
-    def handle_user_log(self, message):
-        username = message.split(" ")[1]
-        client_udp_port = int(message.split(" ")[2].strip())
-        timestamp = datetime.now().strftime('%d %b %Y %H:%M:%S')
-        if os.path.isfile('userlog.txt'):
-            with open('userlog.txt', 'r') as file:
-                active_user = len(file.readlines())
-            active_user += 1
-        else:
-            active_user = 1
-        log_message = f"{active_user}; {timestamp}; {username}; {self.client_address[0]}; {client_udp_port}"
-        with open('userlog.txt', 'a') as file:
-            file.write(log_message + "\n")
+    # The userlog.txt entry comes from the presence snapshot, this only records the UDP port the client reported
+    def handle_user_log(self, command):
+        username, client_udp_port = command.args
+        presence.set_udp_port(username, self.client_socket, client_udp_port)
 
 
-    def authenticate(self, message):
-        print('===== Authentication request received =====')
-        input_username = message.split(" ")[1].strip()
-        input_password = message.split(" ")[2].strip()
-        client_udp_port = int(message.split(" ")[3].strip())
+    def authenticate(self, command):
+        log.debug('Authentication request received')
+        # Clients from before compression send no list of methods
+        input_username, input_password, client_udp_port, *offered = command.args
+        offered = offered[0].split(",") if offered else []
+        input_username = input_username.strip()
+        input_password = input_password.strip()
         
-        # This block deals with blocked clients
-        if input_username in blocked_clients:
-            blocking_end_time = blocked_clients[input_username]
-            current_time = time.time()
-            if current_time < blocking_end_time:
-                message = "client blocked"
-                print(f"===== Error: User {input_username} is blocked. =====")
-                self.client_socket.send(message.encode())
-                return
-            else:
-                del invalid_attempts[input_username]  # reset invalid attempts
-                del blocked_clients[input_username]  # reset blocked clients
+        # This block deals with blocked clients, blocks end on their own in the credential store
+        if credential_store.is_blocked(input_username):
+            log.warning(f"Error: User {input_username} is blocked.")
+            self.send("login", "blocked")
+            return None
         
+        # The password check runs on the credential store's worker pool
+        password_check = credential_store.check_password(input_username, input_password)
+        return self.wait_for(password_check, lambda valid: self.finish_authentication(input_username, client_udp_port, valid, offered))
+
+    # valid is True or False, or None when the username does not exist
+    def finish_authentication(self, input_username, client_udp_port, valid, offered=()):
         # This block deals with logging as well as a successful login
-        does_username_exist = False
-        with open("credentials.txt", 'r') as file:
-            for line in file:
-                username, password = map(str.strip, line.split(" "))
-                if input_username == username:
-                    does_username_exist = True
-                    if input_password == password:
-                        message = "login success"
-                        print(f"===== User {input_username} logged in successfully. =====")
-                        self.client_socket.send(message.encode())
-                        timestamp = datetime.now().strftime('%d %b %Y %H:%M:%S')
-                        connected_clients[input_username] = [self.client_socket, timestamp, self.client_address[0], client_udp_port]
-                        return
+        if valid:
+            log.info(f"User {input_username} logged in successfully.")
+            if broker_link is not None:
+                broker_link.send("@success", input_username)
+            else:
+                credential_store.record_success(input_username)
+            timestamp = datetime.now().strftime('%d %b %Y %H:%M:%S')
+            self.start_session(input_username, client_udp_port, offered, timestamp, new_token())
+            return
         
         # This block deals with invalid login attempts (wrong password)
-        if does_username_exist:
-            if input_username in invalid_attempts:
-                invalid_attempts[input_username] += 1
-            else:
-                invalid_attempts[input_username] = 1
-
-            # Handles locking of an account when max_invalid_attempts is reached
-            if invalid_attempts[input_username] >= max_invalid_attempts:
-                message = "account locked"
-                print(f"===== Error: User {input_username} is locked. =====")
-                self.client_socket.send(message.encode())
-                self.client_alive = False
-                blocking_end_time = time.time() + 10
-                blocked_clients[input_username] = blocking_end_time
-                return
+        # and locks the account when max_invalid_attempts is reached
+        # The credential store journals the block, with workers the broker counts the attempts of every worker
+        if valid is False:
+            if broker_link is not None:
+                failure = broker_link.request("@failure", input_username)
+                return self.wait_for(failure, lambda locked: self.finish_failure(input_username, locked))
+            return self.finish_failure(input_username, credential_store.record_failure(input_username))
+        self.finish_failure(input_username, False)
+
+    # locked is true when this attempt locked the account
+    def finish_failure(self, input_username, locked):
+        if locked:
+            log.warning(f"Error: User {input_username} is locked.")
+            self.send("login", "locked")
+            self.client_alive = False
+            return
         
         # This case occurs when the username does not exist or when password is incorrect but not enough to lock the account
-        message = "login failed"
-        print(f"===== Error: User {input_username} failed to log in. =====")
-        self.client_socket.send(message.encode())
+        log.warning(f"Error: User {input_username} failed to log in.")
+        self.send("login", "failed")
+
+    # Logs the connection in, after a password check or for a resumed session. The session is journaled
+    # so the client can resume it with the token after its connection drops or the server restarts.
+    def start_session(self, username, client_udp_port, offered, timestamp, token):
+        presence.login(username, self.client_socket, timestamp, self.client_address[0], client_udp_port)
+        self.username = username
+        self.session_token = token
+        self.client_socket.name = username
+        record_state("@session", username, token, timestamp, self.client_address[0], client_udp_port)
+        # The reply says which method the client gets, it may already come compressed
+        method = compression if compression in offered else ""
+        if method:
+            self.compressor = protocol.Compressor(compression_threshold, compression_stats)
+        self.send("login", "success", method, token)
+        if offline_delivery:
+            self.deliver_pending(username)
+
+    # resume TOKEN UDP_PORT [METHODS]: a client logs in again with the token of its session instead of
+    # its password, after its connection dropped or the server restarted. It keeps its "active since" time.
+    def handle_resume(self, command):
+        token, client_udp_port, *offered = command.args
+        offered = offered[0].split(",") if offered else []
+        if broker_link is not None:
+            session = broker_link.request("@resume", token)
+            return self.wait_for(session, lambda session: self.finish_resume(token, client_udp_port, offered, session))
+        session = state.resume(token)
+        self.finish_resume(token, client_udp_port, offered, session and (session.username, session.timestamp))
+
+    # session is (username, timestamp), or empty once the session has ended
+    def finish_resume(self, token, client_udp_port, offered, session):
+        if not session:
+            log.warning(f"Error: {self.client_address} tried to resume a session that has ended.")
+            self.send("login", "expired")
+            return
+        username, timestamp = session
+        log.info(f"User {username} resumed their session.")
+        self.start_session(username, client_udp_port, offered, timestamp, token)
+
+    # Sends the messages queued for the user while they were offline, then has them cleared
+    def deliver_pending(self, username):
+        messages = history.pending(username)
+        for message in messages:
+            self.client_socket.sendall(protocol.encode(
+                "msg_recieve", f"{message.timestamp}, {message.sender}: {message.text} (sent while you were offline)"))
+        if messages:
+            log.info(f"Delivered {len(messages)} queued messages to {username}")
+            history.clear_pending(username, len(messages))
+
+    # /history USER|GROUP [BEFORE] [LIMIT]: a page of the private conversation with a user, or of a
+    # group the user is a member of, oldest first. The history store finds the page by seeking, so
+    # this costs the same however long the conversation is.
+    def handle_history(self, command):
+        target, *rest = command.args
+        before = rest[0] if rest else None
+        limit = rest[1] if len(rest) > 1 else DEFAULT_PAGE_SIZE
+        if (before is not None and before < 0) or not 1 <= limit <= MAX_PAGE_SIZE:
+            log.warning(f"Error: History page before {before} of {limit} messages is out of range.")
+            self.send("history", f"Error: BEFORE must be at least 0 and LIMIT from 1 to {MAX_PAGE_SIZE}.")
+            return
+        # Only the logged in user's own conversations, whatever the client sends
+        username = self.username
+        if username is None:
+            log.warning(f"Error: {self.client_address} asked for history without logging in.")
+            self.send("history", "Error: Log in before reading the history.")
+            return
+        group = groups.get(target)
+        if group is not None:
+            if username not in group.members:
+                log.warning("Error: User is not a member of the group.")
+                self.send("history", f"Error: User {username} is not a member of group {target}.")
+                return
+            conversation = group_conversation(target)
+        elif target != username and credential_store.exists(target):
+            conversation = private_conversation(username, target)
+        else:
+            log.warning(f"Error: No user or group named {target}.")
+            self.send("history", f"Error: No user or group named {target}.")
+            return
+
+        messages, older = history.page(conversation, before, limit)
+        if not messages:
+            self.send("history", f"No messages with {target}" + (f" before {before}." if before is not None else "."))
+            return
+        lines = [f"[{message.id}] {message.timestamp}, {message.sender}: {message.text}" for message in messages]
+        if older:
+            lines.append(f"Older messages: /history {target} {messages[0].id}")
+        log.debug(f"Sending {len(messages)} messages of {conversation} to {username}")
+        self.send("history", "\n".join(lines))
+
+    # Admin command, replies with the metrics snapshot as JSON
+    def handle_stats(self, command):
+        if self.username is None or (admins is not None and self.username not in admins):
+            log.warning(f"Error: {self.username or self.client_address} may not read the server stats.")
+            self.send("stats", "Error: You may not read the server stats.")
+            return
+        self.send("stats", metrics.to_json())
+
+    # Command name to handler, looked up once per frame
+    handlers = {
+        'credentials': authenticate,
+        'Log': handle_user_log,
+        '/msgto': handle_msg_to,
+        '/activeuser': handle_active_user,
+        '/creategroup': handle_create_group,
+        '/joingroup': handle_join_group,
+        '/groupmsg': handle_group_msg,
+        '/p2pvideo': handle_p2p_video,
+        '/groupvideo': handle_group_video,
+        '/relay': handle_relay,
+        '/heartbeat': handle_heartbeat,
+        '/history': handle_history,
+        '/logout': handle_logout,
+        'resume': handle_resume,
+        '/stats': handle_stats,
+        '/subscribe': handle_subscribe,
+        '/unsubscribe': handle_unsubscribe,
+    }
+
+# Thread handles each TCP client connection 
+# A second thread writes the connection's outbound queue to the socket
+class ClientThread(ClientHandler, Thread):
+    def __init__(self, client_address, connection):
+        # Daemon threads, so a server that is stopped drops its connections and clients resume on the next one
+        Thread.__init__(self, daemon=True)
+        self.connection = connection
+        ClientHandler.__init__(self, client_address, open_outbound_queue(client_address, on_overflow=self.drop_slow_consumer))
+        self.writer = Thread(target=self.write_loop, daemon=True)
+        
+    def run(self):
+        self.writer.start()
+        try:
+            self.serve()
+        finally:
+            self.close()
+
+    def serve(self):
+        while self.client_alive:
+            try:
+                data = self.connection.recv(protocol.RECV_SIZE)
+            except OSError:
+                break
+            
+            if data == b'':
+                break
+            
+            commands = self.receive(data)
+            if commands is None:
+                break
+            # Replies to every command of one read go out together, in one write, unless they add up
+            # to more than a write: then the writer sends them while the rest of the batch waits
+            self.client_socket.hold()
+            try:
+                for command in commands:
+                    self.dispatch(command)
+                    self.client_socket.catch_up(CATCH_UP_TIMEOUT)
+            finally:
+                self.client_socket.release()
+
+    # Runs however serve() ended, so a failed handler does not leave the user logged in
+    def close(self):
+        self.disconnected()
+        # Lets the writer send what is still queued, such as the reply to a failed login
+        self.client_socket.close()
+        self.writer.join(WRITER_CLOSE_TIMEOUT)
+        if self.writer.is_alive():
+            self.drop_slow_consumer()
+        self.connection.close()
+
+    # While more than one write's worth is queued the socket is corked, so the kernel sends full
+    # segments, and it is uncorked as soon as the queue is empty so the last frames are not held back
+    def write_loop(self):
+        corked = False
+        while True:
+            frames = self.client_socket.take(block=not corked)
+            if frames is None:
+                return
+            try:
+                if not frames:
+                    corked = set_cork(self.connection, False)
+                    continue
+                if not corked and self.client_socket.depth() > 0:
+                    corked = set_cork(self.connection, True)
+                send_frames(self.connection, self.outgoing(frames))
+            except OSError:
+                self.client_socket.close(discard=True)
+                return
+
+    # Unblocks both the reader and the writer, run() then cleans up as for any disconnect
+    def drop_slow_consumer(self):
+        log.error(f"Error: Disconnecting slow consumer {self.client_address}")
+        self.reap()
+
+    def reap(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# Serves one TCP client connection as a coroutine on the server's event loop
+# A second coroutine writes the connection's outbound queue to the stream
+class AsyncClientConnection(ClientHandler):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.outbound_ready = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        ClientHandler.__init__(self, writer.get_extra_info('peername'), open_outbound_queue(
+            writer.get_extra_info('peername'), on_ready=self.outbound_ready.set, on_overflow=self.drop_slow_consumer))
+
+    # Waits for a concurrent Future without blocking the event loop
+    # The callback may wait for something else in turn, such as the broker after a password check
+    async def wait_for(self, future, callback):
+        pending = callback(await asyncio.wrap_future(future))
+        if pending is not None:
+            await pending
+
+    async def run(self):
+        write_task = asyncio.create_task(self.write_loop())
+        try:
+            await self.serve()
+        finally:
+            await self.close(write_task)
+
+    async def serve(self):
+        while self.client_alive:
+            try:
+                data = await self.reader.read(protocol.RECV_SIZE)
+            except ConnectionError:
+                break
+
+            if data == b'':
+                break
+
+            commands = self.receive(data)
+            if commands is None:
+                break
+            for command in commands:
+                pending = self.dispatch(command)
+                # Commands from one client still run in order, other clients are served meanwhile
+                if pending is not None:
+                    await pending
+                # Gives the writer a turn when the replies so far add up to more than a write
+                elif self.client_socket.backlogged():
+                    await asyncio.sleep(0)
+
+    # Runs however serve() ended, so a failed handler does not leave the user logged in
+    async def close(self, write_task):
+        self.disconnected()
+        self.client_socket.close()
+        try:
+            await asyncio.wait_for(write_task, WRITER_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.drop_slow_consumer()
+        self.writer.close()
+
+    # Handlers only ever run on the event loop, so nothing can be queued between take() and clear()
+    async def write_loop(self):
+        while True:
+            frames = self.client_socket.take()
+            if frames is None:
+                return
+            if not frames:
+                self.outbound_ready.clear()
+                await self.outbound_ready.wait()
+                continue
+            self.writer.writelines(self.outgoing(frames))
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.client_socket.close(discard=True)
+                return
+
+    def drop_slow_consumer(self):
+        log.error(f"Error: Disconnecting slow consumer {self.client_address}")
+        self.writer.transport.abort()
+
+    # Called from the timer wheel's thread, the transport belongs to the event loop
+    def reap(self):
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+# TCP_CORK holds back partial segments until it is cleared, Linux only
+# Returns whether the socket is now corked
+def set_cork(connection, corked):
+    if hasattr(socket, "TCP_CORK"):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+        return corked
+    return False
+
+# Accept loop for the threaded mode, one thread per connection
+# Writers already send each batch of frames at once, so Nagle's algorithm would only delay replies
+# (asyncio sets TCP_NODELAY on its connections itself)
+def serve_threaded():
+    while True:
+        client_socket, client_address = server_tcp_socket.accept()
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        clientThread = ClientThread(client_address, client_socket)
+        clientThread.start()
+
+# Accept loop for the async mode, all connections share a single event loop
+async def serve_async():
+    async def handle_connection(reader, writer):
+        await AsyncClientConnection(reader, writer).run()
+
+    if broker_link is not None:
+        # Changes from the broker are applied on the event loop, like everything else in this mode
+        broker_link.schedule = asyncio.get_running_loop().call_soon_threadsafe
+        broker_link.start()
+    server_tcp_socket.setblocking(False)
+    server = await asyncio.start_server(handle_connection, sock=server_tcp_socket)
+    async with server:
+        await server.serve_forever()
+
+# Runs a copy of this server with the same options as worker number index
+def start_worker(index, broker_path):
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--worker-id", str(index), "--broker-path", broker_path]
+    # A session of its own keeps Ctrl-C away from the workers, the supervisor stops them in order
+    return subprocess.Popen(command, start_new_session=True)
+
+def stop_workers():
+    for process in worker_processes:
+        process.send_signal(signal.SIGINT)
+    for process in worker_processes:
+        try:
+            process.wait(WRITER_CLOSE_TIMEOUT * 2)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+# Starts the workers and restarts any that exit, until the supervisor itself is stopped
+def supervise(workers, server_port):
+    global broker
+    broker_path = os.path.join(tempfile.gettempdir(), f"server-{server_port}-{os.getpid()}.broker")
+    broker = Broker(broker_path, presence, groups, log_writer, history, state, credential_store)
+    for index in range(workers):
+        worker_processes.append(start_worker(index, broker_path))
+    print(f"\n===== Supervisor is running {workers} {server_mode} workers on port {server_port} =====")
+    while True:
+        time.sleep(WORKER_POLL_INTERVAL)
+        for index, process in enumerate(worker_processes):
+            if process.poll() is not None:
+                log.error(f"Error: Worker {index} exited with status {process.returncode}, restarting it")
+                worker_processes[index] = start_worker(index, broker_path)
+
+# Replaces the worker's presence registry and log writer with ones backed by the broker
+def connect_to_broker(broker_path, history_directory):
+    global broker_link, presence, log_writer, history
+    broker_link = BrokerLink(broker_path, worker_id)
+    presence = ReplicatedPresence(broker_link)
+    log_writer = RemoteLogWriter(broker_link)
+    history = RemoteHistory(broker_link, history_directory)
+    broker_link.handlers = {
+        "@login": lambda command: presence.apply_login(*command.args),
+        "@logout": lambda command: presence.apply_logout(command.args[0]),
+        "@udpport": lambda command: presence.apply_udp_port(*command.args),
+        "@block": lambda command: credential_store.block(*command.args),
+        "@group": lambda command: groups.create(command.args[0], list(command.args[2:]), command.args[1]),
+        "@join": lambda command: groups.join(*command.args),
+        "@deliver": lambda command: presence.deliver(*command.args),
+    }
+    broker_link.on_lost = broker_lost
+
+def broker_lost():
+    log.error("Error: Lost the connection to the supervisor")
+    os.kill(os.getpid(), signal.SIGINT)
+
+# What /stats and the stats endpoint report besides handler latencies and counters
+def register_gauges():
+    metrics.gauge("role", lambda: server_role if worker_id is None else f"worker {worker_id}")
+    metrics.gauge("connections", lambda: connection_count)
+    metrics.gauge("peak_connections", lambda: peak_connection_count)
+    metrics.gauge("compression", compression_stats.snapshot)
+    metrics.gauge("logged_in_users", lambda: len(presence))
+    metrics.gauge("groups", lambda: len(groups))
+    metrics.gauge("outbound", delivery_metrics.totals)
+    metrics.gauge("deepest_outbound_queues", lambda: [[str(name), depth] for name, depth in delivery_metrics.depths()[:10]])
+    metrics.gauge("log_lines_suppressed", lambda: log.total_suppressed)
+    if timers is not None:
+        metrics.gauge("timers", lambda: len(timers))
+    if relays is not None:
+        metrics.gauge("relays", relays.totals)
+    if server_role != "worker":
+        metrics.gauge("log_writer", log_writer.stats)
+        metrics.gauge("history", history.stats)
+        metrics.gauge("state", state.stats)
+
+def main():
+    global server_mode, max_invalid_attempts, server_tcp_socket, log_writer, userlog_snapshot, credential_store
+    global outbound_limit, outbound_policy, spill_directory, server_role, worker_id, group_snapshot
+    global log, profiler, profile_path, admins, relays, timers, idle_timeout, history, offline_delivery
+    global compression, compression_threshold, state
+
+    parser = argparse.ArgumentParser(usage="python3 server.py SERVER_PORT MAX_INVALID_ATTEMPTS [options]")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("max_invalid_attempts")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="threaded: one thread per connection, async: one event loop for all connections")
+    parser.add_argument("--log-fsync", choices=FSYNC_POLICIES, default="none",
+                        help="when log files are fsynced: none, once per batch of records, or after every record")
+    parser.add_argument("--userlog-interval", type=float, default=1.0,
+                        help="seconds between rewrites of userlog.txt from the presence registry")
+    parser.add_argument("--groups-file", default="groups.txt",
+                        help="where groups are saved, they are loaded from it again when the server starts")
+    parser.add_argument("--auth-workers", type=int, default=4,
+                        help="threads that check hashed passwords")
+    parser.add_argument("--outbound-limit", type=int, default=DEFAULT_LIMIT,
+                        help="bytes queued in memory for each connection before the backpressure policy applies")
+    parser.add_argument("--outbound-policy", choices=BACKPRESSURE_POLICIES, default="spill",
+                        help="what happens to messages for a client over its limit: drop them, disconnect it, or spill them to disk")
+    parser.add_argument("--spill-dir", default=None,
+                        help="directory for spill files (default: the system temporary directory)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT, more than 1 adds a supervisor")
+    parser.add_argument("--log-level", choices=LEVELS, default="info",
+                        help="debug shows every request, info what each did, warning refused requests, off nothing")
+    parser.add_argument("--log-rate", type=int, default=1000,
+                        help="console lines per second before further lines are dropped, 0 for no limit")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="serve /stats and /profile over HTTP on this localhost port (workers use the ports after it)")
+    parser.add_argument("--admins", default=None,
+                        help="comma separated users allowed to run /stats (default: every logged in user)")
+    parser.add_argument("--profile", default=None, metavar="FILE",
+                        help="sample every thread's stack while running and write collapsed stacks to FILE on shutdown")
+    parser.add_argument("--compression", choices=["zlib", "none"], default="zlib",
+                        help="compress what is sent to clients that offer it at login (zlib), or never")
+    parser.add_argument("--compression-threshold", type=int, default=protocol.COMPRESSION_THRESHOLD, metavar="BYTES",
+                        help="writes smaller than this are sent uncompressed")
+    parser.add_argument("--history-dir", default="history",
+                        help="where private and group messages are kept for /history, they survive restarts")
+    parser.add_argument("--history-segment-size", type=int, default=DEFAULT_SEGMENT_SIZE, metavar="BYTES",
+                        help="size at which a history segment is closed and compressed")
+    parser.add_argument("--state-dir", default="state",
+                        help="where groups, blocked accounts and sessions are kept across restarts, as a snapshot and a journal")
+    parser.add_argument("--snapshot-interval", type=float, default=DEFAULT_SNAPSHOT_INTERVAL,
+                        help="seconds between snapshots of the state while it changes")
+    parser.add_argument("--session-timeout", type=float, default=DEFAULT_SESSION_TIMEOUT,
+                        help="seconds a client has to reconnect and resume its session after its connection drops or the server restarts")
+    parser.add_argument("--offline-delivery", action="store_true",
+                        help="keep /msgto messages for users who are offline and send them when they log in")
+    parser.add_argument("--idle-timeout", type=float, default=60,
+                        help=f"seconds a client may send nothing, not even a heartbeat, before it is disconnected, at least {MIN_IDLE_TIMEOUT} (0: never)")
+    parser.add_argument("--relay", action="store_true",
+                        help="relay /p2pvideo files through the server for presenters that cannot reach their audience")
+    parser.add_argument("--relay-rate", type=int, default=DEFAULT_RATE, metavar="BYTES",
+                        help="bytes per second through one relay, 0 for no limit")
+    parser.add_argument("--relay-budget", type=int, default=DEFAULT_BUDGET, metavar="BYTES",
+                        help="bytes per second through all relays together, shared out between workers, 0 for no limit")
+    parser.add_argument("--relay-max", type=int, default=DEFAULT_MAX_RELAYS,
+                        help="relays open at once")
+    # Set by the supervisor when it starts a worker
+    parser.add_argument("--worker-id", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--broker-path", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.max_invalid_attempts.isdigit():
+        print("\n===== Error: Invalid value for MAX_INVALID_ATTEMPTS. Please provide an integer value. ======\n")
+        exit(0)
+
+    server_mode = args.mode
+    outbound_limit = args.outbound_limit
+    outbound_policy = args.outbound_policy
+    offline_delivery = args.offline_delivery
+    compression = args.compression
+    compression_threshold = args.compression_threshold
+    spill_directory = args.spill_dir
+    max_invalid_attempts = int(args.max_invalid_attempts)
+
+    if max_invalid_attempts < 1 or max_invalid_attempts > 5:
+        print("\n===== Error: Invalid number of allowed failed consecutive attempts:", max_invalid_attempts)
+        print("The valid value of argument number is an integer between 1 and 5 ======\n")
+        exit(0)
+
+    if 0 < args.idle_timeout < MIN_IDLE_TIMEOUT:
+        print(f"\n===== Error: Invalid idle timeout: {args.idle_timeout:g}")
+        print(f"Clients send a heartbeat every 15 seconds, the idle timeout has to be 0 or at least {MIN_IDLE_TIMEOUT} ======\n")
+        exit(0)
+
+    if args.worker_id is not None:
+        server_role = "worker"
+        worker_id = args.worker_id
+    elif args.workers > 1:
+        server_role = "supervisor"
+
+    log = ServerLog(args.log_level, args.log_rate)
+    if args.admins is not None:
+        admins = set(args.admins.split(","))
+    if args.profile is not None:
+        profile_path = args.profile if worker_id is None else f"{args.profile}.worker{worker_id}"
+        profiler = SamplingProfiler().start()
+
+    timers = TimerWheel()
+    # The supervisor keeps the log files and userlog.txt, workers serve the clients
+    if server_role != "worker":
+        log_writer = LogWriter(args.log_fsync)
+        log_writer.report = lambda message: log.error(message)
+        history = HistoryStore(args.history_dir, args.history_segment_size, args.log_fsync)
+        userlog_snapshot = UserlogSnapshot(presence, "userlog.txt", args.userlog_interval)
+        # Groups come back from the state store, from groups.txt only the first time the store is used
+        state = StateStore(args.state_dir, args.log_fsync, args.snapshot_interval, args.session_timeout, timers)
+        for name, creator, members, joined in state.group_list():
+            groups.create(name, members, creator, joined)
+        groups.journal = state.record
+        if not state.loaded_records:
+            groups.load(args.groups_file)
+        print(f"===== State: {state.loaded_records} records loaded ({state.replayed_records} from the journal) "
+              f"in {state.load_ms:.1f} ms, {len(state.sessions)} sessions can be resumed =====")
+        groups.attach(presence)
+        group_snapshot = GroupSnapshot(groups, args.groups_file, args.userlog_interval)
+    # With workers the supervisor's store only counts failed logins, the broker journals the blocks
+    # and workers hear of them with @block
+    credential_store = CredentialStore("credentials.txt", max_invalid_attempts, workers=args.auth_workers, timers=timers)
+    credential_store.warn = lambda message: log.warning(message)
+    if server_role != "worker":
+        credential_store.journal = state.record
+        for username, until in state.blocked_list():
+            credential_store.block(username, until)
+    if args.stats_port is not None:
+        start_stats_server(metrics, args.stats_port if worker_id is None else args.stats_port + 1 + worker_id)
+    if server_role == "supervisor":
+        register_gauges()
+        signal.signal(signal.SIGINT, shutdown_server)
+        supervise(args.workers, args.server_port)
+
+    idle_timeout = args.idle_timeout
+    if server_role == "worker":
+        connect_to_broker(args.broker_path, args.history_dir)
+        groups.attach(presence)
+    if args.relay:
+        # Clients reach the relays of the worker they are connected to, each worker gets its share of the budget
+        relays = RelayServer(server_host, args.relay_rate, args.relay_budget // args.workers, args.relay_max)
+    register_gauges()
+
+    server_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if server_role == "worker":
+        # Every worker listens on the same port, the kernel spreads new connections between them
+        server_tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_tcp_socket.bind((server_host, args.server_port))
+    server_tcp_socket.listen(socket.SOMAXCONN)
+
+    signal.signal(signal.SIGINT, shutdown_server)
+
+    if server_role == "worker":
+        print(f"===== Worker {worker_id} is running ({server_mode} mode) =====")
+    else:
+        print(f"\n===== Server is running ({server_mode} mode) =====")
 
-print("\n===== Server is running =====")
+    if server_mode == "async":
+        asyncio.run(serve_async())
+    else:
+        if broker_link is not None:
+            broker_link.start()
+        serve_threaded()
 
-while True:
-    server_tcp_socket.listen()
-    client_socket, client_address = server_tcp_socket.accept()
-    clientThread = ClientThread(client_address, client_socket)
-    clientThread.start()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
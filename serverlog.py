@@ -0,0 +1,58 @@
+# Leveled, rate limited console log for the server, replaces a print() for every request
+#
+#   debug    every request as it arrives
+#   info     what each request did, connections opening and closing (the default)
+#   warning  requests that were refused, such as a wrong password or an unknown group
+#   error    problems with the server or with a connection
+#   off      nothing at all
+# Past --log-rate lines in one second further lines are dropped, and once lines are allowed
+# again a single line says how many were dropped.
+import sys
+import threading
+import time
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+
+class ServerLog:
+    def __init__(self, level="info", rate=1000, stream=None):
+        self.threshold = LEVELS[level]
+        self.rate = rate # Lines per second, 0 for no limit
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+        self.second = 0
+        self.lines_this_second = 0
+        self.suppressed = 0 # Dropped since the last line written
+        self.total_suppressed = 0
+
+    def enabled(self, level):
+        return LEVELS[level] >= self.threshold
+
+    def write(self, level, message):
+        if level < self.threshold:
+            return
+        second = int(time.monotonic())
+        with self.lock:
+            if second != self.second:
+                self.second = second
+                self.lines_this_second = 0
+                if self.suppressed:
+                    self.stream.write(f"===== {self.suppressed} log lines suppressed =====\n")
+                    self.suppressed = 0
+            if self.rate and self.lines_this_second >= self.rate:
+                self.suppressed += 1
+                self.total_suppressed += 1
+                return
+            self.lines_this_second += 1
+            self.stream.write(f"===== {message} =====\n")
+
+    def debug(self, message):
+        self.write(10, message)
+
+    def info(self, message):
+        self.write(20, message)
+
+    def warning(self, message):
+        self.write(30, message)
+
+    def error(self, message):
+        self.write(40, message)
@@ -0,0 +1,340 @@
+# Server state kept across restarts: groups and who has joined them, blocked accounts and login sessions
+#
+# The state is kept in two kinds of file in the state directory. state/snapshot holds the whole state
+# as of one moment. state/journal.N holds every change made since then, as a write-ahead journal.
+# Both hold frames in the wire format (protocol.encode), one per record:
+#   @group NAME CREATOR MEMBER...                       a group and its members, the creator has joined it
+#   @join NAME USERNAME                                 a member joined a group
+#   @blocked USERNAME UNTIL                             an account blocked until UNTIL (seconds since the epoch)
+#   @session USERNAME TOKEN TIMESTAMP IP_ADDRESS UDP_PORT   a login a client can resume with its token
+#   @endsession USERNAME                                the user logged out, or did not come back in time
+# Every record sets something, so replaying a record that the snapshot already includes changes nothing.
+#
+# A session with no connection on it, after its connection dropped or the server restarted, is ended
+# by a timer on the timer wheel (timerwheel.py) unless a client resumes it within the session timeout.
+# Which connections are on a session is not journaled: after a restart no session has any.
+#
+# A change is applied to the store's own copy of the state and queued for the journal, both under one
+# lock, so the copy and the journal see changes in the same order. One writer thread appends the
+# queued records in batches, each with its length and CRC32 (JOURNAL_RECORD), fsynced by the
+# --log-fsync policy. A snapshot is taken every interval (or sooner once the journal has
+# SNAPSHOT_RECORDS records). The writer switches to the next journal file, writes the copy to
+# snapshot.tmp, fsyncs it and renames it over snapshot, and only then removes the older journals.
+# The snapshot names the first journal to replay after it. A crash at any point therefore leaves a
+# complete snapshot and every journal written since. A record cut short at the end of the last
+# journal is dropped when the journal is loaded.
+import os
+import queue
+import secrets
+import struct
+import threading
+import time
+import zlib
+
+import protocol
+from timerwheel import TimerWheel
+
+SNAPSHOT_HEADER = struct.Struct("!4sQII") # magic, first journal to replay, body length, CRC32 of the body
+SNAPSHOT_MAGIC = b"SST1"
+JOURNAL_RECORD = struct.Struct("!II") # frame length, CRC32 of the frame
+DEFAULT_SNAPSHOT_INTERVAL = 60 # Seconds between snapshots while anything changes
+SNAPSHOT_RECORDS = 10000 # Journal records that bring the next snapshot forward
+DEFAULT_SESSION_TIMEOUT = 300 # Seconds a client has to resume its session once it has no connection
+MAX_BATCH = 1024 # Records written per pass
+
+# Marks the end of the queue when the store is closed
+STOP = object()
+
+def new_token():
+    return secrets.token_hex(16)
+
+class Session:
+    __slots__ = ("username", "token", "timestamp", "ip_address", "udp_port")
+
+    def __init__(self, username, token, timestamp, ip_address, udp_port):
+        self.username = username
+        self.token = token
+        self.timestamp = timestamp
+        self.ip_address = ip_address
+        self.udp_port = udp_port
+
+class StateStore:
+    def __init__(self, directory, fsync_policy="none", interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 session_timeout=DEFAULT_SESSION_TIMEOUT, timers=None):
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.interval = interval
+        self.session_timeout = session_timeout
+        self.timers = timers if timers is not None else TimerWheel()
+        self.snapshot_path = os.path.join(directory, "snapshot")
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.groups = {} # name -> [creator, members, joined set]
+        self.blocked = {} # username -> time the block ends
+        self.sessions = {} # username -> Session
+        self.tokens = {} # token -> username
+        self.connections = {} # username -> connections on their session
+        self.expiry_timers = {} # username -> timer that ends their session, while it has no connection
+
+        self.queue = queue.Queue()
+        self.journal = None
+        self.journal_number = 0
+        self.journaled = 0 # Records in the journals since the last snapshot
+
+        self.records = 0
+        self.snapshots = 0
+        self.last_snapshot_ms = 0.0
+        self.loaded_records = 0 # From the snapshot and the journals at startup
+        self.replayed_records = 0 # Of those, from the journals
+        self.load_ms = 0.0
+
+        self.load()
+        self.thread = threading.Thread(target=self.run, name="state-writer", daemon=True)
+        self.thread.start()
+
+    def journal_path(self, number):
+        return os.path.join(self.directory, f"journal.{number}")
+
+    # Reads the snapshot and replays the journals written after it
+    def load(self):
+        started = time.perf_counter()
+        decoder = protocol.FrameDecoder()
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as file:
+                data = file.read()
+            magic, self.journal_number, length, checksum = SNAPSHOT_HEADER.unpack_from(data)
+            body = data[SNAPSHOT_HEADER.size:]
+            if magic != SNAPSHOT_MAGIC or len(body) != length or zlib.crc32(body) != checksum:
+                raise ValueError(f"{self.snapshot_path} is not a complete state snapshot")
+            for command in decoder.feed(body):
+                self.apply(command)
+                self.loaded_records += 1
+
+        numbers = sorted(int(name.split(".", 1)[1]) for name in os.listdir(self.directory)
+                         if name.startswith("journal.") and name.split(".", 1)[1].isdigit())
+        for number in numbers:
+            if number < self.journal_number:
+                os.remove(self.journal_path(number)) # Already in the snapshot
+                continue
+            for command in decoder.feed(self.read_journal(number)):
+                self.apply(command)
+                self.replayed_records += 1
+            self.journal_number = number
+        self.loaded_records += self.replayed_records
+        self.journaled = self.replayed_records
+
+        now = time.time()
+        self.blocked = {username: until for username, until in self.blocked.items() if until > now}
+        # No connection survived the restart
+        self.connections.clear()
+        for username in self.sessions:
+            self.schedule_end(username)
+        self.journal = open(self.journal_path(self.journal_number), "ab")
+        self.load_ms = (time.perf_counter() - started) * 1000
+
+    # Returns the frames of every complete record, and cuts off a record the server was still writing
+    def read_journal(self, number):
+        path = self.journal_path(number)
+        with open(path, "rb") as file:
+            data = file.read()
+        frames = []
+        offset = 0
+        while offset + JOURNAL_RECORD.size <= len(data):
+            length, checksum = JOURNAL_RECORD.unpack_from(data, offset)
+            frame = data[offset + JOURNAL_RECORD.size:offset + JOURNAL_RECORD.size + length]
+            if len(frame) != length or zlib.crc32(frame) != checksum:
+                break
+            frames.append(frame)
+            offset += JOURNAL_RECORD.size + length
+        if offset != len(data):
+            with open(path, "r+b") as file:
+                file.truncate(offset)
+        return b"".join(frames)
+
+    # Called with the lock held, or while loading
+    def apply(self, command):
+        name, args = command.name, command.args
+        if name == "@group":
+            if args[0] not in self.groups:
+                self.groups[args[0]] = [args[1], list(args[2:]), {args[1]}]
+        elif name == "@join":
+            group = self.groups.get(args[0])
+            if group is not None:
+                group[2].add(args[1])
+        elif name == "@blocked":
+            self.blocked[args[0]] = args[1]
+        elif name == "@session":
+            # A connection resuming the session joins those already on it, a new login starts afresh
+            session = self.sessions.get(args[0])
+            connections = self.connections.get(args[0], 0) if session is not None and session.token == args[1] else 0
+            self.end_session(args[0])
+            self.sessions[args[0]] = Session(*args)
+            self.tokens[args[1]] = args[0]
+            self.connections[args[0]] = connections + 1
+        elif name == "@endsession":
+            self.end_session(args[0])
+
+    def end_session(self, username):
+        session = self.sessions.pop(username, None)
+        if session is not None:
+            self.tokens.pop(session.token, None)
+        self.connections.pop(username, None)
+        timer = self.expiry_timers.pop(username, None)
+        if timer is not None:
+            self.timers.cancel(timer)
+
+    # Applies a change and queues it for the journal, the arguments are those of one of the records above
+    def record(self, name, *args):
+        frame = protocol.encode(name, *args)
+        with self.lock:
+            self.apply(protocol.Command(name, args))
+            self.queue.put(frame)
+
+    # The session a token belongs to, or None once it has ended
+    def resume(self, token):
+        with self.lock:
+            username = self.tokens.get(token)
+            if username is None:
+                return None
+            # The @session record of the resuming connection cancels the timer that would end it
+            return self.sessions[username]
+
+    # A connection on the user's session dropped, the session ends if none is left on it within the
+    # session timeout. token, if given, has to be the session's, so a connection that drops after
+    # its user logged in again elsewhere leaves the new session alone.
+    def detach(self, username, token=None):
+        with self.lock:
+            session = self.sessions.get(username)
+            if session is None or (token and session.token != token):
+                return
+            self.connections[username] = self.connections.get(username, 1) - 1
+            if self.connections[username] <= 0:
+                self.schedule_end(username)
+
+    # Called with the lock held, or while loading
+    def schedule_end(self, username):
+        timer = self.expiry_timers.get(username)
+        if timer is not None:
+            self.timers.cancel(timer)
+        token = self.sessions[username].token
+        self.expiry_timers[username] = self.timers.schedule(self.session_timeout, lambda: self.expire(username, token))
+
+    # Runs on the timer wheel, ends the session unless a connection came back on it
+    def expire(self, username, token):
+        with self.lock:
+            session = self.sessions.get(username)
+            if session is None or session.token != token or self.connections.get(username, 0) > 0:
+                return
+            self.expiry_timers.pop(username, None)
+        self.record("@endsession", username)
+
+    # Groups as (name, creator, members, joined), blocks as (username, until) and sessions, to restore the registries
+    def group_list(self):
+        with self.lock:
+            return [(name, creator, list(members), list(joined)) for name, (creator, members, joined) in self.groups.items()]
+
+    def blocked_list(self):
+        now = time.time()
+        with self.lock:
+            return [(username, until) for username, until in self.blocked.items() if until > now]
+
+    # Called with the lock held, the whole state as records
+    def dump(self):
+        frames = []
+        for name, (creator, members, joined) in self.groups.items():
+            frames.append(protocol.encode("@group", name, creator, *members))
+            for username in joined:
+                if username != creator:
+                    frames.append(protocol.encode("@join", name, username))
+        now = time.time()
+        for username, until in self.blocked.items():
+            if until > now:
+                frames.append(protocol.encode("@blocked", username, until))
+        for session in self.sessions.values():
+            frames.append(protocol.encode("@session", session.username, session.token, session.timestamp,
+                                          session.ip_address, session.udp_port))
+        return frames
+
+    def run(self):
+        next_snapshot = time.monotonic() + self.interval
+        while True:
+            try:
+                batch = [self.queue.get(timeout=max(next_snapshot - time.monotonic(), 0))]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = bool(batch) and batch[-1] is STOP
+            if stopping:
+                batch.pop()
+            self.write_batch(batch)
+            if stopping or self.journaled >= SNAPSHOT_RECORDS or (self.journaled and time.monotonic() >= next_snapshot):
+                self.snapshot()
+            if time.monotonic() >= next_snapshot:
+                next_snapshot = time.monotonic() + self.interval
+            if stopping:
+                self.journal.close()
+                return
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        self.journal.write(b"".join(JOURNAL_RECORD.pack(len(frame), zlib.crc32(frame)) + frame for frame in batch))
+        self.journal.flush()
+        if self.fsync_policy != "none":
+            os.fsync(self.journal.fileno())
+        self.journaled += len(batch)
+        self.records += len(batch)
+
+    # Runs on the writer thread, between batches
+    def snapshot(self):
+        started = time.perf_counter()
+        with self.lock:
+            body = b"".join(self.dump())
+        # Records queued from here on go to the next journal, replaying one the snapshot has already is harmless
+        self.journal.close()
+        previous = self.journal_number
+        self.journal_number += 1
+        self.journal = open(self.journal_path(self.journal_number), "ab")
+        self.journaled = 0
+
+        temporary = self.snapshot_path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.journal_number, len(body), zlib.crc32(body)))
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.snapshot_path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        for number in range(previous, self.journal_number):
+            if os.path.exists(self.journal_path(number)):
+                os.remove(self.journal_path(number))
+        self.snapshots += 1
+        self.last_snapshot_ms = (time.perf_counter() - started) * 1000
+
+    # Writes what is still queued and a last snapshot, so the next start replays nothing
+    def close(self):
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            "groups": len(self.groups),
+            "sessions": len(self.sessions),
+            "blocked": len(self.blocked),
+            "records": self.records,
+            "journaled_since_snapshot": self.journaled,
+            "snapshots": self.snapshots,
+            "last_snapshot_ms": self.last_snapshot_ms,
+            "loaded_records": self.loaded_records,
+            "replayed_records": self.replayed_records,
+            "load_ms": self.load_ms,
+        }
@@ -0,0 +1,179 @@
+# Tests of the broker shared by the worker processes (broker.py), over a real Unix socket
+#
+# Usage: python3 -m pytest -q
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import broker
+from credentials import CredentialStore
+from groups import GroupRegistry
+from presence import PresenceRegistry
+from state import StateStore
+from timerwheel import TimerWheel
+
+REPLY_TIMEOUT = 5
+
+class Worker:
+    def __init__(self, path, worker_id):
+        self.received = []
+        self.changed = threading.Condition()
+        self.link = broker.BrokerLink(path, worker_id)
+        self.link.handlers = {name: self.record for name in ("@login", "@logout", "@udpport", "@block", "@group", "@join", "@deliver")}
+        self.link.start()
+
+    def record(self, command):
+        with self.changed:
+            self.received.append((command.name, command.args))
+            self.changed.notify_all()
+
+    # Waits until the broker has sent a change that matches
+    def wait_for(self, predicate):
+        with self.changed:
+            assert self.changed.wait_for(lambda: any(predicate(name, args) for name, args in self.received), REPLY_TIMEOUT)
+
+    def request(self, name, *args):
+        return self.link.request(name, *args).result(REPLY_TIMEOUT)
+
+    def close(self):
+        self.link.close()
+
+@pytest.fixture
+def supervisor(tmp_path):
+    timers = TimerWheel()
+    state = StateStore(str(tmp_path / "state"), timers=timers)
+    credentials = CredentialStore(str(tmp_path / "credentials.txt"), 3, timers=timers)
+    supervisor = broker.Broker(str(tmp_path / "broker.sock"), PresenceRegistry(), GroupRegistry(), None, None, state, credentials)
+    yield supervisor
+    supervisor.close()
+    credentials.close()
+    state.close()
+    timers.close()
+
+@pytest.fixture
+def worker(supervisor):
+    worker = Worker(supervisor.path, 0)
+    yield worker
+    worker.close()
+
+@pytest.fixture
+def other_worker(supervisor):
+    worker = Worker(supervisor.path, 1)
+    yield worker
+    worker.close()
+
+def test_group_without_members_is_turned_down(supervisor, worker):
+    assert worker.request("@creategroup", "g1") == "A group needs at least one member."
+    assert "g1" not in supervisor.groups
+
+def test_failing_request_is_answered_and_the_link_keeps_working(supervisor, worker, monkeypatch, capsys):
+    def broken(*args, **kwargs):
+        raise RuntimeError("broken")
+    with monkeypatch.context() as patch:
+        patch.setattr(supervisor.groups, "create", broken)
+        assert worker.request("@creategroup", "g1", "alice") == "The request failed."
+    assert "RuntimeError" in capsys.readouterr().err
+    assert worker.request("@creategroup", "g1", "alice") == ""
+    worker.wait_for(lambda name, args: name == "@group" and args[0] == "g1")
+
+def test_route_sends_one_deliver_per_worker(worker, other_worker):
+    for username, token in (("bob", "1:1"), ("carol", "1:2")):
+        other_worker.link.send("@login", username, token, "now", "127.0.0.1", 5000)
+    worker.wait_for(lambda name, args: name == "@login" and args[0] == "carol")
+    worker.link.send("@route", b"frame", "bob", "dave", "carol")
+    other_worker.wait_for(lambda name, args: name == "@deliver")
+    # A request answered after the @route means the broker is done with it
+    assert worker.request("@resume", "no such token") == ""
+    deliveries = [args for name, args in other_worker.received if name == "@deliver"]
+    assert deliveries == [(b"frame", "bob", "carol")]
+
+def test_replicated_presence_routes_remote_recipients_together():
+    class Link:
+        worker_id = 0
+        def __init__(self):
+            self.sent = []
+        def send(self, *args):
+            self.sent.append(args)
+    class Connection:
+        def __init__(self):
+            self.frames = []
+        def sendall(self, frame):
+            self.frames.append(frame)
+    link, alice = Link(), Connection()
+    presence = broker.ReplicatedPresence(link)
+    presence.login("alice", alice, "now", "127.0.0.1", 5000)
+    presence.apply_login("bob", "1:1", "now", "127.0.0.1", 5000)
+    presence.apply_login("carol", "1:2", "now", "127.0.0.1", 5000)
+    link.sent.clear()
+    presence.send_to(["alice", "bob", "carol", "dave"], b"frame")
+    assert alice.frames == [b"frame"]
+    assert link.sent == [("@route", b"frame", "bob", "carol")]
+
+def test_failed_logins_are_counted_across_workers(supervisor, worker, other_worker):
+    assert worker.request("@failure", "alice") == ""
+    assert other_worker.request("@failure", "alice") == ""
+    assert worker.request("@failure", "alice") == "locked"
+    for each in (worker, other_worker):
+        each.wait_for(lambda name, args: name == "@block" and args[0] == "alice")
+    assert "alice" in dict(supervisor.state.blocked_list())
+
+def test_successful_login_clears_the_count(supervisor, worker, other_worker):
+    for _ in range(2):
+        assert worker.request("@failure", "alice") == ""
+    other_worker.link.send("@success", "alice")
+    assert other_worker.request("@resume", "no such token") == ""
+    assert worker.request("@failure", "alice") == ""
+
+def test_new_worker_gets_the_current_state(supervisor, worker):
+    worker.link.send("@login", "alice", "0:1", "now", "127.0.0.1", 5000)
+    assert worker.request("@creategroup", "g1", "alice", "bob") == ""
+    worker.link.send("@join", "g1", "bob")
+    assert worker.request("@failure", "carol") == ""
+    for _ in range(2):
+        worker.request("@failure", "carol")
+    late = Worker(supervisor.path, 1)
+    try:
+        late.wait_for(lambda name, args: name == "@block")
+        assert [(name, args[0]) for name, args in late.received] == [
+            ("@login", "alice"), ("@group", "g1"), ("@join", "g1"), ("@block", "carol")]
+        assert late.received[2][1] == ("g1", "bob")
+    finally:
+        late.close()
+
+def test_users_of_a_worker_that_exits_are_logged_out(supervisor, worker):
+    other = Worker(supervisor.path, 1)
+    other.link.send("@login", "bob", "1:7", "now", "127.0.0.1", 5000)
+    other.link.send("@session", "bob", "token", "now", "127.0.0.1", 5000)
+    worker.wait_for(lambda name, args: name == "@login" and args[0] == "bob")
+    # As when its process exits, close() alone leaves the socket open under the reader thread
+    other.link.sock.shutdown(socket.SHUT_RDWR)
+    other.close()
+    worker.wait_for(lambda name, args: name == "@logout" and args[0] == "bob")
+    assert "bob" not in supervisor.presence
+    # The session waits to be resumed on another worker
+    assert supervisor.state.resume("token").username == "bob"
+
+def test_logout_and_udp_port_only_from_the_owning_connection(supervisor, worker):
+    worker.link.send("@login", "alice", "0:1", "now", "127.0.0.1", 5000)
+    worker.link.send("@logout", "alice", "0:2")
+    worker.link.send("@udpport", "alice", "0:2", 6000)
+    worker.link.send("@udpport", "alice", "0:1", 7000)
+    worker.wait_for(lambda name, args: name == "@udpport")
+    assert [name for name, args in worker.received] == ["@login", "@udpport"]
+    assert supervisor.presence.get("alice").udp_port == 7000
+    worker.link.send("@logout", "alice", "")
+    worker.wait_for(lambda name, args: name == "@logout")
+    assert "alice" not in supervisor.presence
+
+def test_join_goes_to_the_other_workers(supervisor, worker, other_worker):
+    assert worker.request("@creategroup", "g1", "alice", "bob") == ""
+    worker.link.send("@join", "g1", "bob")
+    worker.link.send("@join", "nowhere", "bob")
+    other_worker.wait_for(lambda name, args: name == "@join")
+    assert worker.request("@resume", "no such token") == ""
+    assert [name for name, args in worker.received] == ["@group"]
+    assert [args for name, args in other_worker.received if name == "@join"] == [("g1", "bob")]
@@ -0,0 +1,72 @@
+# Tests of the credential store (credentials.py): password checks, lockouts and their timers
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import credentials
+from timerwheel import TimerWheel
+
+def test_store_uses_the_wheel_it_is_given_even_when_empty():
+    timers = TimerWheel()
+    store = credentials.CredentialStore("missing-credentials.txt", 3, timers=timers)
+    try:
+        assert len(timers) == 0
+        assert store.timers is timers
+        store.record_failure("alice")
+        assert len(timers) == 1
+    finally:
+        store.close()
+        timers.close()
+
+def test_hashed_and_plain_passwords(tmp_path):
+    path = tmp_path / "credentials.txt"
+    path.write_text(f"alice {credentials.hash_password('secret', iterations=1000)}\nbob plain\n")
+    timers = TimerWheel()
+    store = credentials.CredentialStore(str(path), 3, timers=timers)
+    try:
+        assert store.check_password("alice", "secret").result() is True
+        assert store.check_password("alice", "wrong").result() is False
+        assert store.check_password("bob", "plain").result() is True
+        assert store.check_password("carol", "x").result() is None
+    finally:
+        store.close()
+        timers.close()
+
+def test_account_is_blocked_after_too_many_failures():
+    timers = TimerWheel()
+    store = credentials.CredentialStore("missing-credentials.txt", 2, timers=timers)
+    blocked = []
+    store.journal = lambda *args: blocked.append(args)
+    try:
+        assert store.record_failure("alice") is False
+        assert store.record_failure("alice") is True
+        assert store.is_blocked("alice")
+        assert [args[:2] for args in blocked] == [("@blocked", "alice")]
+    finally:
+        store.close()
+        timers.close()
+
+def test_unusable_hash_fails_the_login_and_is_reported_once(tmp_path):
+    path = tmp_path / "credentials.txt"
+    good = credentials.hash_password("secret", iterations=1000)
+    path.write_text("\n".join([
+        f"alice {good}",
+        "bob pbkdf2_sha256$1000$abcd",
+        "carol pbkdf2_sha256$many$abcd$abcd",
+        "dave pbkdf2_sha256$1000$not-hex$abcd",
+        f"erin {good[:-1]}é",
+    ]) + "\n")
+    timers = TimerWheel()
+    store = credentials.CredentialStore(str(path), 3, timers=timers)
+    warnings = []
+    store.warn = warnings.append
+    try:
+        for username in ("bob", "carol", "dave", "erin"):
+            assert store.check_password(username, "secret").result() is False
+        assert store.check_password("alice", "secret").result() is True
+        assert len(warnings) == 4
+    finally:
+        store.close()
+        timers.close()
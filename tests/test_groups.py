@@ -0,0 +1,88 @@
+# Tests of the group registry (groups.py): membership, who is online, the reverse index and groups.txt
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from groups import GroupRegistry, GroupSnapshot
+from presence import PresenceRegistry
+
+class Connection:
+    def sendall(self, frame):
+        pass
+
+def registry_with_presence(*online):
+    presence = PresenceRegistry()
+    groups = GroupRegistry()
+    groups.attach(presence)
+    for username in online:
+        presence.login(username, Connection(), "now", "127.0.0.1", 5000)
+    return presence, groups
+
+def test_creator_has_joined_and_a_name_is_taken_once():
+    presence, groups = registry_with_presence("alice")
+    group = groups.create("g1", ["alice", "bob"])
+    assert (group.creator, group.joined, group.recipients()) == ("alice", {"alice"}, ["alice"])
+    assert groups.create("g1", ["bob"]) is None
+    assert groups.get("g1") is group and len(groups) == 1
+
+def test_recipients_are_the_joined_members_online():
+    presence, groups = registry_with_presence("alice", "bob")
+    groups.create("g1", ["alice", "bob", "carol"])
+    assert sorted(groups.get("g1").recipients()) == ["alice"]
+    assert groups.join("g1", "bob") and not groups.join("g1", "bob")
+    groups.join("g1", "carol")
+    assert sorted(groups.get("g1").recipients()) == ["alice", "bob"]
+    presence.login("carol", Connection(), "now", "127.0.0.1", 5000)
+    presence.logout("alice")
+    assert sorted(groups.get("g1").recipients()) == ["bob", "carol"]
+    # A member who has not joined is not a recipient when they log in
+    groups.create("g2", ["bob", "dave"])
+    presence.login("dave", Connection(), "now", "127.0.0.1", 5000)
+    assert groups.get("g2").recipients() == ["bob"]
+
+def test_each_user_knows_their_groups():
+    presence, groups = registry_with_presence()
+    groups.create("g1", ["alice", "bob"])
+    groups.create("g2", ["bob"])
+    assert groups.groups_of("bob") == {"g1", "g2"}
+    assert groups.groups_of("alice") == {"g1"}
+    assert groups.groups_of("carol") == set()
+
+def test_every_change_is_journaled():
+    presence, groups = registry_with_presence()
+    records = []
+    groups.journal = lambda *record: records.append(record)
+    groups.create("g1", ["alice", "bob"], joined=["bob"])
+    groups.join("g1", "bob")
+    groups.create("g2", ["carol"])
+    groups.join("g2", "dave")
+    assert records == [("@group", "g1", "alice", "alice", "bob"), ("@join", "g1", "bob"),
+                       ("@group", "g2", "carol", "carol"), ("@join", "g2", "dave")]
+
+def test_groups_file_round_trip(tmp_path):
+    path = str(tmp_path / "groups.txt")
+    presence, groups = registry_with_presence()
+    groups.create("g2", ["bob", "alice"])
+    groups.create("g1", ["alice", "bob", "carol"])
+    groups.join("g1", "carol")
+    snapshot = GroupSnapshot(groups, path, interval=3600)
+    snapshot.close()
+    with open(path) as file:
+        assert file.read().splitlines() == ["g1; alice; alice bob carol; alice carol", "g2; bob; alice bob; bob"]
+    loaded = GroupRegistry()
+    loaded.load(path)
+    assert loaded.lines()[1] == groups.lines()[1]
+
+def test_groups_file_lines_without_members_are_skipped(tmp_path):
+    path = tmp_path / "groups.txt"
+    path.write_text("empty; ; ; \nbroken line\ng1; alice; alice; alice\n")
+    groups = GroupRegistry()
+    groups.load(str(path))
+    assert list(groups) == ["g1"]
+
+def test_missing_groups_file_loads_nothing(tmp_path):
+    groups = GroupRegistry()
+    groups.load(str(tmp_path / "groups.txt"))
+    assert len(groups) == 0
@@ -0,0 +1,124 @@
+# Tests of the chat history store (history.py): pages, pending messages, segments and recovery after a crash
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import history
+from history import HistoryReader, HistoryStore, group_conversation, private_conversation
+
+CHAT = private_conversation("bob", "alice")
+
+def fill(directory, count, conversation=CHAT, first=0, **options):
+    store = HistoryStore(directory, **options)
+    for number in range(first, first + count):
+        store.append(conversation, "alice", "now", f"message {number}")
+    store.close()
+    return store
+
+def texts(messages):
+    return [message.text for message in messages]
+
+def segment_files(directory):
+    return sorted(os.listdir(os.path.join(directory, "segments")))
+
+def test_pages_go_back_from_before(tmp_path):
+    directory = str(tmp_path)
+    store = fill(directory, 10)
+    store = HistoryStore(directory)
+    store.append(group_conversation("team"), "bob", "now", "elsewhere")
+    store.close()
+    messages, older = store.page(CHAT, limit=4)
+    assert texts(messages) == [f"message {number}" for number in range(6, 10)] and older
+    assert [message.id for message in messages] == [7, 8, 9, 10]
+    messages, older = store.page(CHAT, before=7, limit=4)
+    assert texts(messages) == [f"message {number}" for number in range(2, 6)] and older
+    messages, older = store.page(CHAT, before=3, limit=4)
+    assert texts(messages) == ["message 0", "message 1"] and not older
+    assert store.page(CHAT, before=1) == ([], False)
+    assert store.page(private_conversation("carol", "dave")) == ([], False)
+    assert texts(store.page(group_conversation("team"))[0]) == ["elsewhere"]
+
+def test_pending_messages_are_cleared_once_sent(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    for number in range(3):
+        store.append(CHAT, "alice", "now", f"message {number}", pending_for="bob")
+    store.clear_pending("bob", 2)
+    store.append(CHAT, "alice", "now", "message 3", pending_for="bob")
+    store.close()
+    assert texts(store.pending("bob")) == ["message 2", "message 3"]
+    store = HistoryStore(str(tmp_path))
+    store.clear_pending("bob", 2)
+    store.close()
+    assert store.pending("bob") == []
+    assert len(store.page(CHAT)[0]) == 4
+
+def test_ids_go_on_after_a_restart(tmp_path):
+    directory = str(tmp_path)
+    fill(directory, 3)
+    fill(directory, 2, first=3)
+    messages, _ = HistoryReader(directory).page(CHAT)
+    assert [message.id for message in messages] == [1, 2, 3, 4, 5]
+
+def test_a_record_cut_short_by_a_crash_is_dropped(tmp_path):
+    directory = str(tmp_path)
+    fill(directory, 3)
+    (name,) = segment_files(directory)
+    path = os.path.join(directory, "segments", name)
+    size = os.path.getsize(path)
+    # Half of a fourth record made it to the segment, its index entry was never written
+    body = b'["@alice,bob", "alice", "now", "lost"]'
+    with open(path, "ab") as file:
+        file.write((history.RECORD.pack(len(body), 4) + body)[:20])
+    store = HistoryStore(directory)
+    assert os.path.getsize(path) == size
+    store.append(CHAT, "alice", "now", "message 3")
+    store.close()
+    messages, _ = store.page(CHAT)
+    assert texts(messages) == [f"message {number}" for number in range(4)]
+    assert [message.id for message in messages] == [1, 2, 3, 4]
+
+def test_a_cut_record_header_is_dropped(tmp_path):
+    directory = str(tmp_path)
+    fill(directory, 2)
+    (name,) = segment_files(directory)
+    path = os.path.join(directory, "segments", name)
+    with open(path, "ab") as file:
+        file.write(b"\0\0\0")
+    fill(directory, 1, first=2)
+    assert texts(HistoryReader(directory).page(CHAT)[0]) == ["message 0", "message 1", "message 2"]
+
+def test_closed_segments_are_compressed_and_still_read(tmp_path):
+    directory = str(tmp_path)
+    fill(directory, 50, segment_size=500)
+    files = segment_files(directory)
+    assert files[-1].endswith(".seg") and all(name.endswith(".zseg") for name in files[:-1])
+    reader = HistoryReader(directory)
+    messages, _ = reader.page(CHAT, limit=history.MAX_PAGE_SIZE)
+    assert texts(messages) == [f"message {number}" for number in range(50)]
+    assert texts(reader.page(CHAT, before=26, limit=3)[0]) == ["message 22", "message 23", "message 24"]
+
+def test_segments_left_uncompressed_are_compressed_at_startup(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    with monkeypatch.context() as patch:
+        # Stopped before any closed segment was compressed
+        patch.setattr(HistoryStore, "compress_later", lambda self, first_id: None)
+        fill(directory, 20, segment_size=500)
+    assert all(name.endswith(".seg") for name in segment_files(directory))
+    HistoryStore(directory).close()
+    files = segment_files(directory)
+    assert files[-1].endswith(".seg") and all(name.endswith(".zseg") for name in files[:-1])
+    assert len(HistoryReader(directory).page(CHAT, limit=history.MAX_PAGE_SIZE)[0]) == 20
+
+def test_stopped_between_closing_a_segment_and_starting_the_next(tmp_path):
+    directory = str(tmp_path)
+    fill(directory, 20, segment_size=500)
+    last = segment_files(directory)[-1]
+    path = os.path.join(directory, "segments", last)
+    assert os.path.getsize(path) == 0
+    os.remove(path)
+    fill(directory, 1, first=20, segment_size=500)
+    messages, _ = HistoryReader(directory).page(CHAT, limit=history.MAX_PAGE_SIZE)
+    assert texts(messages) == [f"message {number}" for number in range(21)]
+    assert [message.id for message in messages] == list(range(1, 22))
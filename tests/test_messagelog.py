@@ -0,0 +1,137 @@
+# Tests of the message log writer (messagelog.py): numbering, also across restarts, batching and fsync
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import messagelog
+
+def write(path, *records):
+    writer = messagelog.LogWriter()
+    for fields, numbered in records:
+        writer.append(path, fields, numbered=numbered)
+    writer.close()
+
+# Queues the records in one go, so the writer takes them as batches of up to MAX_BATCH
+def queue_at_once(writer, records):
+    with writer.queue.mutex:
+        for path, fields, numbered in records:
+            writer.queue.queue.append((path, fields, numbered, time.monotonic()))
+            writer.queue.unfinished_tasks += 1
+        writer.queue.not_empty.notify()
+
+def test_numbering_goes_on_after_a_restart(tmp_path):
+    path = str(tmp_path / "messagelog.txt")
+    write(path, (("01 Jan 2026 10:00:00", "alice", "hi"), True), (("01 Jan 2026 10:00:01", "bob", "a; b"), True))
+    write(path, (("01 Jan 2026 10:00:02", "alice", "again"), True))
+    with open(path) as file:
+        assert [line.split(";", 1)[0] for line in file] == ["1", "2", "3"]
+
+# The first line of a group's log is "group; members", for a group named 123 it looks like a record
+def test_group_named_with_digits_does_not_skew_the_numbering(tmp_path):
+    path = str(tmp_path / "123_messagelog.txt")
+    write(path, (("123", "alice bob"), False), (("01 Jan 2026 10:00:00", "alice", "hi"), True))
+    write(path, (("01 Jan 2026 10:00:01", "bob", "hello"), True))
+    with open(path) as file:
+        assert file.read().splitlines() == [
+            "123; alice bob",
+            "1; 01 Jan 2026 10:00:00; alice; hi",
+            "2; 01 Jan 2026 10:00:01; bob; hello",
+        ]
+    assert messagelog.last_sequence(path) == 2
+
+def test_a_log_that_cannot_be_written_is_reported_and_the_writer_goes_on(tmp_path):
+    reports = []
+    writer = messagelog.LogWriter()
+    writer.report = reports.append
+    # A directory where the log should be cannot be opened for appending
+    (tmp_path / "broken_messagelog.txt").mkdir()
+    writer.append(str(tmp_path / "broken_messagelog.txt"), ("01 Jan 2026 10:00:00", "alice", "lost"))
+    writer.append(str(tmp_path / "messagelog.txt"), ("01 Jan 2026 10:00:01", "bob", "kept"))
+    writer.close()
+    assert writer.stats()["write_errors"] == 1
+    (report,) = reports
+    assert report.startswith("Error: Cannot write") and "broken_messagelog.txt" in report
+    assert (tmp_path / "messagelog.txt").read_text() == "1; 01 Jan 2026 10:00:01; bob; kept\n"
+
+def test_numbering_goes_on_from_the_file_after_a_failed_flush(tmp_path, monkeypatch):
+    path = str(tmp_path / "messagelog.txt")
+    writer = messagelog.LogWriter(fsync_policy="batch")
+    failures = [OSError(28, "No space left on device")]
+    real_fsync = messagelog.os.fsync
+    def fsync(fd):
+        if failures:
+            raise failures.pop()
+        real_fsync(fd)
+    monkeypatch.setattr(messagelog.os, "fsync", fsync)
+    writer.append(path, ("01 Jan 2026 10:00:00", "alice", "hi"))
+    writer.close()
+    assert writer.stats()["write_errors"] == 1
+    write(path, (("01 Jan 2026 10:00:01", "bob", "hello"), True))
+    with open(path) as file:
+        assert [line.split(";", 1)[0] for line in file] == ["1", "2"]
+
+def test_line_breaks_in_a_message_cannot_forge_a_record(tmp_path):
+    path = str(tmp_path / "messagelog.txt")
+    write(path, (("01 Jan 2026 10:00:00", "mallory", "hi\n99; 01 Jan 2026 10:00:00; mallory; forged\r98; x; y"), True))
+    write(path, (("01 Jan 2026 10:00:01", "bob", "hello"), True))
+    with open(path) as file:
+        lines = file.read().splitlines()
+    assert lines == [
+        "1; 01 Jan 2026 10:00:00; mallory; hi\\n99; 01 Jan 2026 10:00:00; mallory; forged\\r98; x; y",
+        "2; 01 Jan 2026 10:00:01; bob; hello",
+    ]
+
+def test_unknown_fsync_policy_is_refused():
+    with pytest.raises(ValueError):
+        messagelog.LogWriter(fsync_policy="sometimes")
+
+def test_closing_an_idle_writer_creates_no_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    writer = messagelog.LogWriter()
+    writer.close()
+    assert os.listdir(tmp_path) == []
+    assert writer.stats()["batches"] == 1 and writer.stats()["records"] == 0
+
+def test_records_past_max_batch_go_in_later_batches_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(messagelog, "MAX_BATCH", 4)
+    path = str(tmp_path / "messagelog.txt")
+    writer = messagelog.LogWriter()
+    queue_at_once(writer, [(path, ("now", "alice", str(number)), True) for number in range(10)])
+    writer.close()
+    with open(path) as file:
+        assert file.read().splitlines() == [f"{number + 1}; now; alice; {number}" for number in range(10)]
+    stats = writer.stats()
+    # 4 + 4 + 2 records, the stop comes with the last of them or on its own
+    assert stats["records"] == 10 and stats["batches"] in (3, 4)
+    assert stats["max_queue_depth"] >= 10
+
+def test_each_file_in_a_batch_has_its_own_numbering(tmp_path):
+    first, second = str(tmp_path / "messagelog.txt"), str(tmp_path / "g_messagelog.txt")
+    writer = messagelog.LogWriter()
+    queue_at_once(writer, [
+        (second, ("g", "alice bob"), False),
+        (first, ("now", "alice", "a"), True),
+        (second, ("now", "alice", "b"), True),
+        (first, ("now", "bob", "c"), True),
+    ])
+    writer.close()
+    assert open(first).read().splitlines() == ["1; now; alice; a", "2; now; bob; c"]
+    assert open(second).read().splitlines() == ["g; alice bob", "1; now; alice; b"]
+
+@pytest.mark.parametrize("policy, fsyncs", [("none", 0), ("batch", 2), ("always", 3)])
+def test_fsync_policy(tmp_path, monkeypatch, policy, fsyncs):
+    calls = []
+    monkeypatch.setattr(messagelog.os, "fsync", calls.append)
+    writer = messagelog.LogWriter(fsync_policy=policy)
+    queue_at_once(writer, [
+        (str(tmp_path / "messagelog.txt"), ("now", "alice", "a"), True),
+        (str(tmp_path / "messagelog.txt"), ("now", "bob", "b"), True),
+        (str(tmp_path / "g_messagelog.txt"), ("now", "alice", "c"), True),
+    ])
+    writer.close()
+    assert len(calls) == fsyncs
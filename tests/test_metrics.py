@@ -0,0 +1,30 @@
+# Tests of the metrics HTTP server (metrics.py)
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+
+@pytest.fixture
+def base_url():
+    server = metrics.start_stats_server(metrics.Metrics(), 0)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize("query", ["seconds=", "seconds=abc", "seconds=-1", "seconds=0", "seconds=nan", "seconds=61"])
+def test_bad_profile_duration_is_answered_with_400(base_url, query):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f"{base_url}/profile?{query}", timeout=5)
+    assert error.value.code == 400
+
+def test_short_profile(base_url):
+    with urllib.request.urlopen(f"{base_url}/profile?seconds=0.05", timeout=5) as reply:
+        assert reply.status == 200
+        assert reply.headers["Content-Type"] == "text/plain"
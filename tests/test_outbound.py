@@ -0,0 +1,125 @@
+# Tests of the per-connection outbound queues (outbound.py): backpressure policies, spilling and vectored writes
+#
+# Usage: python3 -m pytest -q
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import outbound
+from outbound import DeliveryMetrics, OutboundQueue, send_frames
+
+# Everything the writer would send, in order
+def drain(queue):
+    data = b""
+    while True:
+        batch = queue.take()
+        if not batch:
+            return data
+        data += b"".join(bytes(frame) for frame in batch)
+
+def frames(count, size=10):
+    return [bytes([number]) * size for number in range(count)]
+
+def test_unknown_policy_is_refused():
+    with pytest.raises(ValueError):
+        OutboundQueue("client", policy="block")
+
+def test_drop_policy_discards_frames_past_the_limit():
+    queue = OutboundQueue("client", limit=25, policy="drop")
+    for frame in frames(4):
+        queue.sendall(frame)
+    assert drain(queue) == b"".join(frames(2))
+    assert (queue.dropped, queue.frames_queued) == (2, 2)
+    queue.sendall(b"x" * 10)
+    assert drain(queue) == b"x" * 10
+
+def test_disconnect_policy_gives_up_on_the_client_once():
+    overflows = []
+    queue = OutboundQueue("client", limit=25, policy="disconnect", on_overflow=lambda: overflows.append(1))
+    for frame in frames(5):
+        queue.sendall(frame)
+    assert overflows == [1]
+    assert queue.overflowed and queue.dropped == 3
+    assert drain(queue) == b"".join(frames(2))
+
+def test_spilled_frames_come_back_in_order(tmp_path):
+    queue = OutboundQueue("client", limit=25, policy="spill", spill_directory=str(tmp_path))
+    sent = frames(6)
+    for frame in sent[:4]:
+        queue.sendall(frame)
+    assert queue.spilled == 20 and queue.depth() == 40
+    # Once spilling, frames go to the file even when memory has room again
+    assert queue.take() == sent[:2]
+    queue.sendall(sent[4])
+    assert queue.bytes == 0
+    queue.sendall(sent[5])
+    assert drain(queue) == b"".join(sent[2:])
+    assert queue.spill_file is None and queue.depth() == 0
+    assert queue.max_depth == 40
+    queue.sendall(b"after")
+    assert queue.take() == [b"after"]
+
+def test_spill_file_is_read_in_writes_of_at_most_max_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbound, "MAX_WRITE", 16)
+    queue = OutboundQueue("client", limit=10, policy="spill", spill_directory=str(tmp_path))
+    for frame in frames(4):
+        queue.sendall(frame)
+    batches = []
+    while True:
+        batch = queue.take()
+        if not batch:
+            break
+        batches.append(b"".join(batch))
+    assert [len(batch) for batch in batches] == [10, 16, 14]
+    assert b"".join(batches) == b"".join(frames(4))
+
+def test_close_sends_what_is_queued_unless_discarded():
+    queue = OutboundQueue("client")
+    queue.sendall(b"last")
+    queue.close()
+    queue.sendall(b"too late")
+    assert queue.take(block=True) == [b"last"]
+    assert queue.take(block=True) is None
+    queue = OutboundQueue("client")
+    queue.sendall(b"last")
+    queue.close(discard=True)
+    assert queue.take() is None
+
+def test_metrics_keep_the_totals_of_closed_queues():
+    metrics = DeliveryMetrics()
+    first = OutboundQueue("first", limit=10, policy="drop", metrics=metrics)
+    second = OutboundQueue("second", metrics=metrics)
+    first.sendall(b"x" * 8)
+    first.sendall(b"x" * 8)
+    second.sendall(b"y" * 20)
+    assert metrics.depths() == [("second", 20), ("first", 8)]
+    first.take()
+    first.close()
+    assert first.take() is None
+    assert metrics.depths() == [("second", 20)]
+    totals = metrics.totals()
+    assert (totals["frames"], totals["dropped"], totals["bytes_sent"], totals["max_depth"]) == (2, 1, 8, 20)
+
+def test_send_frames_finishes_frames_cut_by_a_short_write():
+    left, right = socket.socketpair()
+    sent = [os.urandom(size) for size in (3, 70000, 5, 100000)]
+    expected = b"".join(sent)
+    received = bytearray()
+    def read():
+        while len(received) < len(expected):
+            received.extend(right.recv(65536))
+    reader = threading.Thread(target=read)
+    try:
+        # A small send buffer makes the kernel take part of a frame at a time
+        left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        reader.start()
+        send_frames(left, list(sent))
+        reader.join(5)
+        assert bytes(received) == expected
+    finally:
+        left.close()
+        right.close()
@@ -0,0 +1,124 @@
+# Tests of the presence registry (presence.py): slots, logouts by the owning connection, userlog.txt,
+# /activeuser pages and subscriptions
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+from presence import PresenceRegistry, UserlogSnapshot
+
+class Connection:
+    def __init__(self):
+        self.frames = []
+
+    def sendall(self, frame):
+        self.frames.append(frame)
+
+def login(registry, username, udp_port=5000, connection=None):
+    connection = connection or Connection()
+    registry.login(username, connection, "01 Jan 2026 10:00:00", "127.0.0.1", udp_port)
+    return connection
+
+def test_freed_slots_are_reused_smallest_first():
+    registry = PresenceRegistry()
+    for username in ("alice", "bob", "carol", "dave"):
+        login(registry, username)
+    registry.logout("carol")
+    registry.logout("bob")
+    for username in ("erin", "frank", "grace"):
+        login(registry, username)
+    assert [registry.get(username).slot for username in ("erin", "frank", "grace")] == [2, 3, 5]
+
+def test_logging_in_again_keeps_the_slot():
+    registry = PresenceRegistry()
+    login(registry, "alice")
+    login(registry, "bob")
+    connection = login(registry, "alice", udp_port=6000)
+    record = registry.get("alice")
+    assert (record.slot, record.udp_port, record.client_socket) == (1, 6000, connection)
+    assert len(registry) == 2
+
+def test_only_the_owning_connection_logs_out():
+    registry = PresenceRegistry()
+    old = login(registry, "alice")
+    new = login(registry, "alice")
+    assert registry.logout("alice", old) is None
+    assert "alice" in registry
+    assert registry.logout("alice", new).client_socket is new
+    assert "alice" not in registry and registry.logout("alice") is None
+
+def test_udp_port_is_set_by_the_owning_connection_only():
+    registry = PresenceRegistry()
+    connection = login(registry, "alice")
+    assert not registry.set_udp_port("alice", Connection(), 7000)
+    assert registry.set_udp_port("alice", connection, 7000)
+    assert registry.get("alice").activeuser_line == "alice; 127.0.0.1; 7000; active since 01 Jan 2026 10:00:00."
+
+def test_listeners_hear_joins_and_leaves_but_not_logins_again():
+    registry = PresenceRegistry()
+    heard = []
+    registry.listeners.append(lambda kind, username: heard.append((kind, username)))
+    login(registry, "alice")
+    login(registry, "alice")
+    registry.logout("alice")
+    assert heard == [("join", "alice"), ("leave", "alice")]
+
+def test_userlog_is_written_in_slot_order_only_after_a_change(tmp_path):
+    registry = PresenceRegistry()
+    path = tmp_path / "userlog.txt"
+    snapshot = UserlogSnapshot(registry, str(path), interval=3600)
+    try:
+        for username in ("bob", "alice", "carol"):
+            login(registry, username)
+        registry.logout("bob")
+        snapshot.write()
+        assert path.read_text().splitlines() == [
+            "2; 01 Jan 2026 10:00:00; alice; 127.0.0.1; 5000",
+            "3; 01 Jan 2026 10:00:00; carol; 127.0.0.1; 5000",
+        ]
+        snapshot.write()
+        assert snapshot.writes == 1
+        assert not os.path.exists(str(path) + ".tmp")
+    finally:
+        snapshot.close()
+
+# Users a to j, pages of three leaving out one of them
+def test_pages_leave_out_the_excluded_user_wherever_it_falls():
+    registry = PresenceRegistry()
+    for username in "jihgfedcba":
+        login(registry, username)
+    def names(offset, exclude):
+        lines, others = registry.page(offset, 3, exclude)
+        return "".join(line.split(";")[0] for line in lines), others
+    assert names(0, "e") == ("abc", 9)
+    assert names(3, "e") == ("dfg", 9)
+    assert names(6, "e") == ("hij", 9)
+    assert names(9, "e") == ("", 9)
+    assert names(0, "a") == ("bcd", 9)
+    assert names(6, "j") == ("ghi", 9)
+    assert names(9, None) == ("j", 10)
+    assert names(0, "zed") == ("abc", 10)
+
+def test_subscribers_get_a_snapshot_then_each_change_in_order():
+    registry = PresenceRegistry()
+    login(registry, "bob")
+    subscriber = Connection()
+    registry.subscribe(subscriber)
+    connection = login(registry, "alice")
+    registry.set_udp_port("alice", connection, 7000)
+    login(registry, "alice", connection=connection)
+    registry.logout("bob")
+    registry.unsubscribe(subscriber)
+    login(registry, "carol")
+    decoder = protocol.FrameDecoder()
+    frames = [tuple(command.args) for frame in subscriber.frames for command in decoder.feed(frame)]
+    line = "alice; 127.0.0.1; {}; active since 01 Jan 2026 10:00:00."
+    assert frames == [
+        ("snapshot", 1, "bob; 127.0.0.1; 5000; active since 01 Jan 2026 10:00:00."),
+        ("join", 2, line.format(5000)),
+        ("update", 3, line.format(7000)),
+        ("update", 4, line.format(5000)),
+        ("leave", 5, "bob"),
+    ]
@@ -0,0 +1,108 @@
+# Tests of the wire format (protocol.py): frames, the streaming decoder and compressed frames
+#
+# Usage: python3 -m pytest -q
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+def decode_all(data):
+    return protocol.FrameDecoder().feed(data)
+
+def test_round_trip_of_every_field_type():
+    frame = protocol.encode("/msgto", "alice", "bob", "héllo; there", request_id=42)
+    (command,) = decode_all(frame)
+    assert command.name == "/msgto"
+    assert command.args == ("alice", "bob", "héllo; there")
+    assert command.request_id == 42
+
+    frame = protocol.encode("/activeuser", 3, -1, 2 ** 62) + protocol.encode("msg_recieve", b"\x00\xff binary", "")
+    first, second = decode_all(frame)
+    assert first.args == (3, -1, 2 ** 62)
+    assert second.args == (b"\x00\xff binary", "")
+
+def test_frame_without_fields():
+    (command,) = decode_all(protocol.encode("/logout"))
+    assert command.name == "/logout"
+    assert command.args == ()
+
+def test_frame_split_across_feeds():
+    frames = protocol.encode("/groupmsg", "g1", "alice", "x" * 1000) + protocol.encode("/activeuser", 2, 50)
+    for split in (1, protocol.HEADER.size - 1, protocol.HEADER.size, protocol.HEADER.size + 3, len(frames) - 1):
+        decoder = protocol.FrameDecoder()
+        commands = decoder.feed(frames[:split]) + decoder.feed(frames[split:])
+        assert [command.args for command in commands] == [("g1", "alice", "x" * 1000), (2, 50)]
+
+def test_frame_fed_one_byte_at_a_time():
+    frame = protocol.encode("/msgto", "alice", "bob", "hi", request_id=7)
+    decoder = protocol.FrameDecoder()
+    commands = []
+    for offset in range(len(frame)):
+        commands += decoder.feed(frame[offset:offset + 1])
+        if offset < len(frame) - 1:
+            assert commands == []
+    assert [(command.args, command.request_id) for command in commands] == [(("alice", "bob", "hi"), 7)]
+
+def test_oversized_length_is_rejected():
+    header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.COMMAND_CODES["/msgto"], 1, protocol.MAX_FRAME_SIZE + 1, 0)
+    with pytest.raises(protocol.ProtocolError, match="Frame is too large"):
+        protocol.FrameDecoder().feed(header)
+
+def test_oversized_frame_is_not_encoded():
+    with pytest.raises(protocol.ProtocolError, match="too large"):
+        protocol.encode("/msgto", "alice", "bob", "x" * (protocol.MAX_FRAME_SIZE + 1))
+
+def test_wrong_version_is_rejected():
+    frame = bytearray(protocol.encode("/logout"))
+    frame[0] = protocol.PROTOCOL_VERSION + 1
+    with pytest.raises(protocol.ProtocolError, match="version"):
+        decode_all(bytes(frame))
+
+def test_small_writes_are_sent_as_plain_frames():
+    frame = protocol.encode("/msgto", "alice", "bob", "hi")
+    assert protocol.Compressor().compress(frame) == frame
+
+# Whatever the compressor sends, deflated, stored or plain, decodes to the same commands as the frames it was given
+def test_compressed_and_plain_frames_interoperate():
+    random.seed(1)
+    compressor = protocol.Compressor()
+    decoder = protocol.FrameDecoder()
+    sent = []
+    stream = []
+    writes = [
+        [protocol.encode("/msgto", "alice", "bob", "hi")],
+        [protocol.encode("/groupmsg", "g1", "alice", "hello everyone " * 20, request_id=number) for number in range(10)],
+        [protocol.encode("msg_recieve", bytes(random.getrandbits(8) for _ in range(4000)))],
+        [protocol.encode("/activeuser", 1, 100)],
+    ]
+    for frames in writes:
+        sent += frames
+        stream.append(compressor.compress(b"".join(frames)))
+    stream = b"".join(stream)
+    assert len(stream) < len(b"".join(sent))
+    received = decoder.feed(stream[:100]) + decoder.feed(stream[100:])
+    assert [(command.name, command.args, command.request_id) for command in received] == \
+        [(command.name, command.args, command.request_id) for command in decode_all(b"".join(sent))]
+    assert compressor.stats.deflated and compressor.stats.plain
+
+# A frame can begin in one compressed write and end in the next
+def test_frame_split_across_compressed_writes():
+    frame = protocol.encode("/groupmsg", "g1", "alice", "a long message " * 50)
+    compressor = protocol.Compressor()
+    decoder = protocol.FrameDecoder()
+    received = decoder.feed(compressor.compress(frame[:300])) + decoder.feed(compressor.compress(frame[300:]))
+    assert [command.args for command in received] == [("g1", "alice", "a long message " * 50)]
+
+def test_damaged_compressed_frame_is_rejected():
+    with pytest.raises(protocol.ProtocolError):
+        decode_all(protocol.compressed_frame(protocol.DEFLATED, b"not deflate data"))
+
+# Frames the workers send the broker are encoded by name, an unknown name fails only when it is sent
+def test_every_broker_message_has_a_code():
+    import broker
+    for name in broker.Broker.handlers:
+        assert name in protocol.COMMAND_CODES
@@ -0,0 +1,132 @@
+# Tests of the server relay for /p2pvideo (relay.py): token buckets, forwarding, limits and idle relays
+#
+# Usage: python3 -m pytest -q
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import relay
+import transfer
+from relay import RelayError, RelayServer, TokenBucket
+
+TIMEOUT = 5
+
+def test_bucket_starts_full_and_refills_at_its_rate():
+    bucket = TokenBucket(1000 * 1000)
+    now = bucket.updated
+    assert bucket.capacity == transfer.MAX_DATAGRAM # BURST of 1 MB/s is less than one datagram
+    assert bucket.delay(transfer.MAX_DATAGRAM, now) == 0
+    bucket.consume(transfer.MAX_DATAGRAM)
+    assert bucket.delay(1000, now) == pytest.approx(0.001)
+    assert bucket.delay(1000, now + 0.0011) == 0
+    # Tokens do not build up past the capacity however long the bucket was idle
+    bucket.delay(0, now + 3600)
+    assert bucket.tokens == bucket.capacity
+
+def test_bucket_may_go_below_zero_for_acks():
+    bucket = TokenBucket(100 * 1000 * 1000)
+    now = bucket.updated
+    bucket.consume(bucket.capacity + 50000)
+    assert bucket.tokens == -50000
+    assert bucket.delay(50000, now) == pytest.approx(0.001)
+
+def test_bucket_without_a_rate_never_waits():
+    bucket = TokenBucket(0)
+    bucket.consume(10 ** 9)
+    assert bucket.delay(10 ** 9, time.monotonic()) == 0
+
+# The relay thread counts a datagram just after sending it
+def wait_for_totals(relays, predicate):
+    deadline = time.monotonic() + TIMEOUT
+    while not predicate(relays.totals()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return relays.totals()
+
+def udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(TIMEOUT)
+    return sock
+
+@pytest.fixture
+def relays():
+    relays = RelayServer("127.0.0.1", rate=0, budget=0, max_relays=2)
+    yield relays
+    relays.close()
+
+def test_relay_forwards_to_the_audience_and_acks_back(relays):
+    presenter, audience, stranger = udp_socket(), udp_socket(), udp_socket()
+    try:
+        port = relays.open("127.0.0.1", audience.getsockname(), owner="alice")
+        presenter.sendto(b"data 1", ("127.0.0.1", port))
+        data, address = audience.recvfrom(100)
+        assert (data, address[1]) == (b"data 1", port)
+        audience.sendto(b"ack 1", address)
+        assert presenter.recv(100) == b"ack 1"
+        # Anyone on the presenter's address is taken for the presenter, the relay follows its last port
+        stranger.sendto(b"data 2", ("127.0.0.1", port))
+        assert audience.recv(100) == b"data 2"
+        audience.sendto(b"ack 2", address)
+        assert stranger.recv(100) == b"ack 2"
+        totals = wait_for_totals(relays, lambda totals: totals["acks"] == 2)
+        assert (totals["datagrams"], totals["acks"], totals["bytes"]) == (2, 2, 12)
+    finally:
+        for sock in (presenter, audience, stranger):
+            sock.close()
+
+def test_datagrams_from_other_addresses_are_refused(relays):
+    audience, stranger = udp_socket(), udp_socket()
+    try:
+        port = relays.open("127.0.0.2", audience.getsockname())
+        stranger.sendto(b"data", ("127.0.0.1", port))
+        totals = wait_for_totals(relays, lambda totals: totals["refused"])
+        assert totals["refused"] == 1 and totals["datagrams"] == 0
+    finally:
+        audience.close()
+        stranger.close()
+
+def test_relays_are_limited_in_total_and_per_user(relays, monkeypatch):
+    monkeypatch.setattr(relay, "MAX_RELAYS_PER_USER", 1)
+    relays.open("127.0.0.1", ("127.0.0.1", 9), owner="alice")
+    with pytest.raises(RelayError, match="already have"):
+        relays.open("127.0.0.1", ("127.0.0.1", 9), owner="alice")
+    relays.open("127.0.0.1", ("127.0.0.1", 9), owner="bob")
+    with pytest.raises(RelayError, match="All 2 relays"):
+        relays.open("127.0.0.1", ("127.0.0.1", 9), owner="carol")
+    assert (relays.totals()["opened"], relays.totals()["rejected"]) == (2, 2)
+
+def test_idle_relays_are_closed(relays, monkeypatch):
+    monkeypatch.setattr(relay, "IDLE_TIMEOUT", 0.05)
+    monkeypatch.setattr(relay, "IDLE_CHECK_INTERVAL", 0.05)
+    relays.open("127.0.0.1", ("127.0.0.1", 9))
+    # Wakes the loop so it picks up the shorter check interval
+    relays.wakeup_write.send(b"\0")
+    assert wait_for_totals(relays, lambda totals: not totals["open"])["open"] == 0
+
+def test_relay_rate_paces_the_datagrams():
+    rate = 1000 * 1000
+    relays = RelayServer("127.0.0.1", rate=rate, budget=0)
+    presenter, audience = udp_socket(), udp_socket()
+    try:
+        port = relays.open("127.0.0.1", audience.getsockname())
+        payload = b"x" * 1000
+        rounds, per_round = 10, 16 # Past the burst a bucket can send at once, each round fits in the ring
+        count = rounds * per_round
+        started = time.monotonic()
+        for _ in range(rounds):
+            for _ in range(per_round):
+                presenter.sendto(payload, ("127.0.0.1", port))
+            for _ in range(per_round):
+                audience.recv(2000)
+        elapsed = time.monotonic() - started
+        # The bucket starts with one datagram's worth of tokens, the rest wait for the rate
+        assert elapsed >= (count * len(payload) - transfer.MAX_DATAGRAM) / rate * 0.8
+        assert wait_for_totals(relays, lambda totals: totals["datagrams"] == count)["datagrams"] == count
+    finally:
+        presenter.close()
+        audience.close()
+        relays.close()
@@ -0,0 +1,272 @@
+# Tests of the server's request handlers (server.py), run on a connection with no socket behind it
+#
+# Usage: python3 -m pytest -q
+import asyncio
+import os
+import sys
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+import relay
+import server
+from credentials import CredentialStore
+from groups import GroupRegistry
+from history import HistoryStore, group_conversation, private_conversation
+from messagelog import LogWriter
+from presence import PresenceRegistry
+from serverlog import ServerLog
+from state import StateStore
+from timerwheel import TimerWheel
+
+# Stands in for a connection's outbound queue, keeps every frame sent to it
+class Outbox:
+    def __init__(self):
+        self.name = None
+        self.frames = []
+        self.decoder = protocol.FrameDecoder()
+
+    def sendall(self, frame):
+        self.frames += self.decoder.feed(frame)
+
+    def replies(self):
+        frames, self.frames = self.frames, []
+        return [(frame.name, frame.args) for frame in frames]
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "credentials.txt").write_text("alice a\nbob b\ncarol c\n")
+    timers = TimerWheel()
+    credential_store = CredentialStore("credentials.txt", 3, timers=timers)
+    monkeypatch.setattr(server, "log", ServerLog("off"))
+    monkeypatch.setattr(server, "timers", timers)
+    monkeypatch.setattr(server, "idle_timeout", 0)
+    monkeypatch.setattr(server, "presence", PresenceRegistry())
+    monkeypatch.setattr(server, "groups", GroupRegistry())
+    server.groups.attach(server.presence)
+    monkeypatch.setattr(server, "credential_store", credential_store)
+    yield tmp_path
+    credential_store.close()
+    timers.close()
+
+def connect(username=None, udp_port=5000):
+    handler = server.ClientHandler(("127.0.0.1", 40000), Outbox())
+    if username is not None:
+        server.presence.login(username, handler.client_socket, "01 Jan 2026 10:00:00", "127.0.0.1", udp_port)
+        handler.username = username
+    return handler
+
+def request(handler, name, *args):
+    handler.dispatch(protocol.Command(name, args, 1))
+    return handler.client_socket.replies()
+
+def test_activeuser_pages_leave_out_the_user_asking(environment):
+    for username in ("bob", "carol", "dave"):
+        connect(username)
+    alice = connect("alice")
+    ((name, (text,)),) = request(alice, "/activeuser", 1, 2)
+    assert text.splitlines() == [
+        "bob; 127.0.0.1; 5000; active since 01 Jan 2026 10:00:00.",
+        "carol; 127.0.0.1; 5000; active since 01 Jan 2026 10:00:00.",
+        "Page 1 of 2, 3 other active users.",
+    ]
+    ((name, (text,)),) = request(alice, "/activeuser", 2, 2)
+    assert text.splitlines()[0].startswith("dave;") and text.splitlines()[-1] == "Page 2 of 2, 3 other active users."
+    ((name, (text,)),) = request(alice, "/activeuser")
+    assert len(text.splitlines()) == 3
+    ((name, (text,)),) = request(alice, "/activeuser", 3, 2)
+    assert text == "Error: Page 3 does not exist, there are 2 pages."
+
+@pytest.mark.parametrize("page, page_size", [(0, 10), (-1, 10), (1, 0), (1, -3), (1, server.MAX_ACTIVEUSER_PAGE_SIZE + 1)])
+def test_activeuser_page_out_of_range_is_an_error(environment, page, page_size):
+    connect("bob")
+    ((name, (text,)),) = request(connect("alice"), "/activeuser", page, page_size)
+    assert text.startswith("Error: The page must be at least 1")
+
+def test_activeuser_alone(environment):
+    ((name, (text,)),) = request(connect("alice"), "/activeuser")
+    assert text == "No other active users."
+
+@pytest.fixture
+def history(environment, monkeypatch):
+    store = HistoryStore(str(environment / "history"))
+    for number in range(30):
+        store.append(private_conversation("alice", "bob"), "alice", "now", f"message {number}")
+    store.close()
+    store = HistoryStore(str(environment / "history"))
+    monkeypatch.setattr(server, "history", store)
+    yield store
+    store.close()
+
+def history_lines(replies):
+    ((name, (text,)),) = replies
+    assert name == "history"
+    return text.splitlines()
+
+def test_history_pages_default_and_explicit(history):
+    alice = connect("alice")
+    lines = history_lines(request(alice, "/history", "bob"))
+    assert lines[0].endswith("message 10") and lines[-2].endswith("message 29")
+    assert lines[-1] == "Older messages: /history bob 11"
+    lines = history_lines(request(alice, "/history", "bob", 11, 5))
+    assert [line.split(": ", 1)[1] for line in lines[:-1]] == [f"message {number}" for number in range(5, 10)]
+
+@pytest.mark.parametrize("before, limit", [(11, 0), (11, -5), (-1, 5), (11, server.MAX_PAGE_SIZE + 1)])
+def test_history_page_out_of_range_is_an_error(history, before, limit):
+    (line,) = history_lines(request(connect("alice"), "/history", "bob", before, limit))
+    assert line.startswith("Error: BEFORE must be at least 0")
+
+def test_history_before_zero_is_not_the_newest_page(history):
+    assert history_lines(request(connect("alice"), "/history", "bob", 0, 5)) == ["No messages with bob before 0."]
+
+@pytest.fixture
+def messages(history, monkeypatch):
+    writer = LogWriter()
+    monkeypatch.setattr(server, "log_writer", writer)
+    yield writer
+    writer.close()
+
+def test_messages_are_sent_by_the_logged_in_user(messages):
+    alice, bob = connect("alice"), connect("bob")
+    ((name, (text,)),) = request(connect(), "/msgto", "alice", "bob", "hello")
+    assert (name, text) == ("msgto", "Error: Log in first.")
+    ((name, (text,)),) = request(alice, "/msgto", "carol", "bob", "hello")
+    assert text.startswith("message sent")
+    ((name, (text,)),) = bob.client_socket.replies()
+    assert text.endswith(", alice: hello")
+
+    server.groups.create("team", ["alice", "bob"])
+    server.groups.join("team", "alice")
+    server.groups.join("team", "bob")
+    ((name, (text,)),) = request(bob, "/groupmsg", "team", "carol", "hi")
+    assert text.startswith("Group message sent")
+    ((name, (text,)),) = alice.client_socket.replies()
+    assert text.endswith("team, bob: hi")
+    # Closing writes what the history store still has queued
+    server.history.close()
+    page, _ = server.history.page(group_conversation("team"))
+    assert [message.sender for message in page] == ["bob"]
+
+@pytest.mark.parametrize("args, error", [
+    (("g1",), "A group needs at least one member."),
+    (("g-1", "alice"), "Group name must only consist of letter a-z and digit 0-9."),
+    (("g1", "alice", "erin"), "User erin is not valid or not online."),
+])
+def test_group_that_cannot_be_created(environment, args, error):
+    ((name, (text,)),) = request(connect("alice"), "/creategroup", *args)
+    assert text == f"Error: Group {args[0]} creation failed. {error}"
+    assert len(server.groups) == 0
+
+def test_group_members_join_before_they_send(messages):
+    alice, bob, carol = connect("alice"), connect("bob"), connect("carol")
+    ((name, (text,)),) = request(alice, "/creategroup", "g1", "alice", "bob")
+    assert text == "Group g1 created successfully. Group members: alice bob"
+    ((name, (text,)),) = request(alice, "/creategroup", "g1", "alice")
+    assert text.endswith("Group name already exists.")
+    ((name, (text,)),) = request(carol, "/joingroup", "g1", "carol")
+    assert text.startswith("Error:") and "carol" in text
+    ((name, (text,)),) = request(bob, "/groupmsg", "g1", "bob", "early")
+    assert text == "Error: User bob has not joined group g1."
+    request(bob, "/joingroup", "g1", "bob")
+    ((name, (text,)),) = request(bob, "/joingroup", "g1", "bob")
+    assert text == "Error: User bob has already joined group g1."
+    ((name, (text,)),) = request(bob, "/groupmsg", "g1", "bob", "now")
+    assert text.startswith("Group message sent")
+    ((name, (text,)),) = request(carol, "/groupmsg", "g1", "carol", "hi")
+    assert text == "Error: User carol is not a member of group g1."
+    ((name, (text,)),) = request(carol, "/groupmsg", "g2", "carol", "hi")
+    assert text == "Error: Group g2 does not exist."
+
+def test_logout_ends_only_the_connections_own_session(state):
+    alice = connect("alice")
+    ((name, (text,)),) = request(connect(), "/logout", "alice")
+    assert text == "Error: Log in first."
+    impostor = connect("bob")
+    request(impostor, "/logout", "alice")
+    assert server.presence.get("alice").client_socket is alice.client_socket
+    assert server.presence.get("bob") is None
+    ((name, (text,)),) = request(alice, "/logout", "alice")
+    assert (name, text) == ("logout", "Bye, alice!") and server.presence.get("alice") is None
+
+@pytest.fixture
+def relays(environment, monkeypatch):
+    relays = server.RelayServer("127.0.0.1")
+    monkeypatch.setattr(server, "relays", relays)
+    yield relays
+    relays.close()
+
+def test_relay_needs_a_login_and_the_users_own_name(relays):
+    connect("bob", 6000)
+    ((name, (text,)),) = request(connect(), "/relay", "bob", "clip.mp4", "alice")
+    assert (name, text.startswith("Error: Log in")) == ("relay", True)
+    ((name, (text,)),) = request(connect("carol"), "/relay", "bob", "clip.mp4", "alice")
+    assert text.startswith("Error: Log in")
+    assert relays.opened == 0
+
+def test_relays_per_user_are_limited(relays):
+    connect("bob", 6000)
+    alice = connect("alice")
+    for _ in range(relay.MAX_RELAYS_PER_USER):
+        ((name, (audience, port)),) = request(alice, "/relay", "bob", "clip.mp4", "alice")
+        assert (name, audience) == ("relay", "bob") and port > 0
+    ((name, (text,)),) = request(alice, "/relay", "bob", "clip.mp4", "alice")
+    assert "already have" in text
+    ((name, (audience, port)),) = request(connect("carol"), "/relay", "bob", "clip.mp4", "carol")
+    assert audience == "bob"
+
+@pytest.fixture
+def state(environment, monkeypatch):
+    store = StateStore(str(environment / "state"), timers=server.timers)
+    monkeypatch.setattr(server, "state", store)
+    yield store
+    store.close()
+
+def failed_future(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+# An async connection's read loop, served on a loopback port until the test is done with it
+async def with_async_connection(test):
+    listener = await asyncio.start_server(lambda reader, writer: server.AsyncClientConnection(reader, writer).run(),
+                                          "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname())
+    decoder = protocol.FrameDecoder()
+
+    async def request(name, *args):
+        writer.write(protocol.encode(name, *args, request_id=1))
+        frames = []
+        while not frames:
+            data = await asyncio.wait_for(reader.read(65536), 5)
+            if not data:
+                return None
+            frames = decoder.feed(data)
+        return (frames[0].name, frames[0].args)
+
+    try:
+        await test(request)
+    finally:
+        writer.close()
+        listener.close()
+
+def test_async_handler_that_fails_while_waiting_is_answered(state, monkeypatch):
+    async def test(request):
+        with monkeypatch.context() as patch:
+            patch.setattr(server.credential_store, "check_password", lambda *args: failed_future(ValueError("bad hash")))
+            assert await request("credentials", "alice", "a", 5000) == ("error", ("Error: Malformed credentials request.",))
+        assert (await request("credentials", "alice", "a", 5000))[1][0] == "success"
+
+    asyncio.run(with_async_connection(test))
+
+def test_async_connection_that_fails_is_still_logged_out(state, monkeypatch):
+    async def test(request):
+        assert (await request("credentials", "alice", "a", 5000))[1][0] == "success"
+        assert "alice" in server.presence
+        monkeypatch.setattr(server.credential_store, "check_password", lambda *args: failed_future(RuntimeError("broken")))
+        assert await request("credentials", "alice", "a", 5000) is None
+        assert "alice" not in server.presence
+
+    asyncio.run(with_async_connection(test))
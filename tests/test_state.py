@@ -0,0 +1,193 @@
+# Tests of the state kept across restarts (state.py): snapshot and journal replay, and session expiry
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import state
+from timerwheel import TimerWheel
+
+TIMEOUT = 0.2
+
+@pytest.fixture
+def timers():
+    timers = TimerWheel(tick=0.02)
+    yield timers
+    timers.close()
+
+def open_store(directory, timers, session_timeout=TIMEOUT):
+    # A long interval, so only close() takes a snapshot
+    return state.StateStore(str(directory), interval=3600, session_timeout=session_timeout, timers=timers)
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_dropped_session_stops_being_resumable_after_the_timeout(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    try:
+        store.record("@session", "alice", "token", "now", "127.0.0.1", 5000)
+        store.detach("alice", "token")
+        assert store.resume("token").username == "alice"
+        assert wait_until(lambda: store.resume("token") is None)
+        assert "alice" not in store.sessions
+    finally:
+        store.close()
+
+def test_resumed_session_is_not_ended(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    try:
+        store.record("@session", "alice", "token", "now", "127.0.0.1", 5000)
+        store.detach("alice", "token")
+        store.resume("token")
+        store.record("@session", "alice", "token", "now", "127.0.0.1", 5001)
+        time.sleep(TIMEOUT * 3)
+        assert store.resume("token").udp_port == 5001
+    finally:
+        store.close()
+
+# The old connection of a resumed session can drop after the client resumed it on a new one
+def test_late_drop_of_an_old_connection_keeps_the_session(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    try:
+        store.record("@session", "alice", "token", "now", "127.0.0.1", 5000)
+        store.resume("token")
+        store.record("@session", "alice", "token", "now", "127.0.0.1", 5001)
+        store.detach("alice", "token")
+        time.sleep(TIMEOUT * 3)
+        assert store.resume("token") is not None
+        store.detach("alice", "old-token")
+        time.sleep(TIMEOUT * 3)
+        assert store.resume("token") is not None
+    finally:
+        store.close()
+
+def test_sessions_loaded_at_startup_expire_unless_resumed(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    store.record("@session", "alice", "token-a", "now", "127.0.0.1", 5000)
+    store.record("@session", "bob", "token-b", "now", "127.0.0.1", 5001)
+    store.close()
+
+    store = open_store(tmp_path, timers)
+    try:
+        assert store.resume("token-a") is not None
+        store.record("@session", "alice", "token-a", "now", "127.0.0.1", 5002)
+        assert wait_until(lambda: store.resume("token-b") is None)
+        assert store.resume("token-a") is not None
+    finally:
+        store.close()
+
+def fill(store):
+    store.record("@group", "g1", "alice", "alice", "bob")
+    store.record("@join", "g1", "bob")
+    store.record("@blocked", "carol", int(time.time()) + 3600)
+    store.record("@session", "alice", "token", "now", "127.0.0.1", 5000)
+
+def assert_filled(store):
+    (name, creator, members, joined), = store.group_list()
+    assert (name, creator, members, sorted(joined)) == ("g1", "alice", ["alice", "bob"], ["alice", "bob"])
+    assert [username for username, _ in store.blocked_list()] == ["carol"]
+    assert store.resume("token").udp_port == 5000
+
+# Leaves the store as a crash would: its records are in the journal, but there is no snapshot
+def crash(store, records):
+    assert wait_until(lambda: store.records >= records)
+
+def test_state_comes_back_from_the_snapshot(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    fill(store)
+    store.close()
+    assert store.snapshots == 1
+
+    store = open_store(tmp_path, timers)
+    try:
+        assert_filled(store)
+        assert store.loaded_records == 4 and store.replayed_records == 0
+        assert not os.path.exists(store.journal_path(0))
+    finally:
+        store.close()
+
+def test_state_comes_back_from_the_journal_after_a_crash(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    fill(store)
+    crash(store, 4)
+    assert not os.path.exists(store.snapshot_path)
+
+    store = open_store(tmp_path, timers)
+    try:
+        assert_filled(store)
+        assert store.replayed_records == 4
+    finally:
+        store.close()
+
+def test_journal_after_the_snapshot_is_replayed_on_top_of_it(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    fill(store)
+    store.close()
+    store = open_store(tmp_path, timers)
+    store.record("@group", "g2", "bob", "bob", "carol")
+    store.record("@endsession", "alice")
+    crash(store, 2)
+
+    store = open_store(tmp_path, timers)
+    try:
+        assert sorted(group[0] for group in store.group_list()) == ["g1", "g2"]
+        assert store.resume("token") is None
+        assert store.replayed_records == 2
+    finally:
+        store.close()
+
+# Records after one whose CRC does not match were never completely written, the journal is cut there
+def test_journal_is_cut_at_a_record_that_fails_its_crc(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    fill(store)
+    crash(store, 4)
+    path = store.journal_path(store.journal_number)
+    with open(path, "rb") as file:
+        data = bytearray(file.read())
+    # The last byte of the last record, the session
+    data[-1] ^= 0xFF
+    with open(path, "wb") as file:
+        file.write(data)
+    length = len(data) - state.JOURNAL_RECORD.size - len(state.protocol.encode(
+        "@session", "alice", "token", "now", "127.0.0.1", 5000))
+
+    store = open_store(tmp_path, timers)
+    try:
+        assert store.replayed_records == 3
+        assert [username for username, _ in store.blocked_list()] == ["carol"]
+        assert store.resume("token") is None
+        assert os.path.getsize(path) == length
+    finally:
+        store.close()
+
+def test_record_cut_short_is_dropped(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    fill(store)
+    crash(store, 4)
+    path = store.journal_path(store.journal_number)
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 3)
+
+    store = open_store(tmp_path, timers)
+    try:
+        assert store.replayed_records == 3
+        assert store.resume("token") is None
+    finally:
+        store.close()
+
+def test_damaged_snapshot_is_refused(tmp_path, timers):
+    store = open_store(tmp_path, timers)
+    fill(store)
+    store.close()
+    with open(store.snapshot_path, "r+b") as file:
+        file.seek(-1, os.SEEK_END)
+        file.write(b"\x00")
+    with pytest.raises(ValueError, match="not a complete state snapshot"):
+        open_store(tmp_path, timers)
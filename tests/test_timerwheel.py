@@ -0,0 +1,80 @@
+# Tests of the hashed timer wheel (timerwheel.py): slots and turns, firing, cancelling
+#
+# Usage: python3 -m pytest -q
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from timerwheel import TimerWheel
+
+def test_timer_goes_into_the_slot_of_its_tick_with_the_turns_left():
+    # An hour per tick, so the wheel does not move during the test
+    timers = TimerWheel(tick=3600, slots=8)
+    try:
+        assert [(timer.slot, timer.turns) for timer in (
+            timers.schedule(0, None),
+            timers.schedule(3 * 3600, None),
+            timers.schedule(7 * 3600, None),
+            timers.schedule(8 * 3600, None),
+            timers.schedule(10 * 3600, None),
+            timers.schedule(25 * 3600, None),
+        )] == [(1, 0), (4, 0), (0, 0), (1, 1), (3, 1), (2, 3)]
+        assert len(timers) == 6
+    finally:
+        timers.close()
+
+def test_cancel_takes_the_timer_out_once():
+    timers = TimerWheel(tick=3600, slots=8)
+    try:
+        timer = timers.schedule(3600, None)
+        timers.cancel(timer)
+        timers.cancel(timer)
+        assert len(timers) == 0
+        assert not any(timers.slots)
+    finally:
+        timers.close()
+
+def test_timers_fire_in_order_never_early_and_after_several_turns():
+    timers = TimerWheel(tick=0.01, slots=4)
+    fired = []
+    done = threading.Event()
+    started = time.monotonic()
+
+    def callback(name):
+        fired.append((name, time.monotonic() - started))
+        if len(fired) == 3:
+            done.set()
+
+    try:
+        # 0.15 seconds is 15 ticks, three turns and a bit of a four slot wheel
+        for name, delay in (("late", 0.15), ("soon", 0.02), ("middle", 0.07)):
+            timers.schedule(delay, lambda name=name: callback(name))
+        assert done.wait(2)
+        assert [name for name, _ in fired] == ["soon", "middle", "late"]
+        for (name, at), delay in zip(fired, (0.02, 0.07, 0.15)):
+            assert at >= delay
+        assert len(timers) == 0 and timers.fired == 3
+    finally:
+        timers.close()
+
+def test_a_failing_callback_does_not_stop_the_wheel(capsys):
+    timers = TimerWheel(tick=0.01, slots=4)
+    done = threading.Event()
+    try:
+        timers.schedule(0.01, lambda: 1 / 0)
+        timers.schedule(0.03, done.set)
+        assert done.wait(2)
+    finally:
+        timers.close()
+    assert "ZeroDivisionError" in capsys.readouterr().err
+
+def test_callback_may_schedule_another_timer():
+    timers = TimerWheel(tick=0.01, slots=4)
+    done = threading.Event()
+    try:
+        timers.schedule(0.01, lambda: timers.schedule(0.01, done.set))
+        assert done.wait(2)
+    finally:
+        timers.close()
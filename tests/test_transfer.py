@@ -0,0 +1,262 @@
+# Tests of the reliable UDP file transfer (transfer.py): handshake parsing, resuming and acks
+#
+# Usage: python3 -m pytest -q
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import transfer
+
+ADDRESS = ("127.0.0.1", 9)
+
+@pytest.fixture
+def receiver(tmp_path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    receiver = transfer.TransferReceiver(sock, directory=str(tmp_path))
+    yield receiver
+    receiver.close()
+    sock.close()
+
+def start_datagram(size=10, payload_size=4, chunk_payloads=2, digest=bytes(16), names=b"alice clip.mp4"):
+    return (transfer.HEADER.pack(transfer.START, 1, 0)
+            + transfer.START_BODY.pack(size, payload_size, chunk_payloads, digest) + names)
+
+@pytest.mark.parametrize("datagram", [
+    transfer.HEADER.pack(transfer.START, 1, 0),
+    start_datagram()[:transfer.HEADER.size + transfer.START_BODY.size - 1],
+    start_datagram(names=b"alice"),
+    start_datagram(names=b"\xff\xfe clip.mp4"),
+    start_datagram(payload_size=0),
+    start_datagram(payload_size=transfer.MAX_PAYLOAD_SIZE + 1),
+    start_datagram(chunk_payloads=0),
+    start_datagram(size=transfer.DEFAULT_MAX_FILE_SIZE + 1),
+    start_datagram(size=transfer.MAX_PAYLOADS + 1, payload_size=1),
+    start_datagram(names=b".. clip.mp4"),
+    start_datagram(names=b"a/b clip.mp4"),
+])
+def test_malformed_start_is_ignored(receiver, datagram):
+    assert receiver.handle_datagram(memoryview(datagram), ADDRESS) is None
+    assert receiver.transfers == {}
+
+def test_well_formed_start_begins_a_transfer(receiver):
+    receiver.handle_datagram(memoryview(start_datagram(names=b"alice ../clip.mp4")), ADDRESS)
+    (incoming,) = receiver.transfers.values()
+    assert (incoming.sender, incoming.size, incoming.total, incoming.chunks) == ("alice", 10, 3, 2)
+    assert incoming.path == os.path.join(receiver.directory, "alice_clip.mp4")
+
+def test_receiver_takes_files_up_to_its_max_file_size(tmp_path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver = transfer.TransferReceiver(sock, directory=str(tmp_path), max_file_size=10)
+    try:
+        assert receiver.handle_datagram(memoryview(start_datagram(size=11)), ADDRESS) is None
+        assert receiver.transfers == {}
+        receiver.handle_datagram(memoryview(start_datagram(size=10)), ADDRESS)
+        assert len(receiver.transfers) == 1
+    finally:
+        receiver.close()
+        sock.close()
+
+def test_file_without_room_on_disk_is_ignored(receiver, monkeypatch):
+    usage = transfer.shutil.disk_usage(receiver.directory)
+    free = 25
+    monkeypatch.setattr(transfer.shutil, "disk_usage", lambda path: usage._replace(free=free))
+    receiver.handle_datagram(memoryview(start_datagram(size=20)), ADDRESS)
+    assert len(receiver.transfers) == 1
+    # 20 bytes are still to come for the first file, 25 are free
+    second = bytearray(start_datagram(size=10))
+    second[1:5] = (2).to_bytes(4, "big")
+    assert receiver.handle_datagram(memoryview(second), ADDRESS) is None
+    assert len(receiver.transfers) == 1
+    free = 30
+    receiver.handle_datagram(memoryview(second), ADDRESS)
+    assert len(receiver.transfers) == 2
+
+PAYLOAD_SIZE = 1000
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Four payloads per chunk, so a small file has several chunks
+    monkeypatch.setattr(transfer, "CHUNK_SIZE", 4 * PAYLOAD_SIZE)
+
+@pytest.fixture
+def sender(tmp_path, small_chunks):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(os.urandom(20 * PAYLOAD_SIZE))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = transfer.TransferSender(sock, ("127.0.0.1", 9), str(path), "alice", "clip.mp4", PAYLOAD_SIZE)
+    sender.started = True
+    yield sender
+    sock.close()
+
+def sent(sender, *seqs, at):
+    for seq in seqs:
+        sender.in_flight[seq] = (at, False)
+        sender.next_seq = max(sender.next_seq, seq + 1)
+
+def test_sack_round_trip():
+    received = bytearray(100)
+    for seq in (11, 12, 40, 99):
+        received[seq] = 1
+    bits = int.from_bytes(transfer.encode_sack(received, 10, 100), "little")
+    assert [10 + bit for bit in transfer.set_bits(bits)] == [11, 12, 40, 99]
+    assert transfer.encode_sack(bytearray(10), 0, 10) == b""
+
+def test_chunk_hashes_name_the_file_and_its_chunking():
+    hashes = [transfer.chunk_hash(b"a" * 100), transfer.chunk_hash(b"b" * 100)]
+    assert all(len(value) == transfer.HASH_SIZE for value in hashes)
+    digest = transfer.manifest_digest(200, 50, 2, hashes)
+    assert digest == transfer.manifest_digest(200, 50, 2, list(hashes))
+    assert digest != transfer.manifest_digest(200, 25, 4, hashes)
+    assert digest != transfer.manifest_digest(200, 50, 2, hashes[::-1])
+
+def test_acks_grow_the_window_in_slow_start_then_by_one_per_round_trip(sender):
+    now = transfer.time.monotonic()
+    sent(sender, 0, 1, at=now)
+    sender.on_ack(2, transfer.MAX_WINDOW, 0)
+    assert (sender.cum, sender.cwnd) == (2, 4.0)
+
+    sender.ssthresh = 4.0
+    sent(sender, 2, 3, 4, 5, at=now)
+    sender.on_ack(6, transfer.MAX_WINDOW, 0)
+    assert 4.9 < sender.cwnd < 5.0
+
+def test_selective_ack_marks_a_loss_and_halves_the_window(sender):
+    now = transfer.time.monotonic()
+    sender.cwnd = 8.0
+    sender.srtt, sender.rttvar = 0.1, 0.05
+    sent(sender, 0, at=now - 1)
+    sent(sender, 1, 2, 3, at=now)
+    # Payloads 1 to 3 arrived, payload 0 did not
+    sender.on_ack(0, transfer.MAX_WINDOW, 0b111)
+    assert list(sender.lost) == [0]
+    assert 0 not in sender.in_flight
+    assert sender.cwnd == sender.ssthresh == (8.0 + 3) / 2
+    assert sender.acked[1:4] == b"\x01\x01\x01"
+
+    # A second loss in the same round trip does not halve the window again
+    cwnd = sender.cwnd
+    sent(sender, 4, at=now - 1)
+    sent(sender, 5, at=now)
+    sender.on_ack(0, transfer.MAX_WINDOW, 0b10000)
+    assert list(sender.lost) == [0, 4]
+    assert sender.cwnd > cwnd
+
+def test_timeout_resends_everything_in_flight_from_a_window_of_one(sender):
+    now = transfer.time.monotonic()
+    sender.cwnd = 10.0
+    sent(sender, 0, 1, 2, at=now)
+    sender.lost.append(7)
+    rto = sender.rto
+    sender.on_timeout()
+    assert list(sender.lost) == [0, 1, 2, 7]
+    assert sender.cwnd == 1.0
+    assert sender.ssthresh == 2.0
+    assert sender.rto == min(rto * 2, transfer.MAX_RTO)
+
+def test_have_skips_the_chunks_the_receiver_already_holds(sender):
+    sender.started = False
+    # Chunks 0 and 2 of five, four payloads each
+    sender.on_have(0, 0b101)
+    assert sender.cum == sender.next_seq == 4
+    assert sender.acked[8:12] == b"\x01" * 4 and not any(sender.acked[4:8])
+    assert sender.stats.resumed == 8 * PAYLOAD_SIZE
+
+def test_reject_sends_a_chunk_again(sender):
+    sender.on_have(0, 0)
+    sender.on_ack(8, transfer.MAX_WINDOW, 0)
+    sender.on_reject(1, 1)
+    assert list(sender.lost) == [4, 5, 6, 7]
+    assert sender.cum == 4
+    # The same rejection repeated is only acted on once
+    sender.on_reject(1, 1)
+    assert list(sender.lost) == [4, 5, 6, 7]
+
+def incoming_for(tmp_path, data, chunk_payloads=4):
+    hashes = [transfer.chunk_hash(data[offset:offset + chunk_payloads * PAYLOAD_SIZE])
+              for offset in range(0, len(data), chunk_payloads * PAYLOAD_SIZE)]
+    digest = transfer.manifest_digest(len(data), PAYLOAD_SIZE, chunk_payloads, hashes)
+    incoming = transfer.IncomingTransfer(1, ADDRESS, "alice", "clip.mp4", str(tmp_path / "alice_clip.mp4"),
+                                         len(data), PAYLOAD_SIZE, chunk_payloads, digest)
+    incoming.hashes = hashes
+    incoming.missing_hashes = 0
+    return incoming
+
+def store_all(incoming, data, seqs):
+    for seq in seqs:
+        incoming.store(seq, data[seq * PAYLOAD_SIZE:(seq + 1) * PAYLOAD_SIZE])
+
+def test_receiver_resumes_from_the_bitmap_and_checks_the_chunks_again(tmp_path):
+    data = os.urandom(10 * PAYLOAD_SIZE)
+    incoming = incoming_for(tmp_path, data)
+    incoming.open()
+    store_all(incoming, data, range(8))
+    assert bytes(incoming.verified) == b"\x01\x01\x00"
+    incoming.close()
+
+    # The second chunk is damaged on disk after it was verified
+    with open(incoming.path + ".part", "r+b") as file:
+        file.seek(5 * PAYLOAD_SIZE)
+        file.write(b"x")
+    resumed = incoming_for(tmp_path, data)
+    resumed.open()
+    assert bytes(resumed.verified) == b"\x01\x00\x00"
+    assert resumed.cum == 4
+    assert resumed.stats.resumed == 4 * PAYLOAD_SIZE
+    store_all(resumed, data, range(4, 10))
+    assert resumed.complete()
+    resumed.finish()
+    with open(resumed.path, "rb") as file:
+        assert file.read() == data
+    assert not os.path.exists(resumed.path + ".part.bitmap")
+
+def test_chunk_that_fails_its_hash_is_rejected_and_received_again(tmp_path):
+    data = os.urandom(8 * PAYLOAD_SIZE)
+    incoming = incoming_for(tmp_path, data)
+    incoming.open()
+    try:
+        store_all(incoming, data, range(4))
+        incoming.store(4, b"y" * PAYLOAD_SIZE)
+        store_all(incoming, data, range(5, 8))
+        assert incoming.rejected == {1: 1}
+        assert incoming.cum == 4 and not any(incoming.received[4:8])
+        store_all(incoming, data, range(4, 8))
+        assert incoming.rejected == {}
+        assert incoming.complete()
+    finally:
+        incoming.close()
+
+def test_file_is_sent_over_loopback(tmp_path, small_chunks):
+    data = os.urandom(50 * PAYLOAD_SIZE + 123)
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(data)
+    directory = tmp_path / "received"
+    directory.mkdir()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.1)
+    receiver = transfer.TransferReceiver(sock, directory=str(directory))
+    completed = []
+    stopping = threading.Event()
+
+    def receive():
+        while not stopping.is_set() and not completed:
+            completed.extend(receiver.receive())
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    try:
+        stats = transfer.send_file(sock.getsockname(), str(path), "alice", "clip.mp4", PAYLOAD_SIZE)
+        thread.join(5)
+    finally:
+        stopping.set()
+        thread.join()
+        receiver.close()
+        sock.close()
+    assert stats.size == len(data)
+    assert [incoming.sender for incoming in completed] == ["alice"]
+    assert (directory / "alice_clip.mp4").read_bytes() == data
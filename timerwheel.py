@@ -0,0 +1,79 @@
+# Hashed timer wheel, one thread for every idle connection deadline and account lockout
+#
+# The wheel has SLOTS slots and moves on one slot every TICK seconds. A timer goes into the slot
+# its expiry tick falls in, with the number of whole turns of the wheel still to wait. Each tick
+# looks at one slot only: timers with no turns left fire and the others count one turn down.
+# Scheduling and cancelling are O(1), a tick is O(timers in its slot), however many timers there
+# are. Timers never fire early and at most one TICK late.
+#
+# Callbacks run on the wheel's thread without its lock held, so they may schedule new timers. A
+# callback that needs a connection's event loop has to hand itself over with call_soon_threadsafe.
+import threading
+import time
+import traceback
+
+TICK = 0.5 # Seconds per slot
+SLOTS = 512 # Slots per turn, a turn is TICK * SLOTS seconds
+
+class Timer:
+    __slots__ = ("callback", "slot", "turns")
+
+    def __init__(self, callback, slot, turns):
+        self.callback = callback
+        self.slot = slot
+        self.turns = turns
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.current = 0 # Ticks done since started
+        self.count = 0 # Timers waiting
+        self.fired = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="timer-wheel", daemon=True)
+        self.thread.start()
+
+    # Calls callback once delay seconds have passed, returns the timer to cancel it with
+    def schedule(self, delay, callback):
+        with self.lock:
+            # The tick that is due next may already be partly over, so it does not count
+            ticks = max(int(-(-(time.monotonic() - self.started + delay) // self.tick)), self.current + 1)
+            slot = ticks % len(self.slots)
+            timer = Timer(callback, slot, (ticks - self.current - 1) // len(self.slots))
+            self.slots[slot].add(timer)
+            self.count += 1
+        return timer
+
+    # Does nothing if the timer has fired or was cancelled already
+    def cancel(self, timer):
+        with self.lock:
+            if timer in self.slots[timer.slot]:
+                self.slots[timer.slot].discard(timer)
+                self.count -= 1
+
+    def run(self):
+        while not self.stopped.wait(max(self.started + (self.current + 1) * self.tick - time.monotonic(), 0)):
+            with self.lock:
+                self.current += 1
+                bucket = self.slots[self.current % len(self.slots)]
+                due = [timer for timer in bucket if not timer.turns]
+                for timer in bucket:
+                    timer.turns -= 1
+                bucket.difference_update(due)
+                self.count -= len(due)
+                self.fired += len(due)
+            for timer in due:
+                try:
+                    timer.callback()
+                except Exception:
+                    # One broken callback must not stop every other timer
+                    traceback.print_exc()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.stopped.set()
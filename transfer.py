@@ -0,0 +1,1022 @@
+# Reliable file transfer over UDP, used by /p2pvideo
+#
+# Every datagram starts with: type (1 byte), transfer id (4 bytes), sequence number (4 bytes)
+#   START     body is the file size (8 bytes), the payload size (4 bytes), the payloads per chunk
+#             (4 bytes), the manifest digest (16 bytes) and "sender filename"
+#   MANIFEST  body is the hashes of the chunks from number seq on, 16 bytes each
+#   HAVE      answers START once the whole manifest has arrived, seq is the number of chunks and
+#             the body a flags byte (ACCEPTS_COMPRESSED) and a bitmap of the chunks the receiver
+#             already holds, which are not sent again
+#   DATA      body is payload number seq of the file
+#   ZDATA     body is payload number seq of the file, raw deflate
+#   ACK       seq is the cumulative ack (every payload below it has arrived), the body is the receive
+#             window (4 bytes, payloads from seq on the receiver has room for) and a selective ack
+#             bitmap, bit i set means payload seq + 1 + i has arrived as well
+#   REJECT    chunk number seq did not match its hash, its payloads have to be sent again, the body
+#             counts how often it failed (4 bytes), as REJECT is repeated until the chunk arrives again
+#   STOP      tells the receive loop to stop, a client sends it to its own socket on logout
+#
+# The sender maps the file and sends each payload straight from the mapping with sendmsg(),
+# so file data is never copied into Python objects. Payloads are as large as the path MTU allows.
+# The receiver reads into one preallocated buffer with recvfrom_into(), copies each payload into
+# a memory mapped output file of the final size, and sends one ack per transfer per batch of reads.
+#
+# The sender keeps a congestion window of datagrams in flight. The window grows by one per
+# acked datagram in slow start and by 1/cwnd afterwards, and is halved at most once per round
+# trip when a loss is detected (AIMD). A datagram is taken as lost when one sent after it has
+# been acked a quarter of a round trip later, or when the retransmission timeout (RFC 6298) fires.
+# It never sends past the receive window, except for a probe when the window has been closed for
+# PROBE_INTERVAL.
+#
+# Files are split into chunks of whole payloads, about CHUNK_SIZE bytes each, and the sender hashes
+# every chunk (the manifest) before it starts. The receiver writes into "{sender}_{filename}.part"
+# and keeps a ".part.bitmap" file beside it, one byte per chunk, set once the chunk matched its hash.
+# A transfer of the same file that was interrupted or is repeated picks up from the bitmap, so only
+# the missing chunks are sent, and the .part file only gets its final name once every chunk matched.
+# A receiver ignores a START for a file larger than its max_file_size, or one the disk has no room
+# for once the transfers in progress are done.
+#
+# A sender started with compress=True sends ZDATA to receivers whose HAVE accepts it, see
+# PayloadCompressor. Payloads keep their numbers and the receiver inflates a ZDATA payload before
+# storing it, so windows, acks and chunk hashes work on the payloads as before.
+import hashlib
+import mmap
+import os
+import random
+import select
+import shutil
+import socket
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+
+START = 1
+DATA = 2
+ACK = 3
+STOP = 4
+MANIFEST = 5
+HAVE = 6
+REJECT = 7
+ZDATA = 8
+
+ACCEPTS_COMPRESSED = 1 # HAVE flag, the receiver inflates ZDATA
+
+HEADER = struct.Struct("!BII")
+ACK_BODY = struct.Struct("!I")
+START_BODY = struct.Struct("!QII16s")
+REJECT_BODY = struct.Struct("!I")
+
+IP_UDP_OVERHEAD = 28
+MAX_DATAGRAM = 65507
+DEFAULT_PAYLOAD_SIZE = 1500 - IP_UDP_OVERHEAD - HEADER.size # Ethernet MTU when the path MTU is unknown
+MAX_PAYLOAD_SIZE = MAX_DATAGRAM - HEADER.size
+MAX_FILE_SIZE = 64 * 1024 ** 3 # Largest file that can be sent, a receiver may be set to accept up to this
+DEFAULT_MAX_FILE_SIZE = 4 * 1024 ** 3 # Largest file a receiver accepts unless told otherwise
+MAX_PAYLOADS = 64 * 1024 ** 2 # Most payloads a receiver accepts, it keeps one byte for each
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+RECEIVE_BATCH = 64 # Datagrams read without blocking before acks are sent
+MAX_WINDOW = 1024 # Datagrams in flight, also the number of bits in a selective ack
+INITIAL_RTO = 1.0
+MIN_RTO = 0.05
+MAX_RTO = 10.0
+MAX_TIMEOUTS = 10 # Consecutive timeouts without progress before the transfer is abandoned
+IDLE_TIMEOUT = 30.0 # Incoming transfers with no datagram for this long are dropped
+PROBE_INTERVAL = 1.0 # Seconds a closed receive window is waited on before a probe is sent
+CHUNK_SIZE = 1024 * 1024 # Bytes per hashed chunk, rounded down to a whole number of payloads
+HASH_SIZE = 16 # Bytes of SHA-256 kept per chunk
+COMPRESSION_LEVEL = 1 # Deflate has to keep up with the link, a higher level gains little on media
+MIN_SAVING = 0.1 # A chunk whose sample does not get this much smaller is sent as it is
+COMPRESSED_CACHE = 8 * 1024 * 1024 # Bytes of deflated payloads kept for retransmissions and other receivers
+
+BIT_CHARS = bytes.maketrans(b"\x00\x01", b"01")
+
+class TransferError(Exception):
+    pass
+
+# Nothing came back from the receiver before the transfer started, client.py then tries the server relay
+class ReceiverUnreachable(TransferError):
+    pass
+
+# Numbers reported for one transfer on either side
+class TransferStats:
+    __slots__ = ("size", "started", "finished", "datagrams", "retransmits", "timeouts", "duplicates",
+                 "resumed", "rejected", "payload_bytes", "wire_bytes", "compress_seconds")
+
+    def __init__(self, size):
+        self.size = size
+        self.started = time.monotonic()
+        self.finished = None
+        self.datagrams = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.duplicates = 0
+        self.resumed = 0 # Bytes the receiver already had from an earlier transfer
+        self.rejected = 0 # Chunks that did not match their hash and were sent again
+        self.payload_bytes = 0 # Payloads sent or received, and what they took on the wire
+        self.wire_bytes = 0
+        self.compress_seconds = 0.0 # CPU time deflating or inflating them
+
+    def duration(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def throughput(self):
+        return self.size / max(self.duration(), 1e-9)
+
+    def summary(self):
+        summary = (f"{self.size / 1e6:.2f} MB in {self.duration():.2f} s, {self.throughput() / 1e6:.2f} MB/s, "
+                   f"{self.datagrams} datagrams")
+        if self.resumed:
+            summary += f", {self.resumed / 1e6:.2f} MB already there"
+        if self.rejected:
+            summary += f", {self.rejected} chunks failed their hash and were sent again"
+        if self.wire_bytes < self.payload_bytes:
+            summary += (f", compressed to {self.wire_bytes / self.payload_bytes:.0%} "
+                        f"({self.compress_seconds:.2f} CPU s)")
+        return summary
+
+def payload_count(size, payload_size):
+    return (size + payload_size - 1) // payload_size
+
+# SHA-256 rather than BLAKE2, CPUs with SHA extensions hash about twice as fast with it
+def chunk_hash(data):
+    return hashlib.sha256(data).digest()[:HASH_SIZE]
+
+# Names the file and its chunking, a receiver only resumes a transfer with the same digest
+def manifest_digest(size, payload_size, chunk_payloads, hashes):
+    digest = hashlib.sha256(struct.pack("!QII", size, payload_size, chunk_payloads))
+    for value in hashes:
+        digest.update(value)
+    return digest.digest()[:HASH_SIZE]
+
+# Bits of a little endian bitmap that are set
+def set_bits(bits):
+    while bits:
+        low_bit = bits & -bits
+        yield low_bit.bit_length() - 1
+        bits ^= low_bit
+
+# Chunk hashes of files sent before, so sending the same file again does not hash it again
+# (path, size, modification time, chunk size) -> hashes
+manifest_cache = {}
+
+def stop_packet():
+    return HEADER.pack(STOP, 0, 0)
+
+# Largest payload that fits the path MTU of a connected socket without IP fragmentation
+def path_payload_size(sock):
+    if not sys.platform.startswith("linux"):
+        return DEFAULT_PAYLOAD_SIZE
+    try:
+        mtu = sock.getsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU", 14))
+    except OSError:
+        return DEFAULT_PAYLOAD_SIZE
+    return max(min(mtu - IP_UDP_OVERHEAD, MAX_DATAGRAM) - HEADER.size, 512)
+
+def set_buffer_sizes(sock):
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        except OSError:
+            pass
+
+def encode_sack(received, start, end):
+    window = received[start:end]
+    if not any(window):
+        return b""
+    # One byte per payload becomes a little endian bitmap without looping in Python
+    bits = int(bytes(window).translate(BIT_CHARS)[::-1], 2)
+    return bits.to_bytes((len(window) + 7) // 8, "little")
+
+# Deflates the payloads of one mapped file for every sender of it
+# Whether a chunk is worth it is decided once, by deflating its first payload: media containers
+# mostly hold data that is compressed already, and their chunks are then sent as they are without
+# spending more CPU on them. Deflated payloads are kept a while, for retransmissions and for the
+# other receivers of /groupvideo, which are sent the same payloads at about the same time.
+class PayloadCompressor:
+    def __init__(self, view, size, payload_size, chunk_payloads):
+        self.view = view
+        self.size = size
+        self.payload_size = payload_size
+        self.chunk_payloads = chunk_payloads
+        self.worth_it = {} # chunk -> True if its payloads are sent deflated
+        self.cache = OrderedDict() # seq -> deflated payload
+        self.cached_bytes = 0
+        self.cpu_seconds = 0.0
+        self.skipped_chunks = 0
+
+    # Returns the kind of datagram and the body for payload seq
+    def payload(self, seq):
+        packed = self.cache.get(seq)
+        if packed is not None:
+            return ZDATA, packed
+        offset = seq * self.payload_size
+        raw = self.view[offset:offset + self.payload_size]
+        chunk = seq // self.chunk_payloads
+        worth_it = self.worth_it.get(chunk)
+        if worth_it is False:
+            return DATA, raw
+        started = time.thread_time()
+        packed = zlib.compress(raw, COMPRESSION_LEVEL, -zlib.MAX_WBITS)
+        self.cpu_seconds += time.thread_time() - started
+        if worth_it is None:
+            worth_it = self.worth_it[chunk] = len(packed) <= len(raw) * (1 - MIN_SAVING)
+            if not worth_it:
+                self.skipped_chunks += 1
+                return DATA, raw
+        if len(packed) >= len(raw):
+            return DATA, raw
+        self.cache[seq] = packed
+        self.cached_bytes += len(packed)
+        while self.cached_bytes > COMPRESSED_CACHE:
+            self.cached_bytes -= len(self.cache.popitem(last=False)[1])
+        return ZDATA, packed
+
+# Sends one file to one receiver, run() blocks until every payload has been acked
+# Without a payload_size the largest one the path MTU allows is used
+# The transfer moves on through send_window(), read_acks() and on_timer(), called by drive(), so
+# one thread can run the senders of a file to several receivers at once, see send_file_to_group()
+class TransferSender:
+    def __init__(self, sock, address, path, sender, filename, payload_size=None, handshake_timeouts=MAX_TIMEOUTS,
+                 compress=False):
+        self.sock = sock
+        self.address = address
+        self.path = path
+        self.sender = sender
+        self.filename = filename
+        sock.connect(address)
+        set_buffer_sizes(sock)
+        self.payload_size = min(payload_size or path_payload_size(sock), MAX_PAYLOAD_SIZE)
+        self.transfer_id = random.getrandbits(32)
+        self.size = os.path.getsize(path)
+        self.total = payload_count(self.size, self.payload_size)
+        if self.size > MAX_FILE_SIZE or self.total > MAX_PAYLOADS:
+            raise TransferError(f"{filename} is too large to send")
+        self.chunk_payloads = max(CHUNK_SIZE // self.payload_size, 1)
+        self.chunk_size = self.chunk_payloads * self.payload_size
+        self.chunks = payload_count(self.size, self.chunk_size)
+        self.stats = TransferStats(self.size)
+        self.started = False # Set once the receiver has answered with HAVE
+        self.handshake = [] # START and MANIFEST datagrams
+        self.handshake_sent = 0.0
+        self.handshake_timeouts = 0
+        self.max_handshake_timeouts = handshake_timeouts
+        self.last_heard = 0.0 # When the receiver last sent anything
+        self.window = MAX_WINDOW # Receive window from the last ack
+        self.rejections = {} # chunk -> number of the last REJECT acted on
+        self.compress = compress
+        self.compressor = None # Set by run_senders() when compress is set, used once HAVE accepts it
+        self.compressing = False
+
+        self.cwnd = 2.0
+        self.ssthresh = float(MAX_WINDOW)
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.last_reduction = 0.0
+        self.consecutive_timeouts = 0
+
+        self.acked = bytearray(self.total)
+        self.cum = 0
+        self.next_seq = 0
+        self.in_flight = OrderedDict() # seq -> (send time, retransmitted), oldest first
+        self.lost = deque()
+        self.header = bytearray(HEADER.size) # Reused for every datagram, sendmsg() copies it into the kernel
+
+    def run(self):
+        failed = run_senders([self])
+        if failed:
+            raise failed[self]
+        return self.stats
+
+    def manifest(self):
+        key = (os.path.abspath(self.path), self.size, os.stat(self.path).st_mtime_ns, self.chunk_size)
+        hashes = manifest_cache.get(key)
+        if hashes is None:
+            chunk_size = self.chunk_size
+            hashes = [chunk_hash(self.view[offset:offset + chunk_size]) for offset in range(0, self.size, chunk_size)]
+            manifest_cache[key] = hashes
+        return hashes
+
+    # Sends START and the manifest, they are sent again until the receiver answers with the chunks
+    # it already has
+    def begin(self, hashes):
+        digest = manifest_digest(self.size, self.payload_size, self.chunk_payloads, hashes)
+        body = START_BODY.pack(self.size, self.payload_size, self.chunk_payloads, digest) + f"{self.sender} {self.filename}".encode()
+        self.handshake = [HEADER.pack(START, self.transfer_id, 0) + body]
+        per_datagram = self.payload_size // HASH_SIZE
+        for first in range(0, self.chunks, per_datagram):
+            self.handshake.append(HEADER.pack(MANIFEST, self.transfer_id, first) + b"".join(hashes[first:first + per_datagram]))
+        self.send_handshake()
+
+    def send_handshake(self):
+        self.handshake_sent = time.monotonic()
+        for datagram in self.handshake:
+            try:
+                self.sock.send(datagram)
+            except BlockingIOError:
+                break
+
+    def done(self):
+        return self.started and self.cum >= self.total
+
+    # When on_timer() has something to do next, None while only an ack can move the transfer on
+    def deadline(self):
+        if not self.started:
+            return self.handshake_sent + self.rto
+        if self.in_flight:
+            return next(iter(self.in_flight.values()))[0] + self.rto
+        if not self.window:
+            return self.last_heard + max(self.rto, PROBE_INTERVAL)
+        return None
+
+    def on_timer(self, now):
+        if not self.started:
+            self.stats.timeouts += 1
+            self.handshake_timeouts += 1
+            if self.handshake_timeouts >= self.max_handshake_timeouts:
+                raise ReceiverUnreachable("Receiver did not answer")
+            self.rto = min(self.rto * 2, MAX_RTO)
+            self.send_handshake()
+        elif self.in_flight:
+            self.on_timeout()
+        elif not self.window:
+            # The receiver acks again once its window opens, in case that ack was lost the next
+            # payload goes out as a probe and the ack for it brings the window
+            self.lost.append(self.cum)
+            self.last_heard = now
+
+    # Sends retransmissions first, then new payloads, as one burst while the window allows
+    def send_window(self):
+        now = time.monotonic()
+        header = self.header
+        view = self.view
+        payload_size = self.payload_size
+        while len(self.in_flight) < int(self.cwnd):
+            if self.lost:
+                seq = self.lost.popleft()
+                if self.acked[seq]:
+                    continue
+                retransmitted = True
+            else:
+                # Payloads the receiver had before the transfer started are skipped
+                while self.next_seq < self.total and self.acked[self.next_seq]:
+                    self.next_seq += 1
+                if self.next_seq >= self.total or self.next_seq >= self.cum + min(self.window, MAX_WINDOW):
+                    break
+                seq = self.next_seq
+                retransmitted = False
+            if self.compressing:
+                kind, body = self.compressor.payload(seq)
+            else:
+                offset = seq * payload_size
+                kind, body = DATA, view[offset:offset + payload_size]
+            HEADER.pack_into(header, 0, kind, self.transfer_id, seq)
+            try:
+                self.sock.sendmsg([header, body])
+            except BlockingIOError:
+                # The socket buffer is full, the datagram goes out on the next pass
+                if retransmitted:
+                    self.lost.appendleft(seq)
+                break
+            if retransmitted:
+                self.stats.retransmits += 1
+            else:
+                self.next_seq += 1
+            self.stats.datagrams += 1
+            self.stats.payload_bytes += min(payload_size, self.size - seq * payload_size)
+            self.stats.wire_bytes += len(body)
+            self.in_flight[seq] = (now, retransmitted)
+
+    # Reads every ack, HAVE and REJECT waiting on the socket
+    def read_acks(self):
+        started = self.started
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                raise (TransferError if self.started else ReceiverUnreachable)("Receiver is not listening")
+            if len(data) < HEADER.size:
+                continue
+            kind, transfer_id, seq = HEADER.unpack_from(data)
+            if transfer_id != self.transfer_id:
+                continue
+            self.last_heard = time.monotonic()
+            if kind == HAVE and len(data) > HEADER.size:
+                self.on_have(data[HEADER.size], int.from_bytes(data[HEADER.size + 1:], "little"))
+            elif kind == ACK and len(data) >= HEADER.size + ACK_BODY.size:
+                # A receiver that already finished the file answers START with an ack
+                self.started = True
+                window = ACK_BODY.unpack_from(data, HEADER.size)[0]
+                self.on_ack(seq, window, int.from_bytes(data[HEADER.size + ACK_BODY.size:], "little"))
+            elif kind == REJECT and len(data) >= HEADER.size + REJECT_BODY.size:
+                self.on_reject(seq, REJECT_BODY.unpack_from(data, HEADER.size)[0])
+        if self.started and not started:
+            self.update_rtt(self.last_heard - self.handshake_sent)
+
+    # Chunks the receiver holds from an earlier transfer count as acked
+    def on_have(self, flags, chunk_bits):
+        if self.started:
+            return
+        self.started = True
+        self.compressing = self.compressor is not None and bool(flags & ACCEPTS_COMPRESSED)
+        for chunk in set_bits(chunk_bits):
+            first = chunk * self.chunk_payloads
+            last = min(first + self.chunk_payloads, self.total)
+            self.acked[first:last] = b"\x01" * (last - first)
+            self.stats.resumed += min(last * self.payload_size, self.size) - first * self.payload_size
+        while self.cum < self.total and self.acked[self.cum]:
+            self.cum += 1
+        self.next_seq = self.cum
+
+    # The payloads of a chunk that did not match its hash are sent again
+    def on_reject(self, chunk, rejection):
+        if rejection <= self.rejections.get(chunk, 0):
+            return
+        self.rejections[chunk] = rejection
+        self.stats.rejected += 1
+        first = chunk * self.chunk_payloads
+        last = min(first + self.chunk_payloads, self.total)
+        # Payloads still in flight arrived before the chunk was dropped, so they are sent again too
+        for seq in range(first, last):
+            self.acked[seq] = 0
+            if self.in_flight.pop(seq, None) is not None or seq not in self.lost:
+                self.lost.append(seq)
+        self.cum = min(self.cum, first)
+
+    def on_ack(self, cum, window, sack_bits):
+        now = time.monotonic()
+        self.window = window
+        if not window:
+            # The receiver is there but full, it is waiting for its player, see playback.py
+            self.consecutive_timeouts = 0
+        newest_sent = None
+        newest_sample = None
+        newly_acked = []
+        for seq in range(self.cum, min(cum, self.total)):
+            if not self.acked[seq]:
+                newly_acked.append(seq)
+        for bit in set_bits(sack_bits):
+            seq = cum + 1 + bit
+            if seq < self.total and not self.acked[seq]:
+                newly_acked.append(seq)
+        for seq in newly_acked:
+            self.acked[seq] = 1
+            sent = self.in_flight.pop(seq, None)
+            if sent is None:
+                continue
+            sent_at, retransmitted = sent
+            if newest_sent is None or sent_at > newest_sent:
+                newest_sent = sent_at
+                # Karn's rule, round trip samples only come from datagrams sent once
+                newest_sample = None if retransmitted else now - sent_at
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, float(MAX_WINDOW))
+        self.cum = max(self.cum, min(cum, self.total))
+        if newest_sample is not None:
+            self.update_rtt(newest_sample)
+        if newest_sent is not None:
+            self.consecutive_timeouts = 0
+            self.detect_losses(newest_sent, now)
+
+    # Anything sent before the newest acked datagram by more than the reordering window is lost
+    def detect_losses(self, newest_sent, now):
+        reorder_window = (self.srtt or self.rto) / 4
+        lost_any = False
+        while self.in_flight:
+            seq, (sent_at, _) = next(iter(self.in_flight.items()))
+            if sent_at >= newest_sent - reorder_window:
+                break
+            del self.in_flight[seq]
+            self.lost.append(seq)
+            lost_any = True
+        if lost_any and now - self.last_reduction > (self.srtt or self.rto):
+            self.ssthresh = max(self.cwnd / 2, 2.0)
+            self.cwnd = self.ssthresh
+            self.last_reduction = now
+
+    def on_timeout(self):
+        self.stats.timeouts += 1
+        self.consecutive_timeouts += 1
+        if self.consecutive_timeouts >= MAX_TIMEOUTS:
+            raise TransferError(f"No ack after {MAX_TIMEOUTS} retransmission timeouts")
+        # Everything still in flight is taken as lost, oldest first, or a window of one would stay
+        # full of datagrams that never arrive and nothing would be sent again
+        self.ssthresh = max(len(self.in_flight) / 2, 2.0)
+        self.lost.extendleft(reversed(self.in_flight))
+        self.in_flight.clear()
+        self.cwnd = 1.0
+        self.last_reduction = time.monotonic()
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+    def update_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+# Runs senders from this thread until each has finished or failed, every one with its own window
+# and timers, so a slow or lost receiver does not hold up the others
+# Returns the senders that failed, with their error
+def drive(senders, hashes):
+    for sender in senders:
+        sender.begin(hashes)
+    active = {sender.sock: sender for sender in senders}
+    failed = {}
+    readable = []
+    while True:
+        now = time.monotonic()
+        for sock, sender in list(active.items()):
+            try:
+                if sock in readable:
+                    sender.read_acks()
+                deadline = sender.deadline()
+                if deadline is not None and now >= deadline:
+                    sender.on_timer(now)
+                if sender.started:
+                    sender.send_window()
+            except (OSError, TransferError) as error:
+                failed[sender] = error
+                del active[sock]
+                continue
+            if sender.done():
+                sender.stats.finished = now
+                del active[sock]
+        if not active:
+            return failed
+        deadlines = [deadline for deadline in (sender.deadline() for sender in active.values()) if deadline is not None]
+        timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else MAX_RTO
+        readable = select.select(list(active), [], [], timeout)[0]
+
+# Maps the file once for senders of the same file with the same payload size, and hashes it once
+def run_senders(senders):
+    first = senders[0]
+    for sender in senders:
+        sender.sock.setblocking(False)
+    with open(first.path, "rb") as file:
+        # An empty file cannot be mapped and has no payloads to send
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if first.size else b""
+        view = memoryview(file_map)
+        try:
+            compressor = None
+            if any(sender.compress for sender in senders):
+                compressor = PayloadCompressor(view, first.size, first.payload_size, first.chunk_payloads)
+            for sender in senders:
+                sender.view = view
+                if sender.compress:
+                    sender.compressor = compressor
+            try:
+                return drive(senders, first.manifest())
+            finally:
+                if compressor is not None:
+                    # Shared by every sender, each reports the whole of it
+                    for sender in senders:
+                        sender.stats.compress_seconds = compressor.cpu_seconds
+                    compressor.cache.clear()
+        finally:
+            view.release()
+            if first.size:
+                file_map.close()
+
+# Sends a file over a new UDP socket so acks for it never reach the client's main UDP socket
+# handshake_timeouts is how many retransmission timeouts pass without an answer before the
+# receiver is taken to be unreachable
+# compress sends payloads deflated when the receiver accepts them and they get smaller
+def send_file(address, path, sender, filename, payload_size=None, handshake_timeouts=MAX_TIMEOUTS, compress=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        return TransferSender(sock, address, path, sender, filename, payload_size, handshake_timeouts, compress).run()
+    finally:
+        sock.close()
+
+# Sends a file to several receivers at once, /groupvideo
+# Every payload is sent to each receiver straight from one mapping of the file, so the file is read
+# and hashed once however many receivers there are. They all get the payload size the smallest
+# path MTU allows, as they share one manifest.
+# Returns the stats of each address that got the whole file and the error of each that did not
+def send_file_to_group(addresses, path, sender, filename, payload_size=None, compress=False):
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in addresses]
+    try:
+        if payload_size is None:
+            for sock, address in zip(sockets, addresses):
+                sock.connect(address)
+            payload_size = min(path_payload_size(sock) for sock in sockets)
+        senders = [TransferSender(sock, address, path, sender, filename, payload_size, compress=compress)
+                   for sock, address in zip(sockets, addresses)]
+        failed = run_senders(senders)
+    finally:
+        for sock in sockets:
+            sock.close()
+    stats = {sender.address: sender.stats for sender in senders if sender not in failed}
+    errors = {sender.address: error for sender, error in failed.items()}
+    return stats, errors
+
+# State of one file being received
+# The files are only opened once the whole manifest has arrived, see open()
+class IncomingTransfer:
+    __slots__ = ("transfer_id", "address", "sender", "filename", "path", "size", "payload_size",
+                 "chunk_payloads", "chunk_size", "chunks", "digest", "hashes", "missing_hashes",
+                 "total", "file", "map", "view", "bitmap", "bitmap_offset", "verified", "chunk_received", "rejected",
+                 "received", "cum", "highest", "advertised", "stats", "last_activity")
+
+    def __init__(self, transfer_id, address, sender, filename, path, size, payload_size, chunk_payloads, digest):
+        self.transfer_id = transfer_id
+        self.address = address
+        self.sender = sender
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.payload_size = payload_size
+        self.chunk_payloads = chunk_payloads
+        self.chunk_size = chunk_payloads * payload_size
+        self.chunks = payload_count(size, self.chunk_size)
+        self.digest = digest
+        self.hashes = [None] * self.chunks
+        self.missing_hashes = self.chunks
+        self.total = payload_count(size, payload_size)
+        self.file = None
+        self.map = None
+        self.view = None
+        self.bitmap = None # File descriptor of the .part.bitmap file
+        self.bitmap_offset = 0 # Where the byte of chunk 0 is in it
+        self.verified = bytearray(self.chunks) # 1 for chunks that matched their hash
+        self.chunk_received = [0] * self.chunks # Payloads of each chunk that have arrived
+        self.rejected = {} # chunk -> times it failed its hash, until it arrives again and matches
+        self.received = None # One byte per payload, 1 once it has arrived
+        self.cum = 0
+        self.highest = -1
+        self.advertised = MAX_WINDOW # Receive window in the last ack sent
+        self.stats = TransferStats(size)
+        self.last_activity = time.monotonic()
+
+    def ready(self):
+        return self.file is not None
+
+    # Bytes the file may still take on disk. The .part file is sparse, so the blocks it has are taken already.
+    def disk_needed(self):
+        try:
+            allocated = os.stat(self.path + ".part").st_blocks * 512
+        except OSError:
+            allocated = 0
+        return max(self.size - allocated, 0)
+
+    # Opens the .part file, picking up the chunks of an earlier transfer of the same file if its
+    # bitmap is there, and checks them against their hashes again
+    def open(self):
+        part_path = self.path + ".part"
+        header = f"{self.digest.hex()} {self.size} {self.payload_size} {self.chunk_payloads}\n".encode()
+        bitmap = None
+        try:
+            if os.path.getsize(part_path) == self.size:
+                with open(part_path + ".bitmap", "rb") as file:
+                    content = file.read()
+                if content.startswith(header) and len(content) == len(header) + self.chunks:
+                    bitmap = content[len(header):]
+        except OSError:
+            pass
+
+        # The output file is created at its final size and payloads are copied straight into a mapping of it
+        if bitmap is None:
+            self.file = open(part_path, "w+b")
+            self.file.truncate(self.size)
+            with open(part_path + ".bitmap", "wb") as file:
+                file.write(header + b"0" * self.chunks)
+        else:
+            self.file = open(part_path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), self.size) if self.size else None
+        self.view = memoryview(self.map) if self.size else None
+        self.bitmap = os.open(part_path + ".bitmap", os.O_WRONLY)
+        self.bitmap_offset = len(header)
+        self.received = bytearray(self.total)
+
+        if bitmap is not None:
+            for chunk in range(self.chunks):
+                if bitmap[chunk] == ord("1") and self.chunk_matches(chunk):
+                    self.verified[chunk] = 1
+                    first, last = self.chunk_payload_range(chunk)
+                    self.received[first:last] = b"\x01" * (last - first)
+                    self.chunk_received[chunk] = last - first
+                    self.stats.resumed += min(last * self.payload_size, self.size) - first * self.payload_size
+                    self.highest = last - 1
+            while self.cum < self.total and self.received[self.cum]:
+                self.cum += 1
+
+    def chunk_payload_range(self, chunk):
+        first = chunk * self.chunk_payloads
+        return first, min(first + self.chunk_payloads, self.total)
+
+    def chunk_matches(self, chunk):
+        offset = chunk * self.chunk_size
+        return chunk_hash(self.view[offset:offset + self.chunk_size]) == self.hashes[chunk]
+
+    # Called once every payload of a chunk has arrived, a chunk that does not match its hash is
+    # dropped and rejected until it has arrived again
+    def verify(self, chunk):
+        if self.chunk_matches(chunk):
+            self.verified[chunk] = 1
+            self.rejected.pop(chunk, None)
+            os.pwrite(self.bitmap, b"1", self.bitmap_offset + chunk)
+            return
+        first, last = self.chunk_payload_range(chunk)
+        self.received[first:last] = bytes(last - first)
+        self.chunk_received[chunk] = 0
+        self.rejected[chunk] = self.rejected.get(chunk, 0) + 1
+        self.cum = min(self.cum, first)
+        self.stats.rejected += 1
+
+    # Copies payload number seq into the file
+    def store(self, seq, payload):
+        if self.received[seq]:
+            self.stats.duplicates += 1
+            return
+        offset = seq * self.payload_size
+        length = len(payload)
+        if length > self.payload_size or offset + length > self.size:
+            return
+        self.map[offset:offset + length] = payload
+        self.received[seq] = 1
+        self.stats.datagrams += 1
+        if seq > self.highest:
+            self.highest = seq
+        while self.cum < self.total and self.received[self.cum]:
+            self.cum += 1
+        chunk = seq // self.chunk_payloads
+        self.chunk_received[chunk] += 1
+        first, last = self.chunk_payload_range(chunk)
+        if self.chunk_received[chunk] == last - first:
+            self.verify(chunk)
+
+    # Payloads past the cumulative ack the sender may send, a file has room for all of them
+    def window(self):
+        return MAX_WINDOW
+
+    def sack(self):
+        if self.highest <= self.cum:
+            return b""
+        return encode_sack(self.received, self.cum + 1, min(self.cum + 1 + MAX_WINDOW, self.total))
+
+    def complete(self):
+        return self.ready() and self.cum >= self.total
+
+    # True while received data is waiting to be written somewhere, never for a file
+    def waiting(self):
+        return False
+
+    # Gives the file its final name once every chunk matched
+    def finish(self):
+        self.close()
+        os.replace(self.path + ".part", self.path)
+        os.remove(self.path + ".part.bitmap")
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+            os.close(self.bitmap)
+
+# Receives any number of files at once on one UDP socket
+# receive() reads a batch of datagrams and returns the transfers it completed, callers that read
+# the socket themselves can feed handle_datagram() instead and call flush_acks() after each batch
+# incoming builds the state of each new transfer, playback.player() returns one that plays files
+# as they arrive instead of saving them. Streams whose player is not keeping up are in blocked,
+# callers call drain_streams() once one of their sinks can be written to.
+# With accept_compressed, HAVE tells senders they may send ZDATA.
+class TransferReceiver:
+    def __init__(self, sock, directory=".", incoming=IncomingTransfer, accept_compressed=True,
+                 max_file_size=DEFAULT_MAX_FILE_SIZE):
+        self.sock = sock
+        self.directory = directory
+        self.incoming = incoming
+        self.max_file_size = min(max_file_size, MAX_FILE_SIZE)
+        self.flags = ACCEPTS_COMPRESSED if accept_compressed else 0
+        self.transfers = {} # (address, transfer id) -> IncomingTransfer
+        self.completed = OrderedDict() # (address, transfer id) -> payload count, to re-ack late duplicates
+        self.pending_acks = {} # (address, transfer id) -> transfer that has unacked datagrams
+        self.blocked = {} # (address, transfer id) -> transfer with data waiting for its sink
+        self.stopped = False
+        self.buffer = bytearray(65536)
+        self.buffer_view = memoryview(self.buffer)
+        set_buffer_sizes(sock)
+
+    # Blocks for the first datagram, as long as the socket timeout allows, then drains the socket
+    def receive(self, max_batch=RECEIVE_BATCH):
+        completed = []
+        timeout = self.sock.gettimeout()
+        try:
+            for count in range(max_batch):
+                try:
+                    nbytes, address = self.sock.recvfrom_into(self.buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                if count == 0:
+                    # Sockets with a timeout wait for it even with MSG_DONTWAIT, so drain the rest in non-blocking mode
+                    self.sock.settimeout(0.0)
+                if nbytes >= HEADER.size and self.buffer[0] == STOP:
+                    self.stopped = True
+                    break
+                transfer = self.handle_datagram(self.buffer_view[:nbytes], address)
+                if transfer is not None:
+                    completed.append(transfer)
+        finally:
+            self.sock.settimeout(timeout)
+            self.flush_acks()
+        return completed
+
+    def handle_datagram(self, data, address):
+        if len(data) < HEADER.size:
+            return None
+        kind, transfer_id, seq = HEADER.unpack_from(data)
+        key = (address, transfer_id)
+        transfer = self.transfers.get(key)
+
+        if transfer is None:
+            if key in self.completed:
+                self.sock.sendto(HEADER.pack(ACK, transfer_id, self.completed[key]) + ACK_BODY.pack(MAX_WINDOW), address)
+            elif kind == START:
+                transfer = self.start(key, data)
+                if transfer is not None and transfer.ready():
+                    return self.started(key, transfer)
+            return None
+
+        transfer.last_activity = time.monotonic()
+        if not transfer.ready():
+            if kind == MANIFEST:
+                self.add_hashes(transfer, seq, data[HEADER.size:])
+                if transfer.ready():
+                    return self.started(key, transfer)
+            return None
+        if kind == START:
+            # The sender missed HAVE
+            self.send_have(transfer)
+            return None
+        if kind == DATA and seq < transfer.total:
+            transfer.stats.payload_bytes += len(data) - HEADER.size
+            transfer.stats.wire_bytes += len(data) - HEADER.size
+            transfer.store(seq, data[HEADER.size:])
+            if transfer.waiting():
+                self.blocked[key] = transfer
+        elif kind == ZDATA and seq < transfer.total and self.flags & ACCEPTS_COMPRESSED:
+            payload = self.inflate(transfer, data[HEADER.size:])
+            if payload is None:
+                return None
+            transfer.stats.payload_bytes += len(payload)
+            transfer.stats.wire_bytes += len(data) - HEADER.size
+            transfer.store(seq, payload)
+            if transfer.waiting():
+                self.blocked[key] = transfer
+        self.pending_acks[key] = transfer
+        if transfer.complete():
+            return self.finish(key, transfer)
+        return None
+
+    # A payload that does not inflate to at most a payload is dropped, the sender sends it again
+    def inflate(self, transfer, body):
+        started = time.thread_time()
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            payload = inflater.decompress(body, transfer.payload_size)
+        except zlib.error:
+            return None
+        finally:
+            transfer.stats.compress_seconds += time.thread_time() - started
+        if not inflater.eof or inflater.unconsumed_tail:
+            return None
+        return payload
+
+    # Returns None for a START that is not well formed, any datagram can arrive on the socket
+    def start(self, key, data):
+        if len(data) < HEADER.size + START_BODY.size:
+            return None
+        size, payload_size, chunk_payloads, digest = START_BODY.unpack_from(data, HEADER.size)
+        if (not 1 <= payload_size <= MAX_PAYLOAD_SIZE or chunk_payloads < 1 or size > self.max_file_size
+                or payload_count(size, payload_size) > MAX_PAYLOADS):
+            return None
+        try:
+            sender, filename = bytes(data[HEADER.size + START_BODY.size:]).decode().split(" ", 1)
+        except (UnicodeDecodeError, ValueError):
+            return None
+        # Both name parts come from the datagram: a sender that is not a plain name is ignored, and
+        # only the file's base name is used, so a datagram cannot write outside the directory
+        if sender in ("", ".", "..") or os.sep in sender or (os.altsep and os.altsep in sender):
+            return None
+        path = os.path.join(self.directory, f"{sender}_{os.path.basename(filename)}")
+        transfer = self.incoming(key[1], key[0], sender, filename, path, size, payload_size, chunk_payloads, digest)
+        # Streams that are played need no disk, a file has to fit beside the ones still arriving
+        needed = transfer.disk_needed()
+        if needed:
+            needed += sum(other.disk_needed() for other in self.transfers.values())
+            if needed > shutil.disk_usage(self.directory).free:
+                transfer.close()
+                return None
+        self.transfers[key] = transfer
+        if transfer.chunks == 0:
+            self.add_hashes(transfer, 0, b"")
+        return transfer
+
+    # Hashes from a MANIFEST datagram, the files are opened once all of them match the digest
+    def add_hashes(self, transfer, first, body):
+        for index in range(min(len(body) // HASH_SIZE, transfer.chunks - first)):
+            if transfer.hashes[first + index] is None:
+                transfer.hashes[first + index] = bytes(body[index * HASH_SIZE:(index + 1) * HASH_SIZE])
+                transfer.missing_hashes -= 1
+        if transfer.missing_hashes:
+            return
+        if manifest_digest(transfer.size, transfer.payload_size, transfer.chunk_payloads, transfer.hashes) != transfer.digest:
+            # The sender sends the manifest again with its next START
+            transfer.hashes = [None] * transfer.chunks
+            transfer.missing_hashes = transfer.chunks
+            return
+        transfer.open()
+
+    # Answers START with the chunks already here, then finishes a file that was complete already
+    def started(self, key, transfer):
+        self.send_have(transfer)
+        if transfer.complete():
+            return self.finish(key, transfer)
+        return None
+
+    def send_have(self, transfer):
+        have = encode_sack(transfer.verified, 0, transfer.chunks)
+        self.sock.sendto(HEADER.pack(HAVE, transfer.transfer_id, transfer.chunks) + bytes((self.flags,)) + have,
+                         transfer.address)
+
+    def flush_acks(self):
+        for transfer in self.pending_acks.values():
+            self.send_ack(transfer)
+            for chunk, rejection in transfer.rejected.items():
+                self.sock.sendto(HEADER.pack(REJECT, transfer.transfer_id, chunk) + REJECT_BODY.pack(rejection), transfer.address)
+        self.pending_acks.clear()
+
+    def send_ack(self, transfer):
+        window = transfer.window()
+        transfer.advertised = window
+        self.sock.sendto(HEADER.pack(ACK, transfer.transfer_id, transfer.cum) + ACK_BODY.pack(window) + transfer.sack(),
+                         transfer.address)
+
+    # Returns the transfer once it is done, a stream is only done once its player has everything
+    def finish(self, key, transfer):
+        del self.transfers[key]
+        self.completed[key] = transfer.total
+        if len(self.completed) > 256:
+            self.completed.popitem(last=False)
+        if transfer.waiting():
+            return None
+        self.blocked.pop(key, None)
+        transfer.finish()
+        transfer.stats.finished = time.monotonic()
+        return transfer
+
+    # Writes what the blocked streams' sinks take now and returns the streams that finished playing
+    # A stream still being received gets a fresh ack once its window has opened by a quarter, or at
+    # all after the last ack closed it
+    def drain_streams(self):
+        finished = []
+        for key, transfer in list(self.blocked.items()):
+            transfer.drain()
+            window = transfer.window()
+            if key in self.transfers and (window - transfer.advertised >= max(transfer.slots // 4, 1)
+                                          or (window and not transfer.advertised)):
+                self.send_ack(transfer)
+            if transfer.waiting():
+                continue
+            del self.blocked[key]
+            if key not in self.transfers:
+                transfer.finish()
+                transfer.stats.finished = time.monotonic()
+                finished.append(transfer)
+        return finished
+
+    # Closes every transfer still in progress and every stream still playing, on logout
+    def close(self):
+        for transfer in self.transfers.values():
+            transfer.close()
+        for transfer in self.blocked.values():
+            transfer.close()
+        self.transfers.clear()
+        self.blocked.clear()
+
+    # Drops transfers whose sender went away, returns them so the caller can report them
+    # Their .part and .part.bitmap files stay, so sending the file again resumes it
+    def expire_idle(self, timeout=IDLE_TIMEOUT):
+        now = time.monotonic()
+        expired = [key for key, transfer in self.transfers.items() if now - transfer.last_activity > timeout]
+        dropped = []
+        for key in expired:
+            transfer = self.transfers.pop(key)
+            self.pending_acks.pop(key, None)
+            self.blocked.pop(key, None)
+            transfer.close()
+            dropped.append(transfer)
+        return dropped